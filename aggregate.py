@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Merge the result shards written by run_analysis --output (from any number of
+workers or machines) into histograms and summary tables, and optionally plots.
+"""
+
+import argparse
+
+import numpy
+
+from pdb_parser import COIL, HELIX, SHEET
+from results_sink import read_shards
+
+# Width (in angstroms) of the bins of the distance table
+DISTANCE_BIN = 1.0
+
+# The secondary structure classes in the order they are tabulated
+SECONDARY_STRUCTURE = (HELIX, SHEET, COIL)
+SECONDARY_STRUCTURE_NAMES = {HELIX: "helix", SHEET: "sheet", COIL: "coil"}
+
+
+def pairs_histogram(pairs_per_structure):
+    """
+    Count how many structures have each number of (site, dehydron) pairs.
+    """
+
+    return numpy.bincount(numpy.asarray(pairs_per_structure, dtype=int), minlength=1)
+
+def print_histogram(histogram):
+    """
+    Print a histogram made by pairs_histogram as a table.
+    """
+
+    print("{:>8} {:>12}".format("pairs", "structures"))
+    for pairs, count in enumerate(histogram.tolist()):
+        if count:
+            print("{:>8} {:>12}".format(pairs, count))
+
+def print_summary(structures, sites):
+    """
+    Print summary tables of merged results: totals, pairs by site residue and
+    pairs by the larger of the distances from the site to the dehydron ends.
+    """
+
+    pairs = structures["pairs"]
+    print("Structures: {}".format(len(pairs)))
+    print("Structures with a site near a dehydron: {}".format(int((pairs > 0).sum())))
+    print("Pairs: {}".format(int(pairs.sum())))
+
+    if not len(sites["pdb_name"]):
+        return
+    print("")
+    print("{:>8} {:>12} {:>12}".format("residue", "pairs", "sites"))
+    site_keys = numpy.array(["{} {} {}".format(*x) for x in
+                             zip(sites["pdb_name"], sites["site_chain"], sites["site_sequence_id"])])
+    for name in numpy.unique(sites["site_name"]).tolist():
+        selected = sites["site_name"] == name
+        print("{:>8} {:>12} {:>12}".format(name, int(selected.sum()), len(numpy.unique(site_keys[selected]))))
+
+    print_secondary_structure(sites)
+
+    print("")
+    reach = numpy.maximum(sites["donor_distance"], sites["acceptor_distance"])
+    edges = numpy.arange(0, numpy.floor(reach.max() / DISTANCE_BIN) + 2) * DISTANCE_BIN
+    counts, _ = numpy.histogram(reach, edges)
+    print("{:>16} {:>12} {:>12}".format("distance", "pairs", "cumulative"))
+    for low, high, count, cumulative in zip(edges[:-1], edges[1:], counts, numpy.cumsum(counts)):
+        print("{:>16} {:>12} {:>12}".format("{:.1f}-{:.1f}".format(low, high), count, cumulative))
+
+def print_secondary_structure(sites):
+    """
+    Print a table of the pairs by the secondary structure of the site (rows)
+    and of the dehydron (columns). A dehydron whose ends are in different
+    classes is counted as mixed. Sites from shards written before secondary
+    structure was recorded are left out.
+    """
+
+    known = sites["site_ss"] != ""
+    if not known.any():
+        return
+    site_classes = sites["site_ss"][known]
+    dehydron_classes = numpy.where(sites["donor_ss"][known] == sites["acceptor_ss"][known],
+                                   sites["donor_ss"][known], "mixed")
+    columns = SECONDARY_STRUCTURE + ("mixed",)
+    print("")
+    print("{:>8}".format("site") + "".join("{:>12}".format(SECONDARY_STRUCTURE_NAMES.get(x, x)) for x in columns))
+    for site_class in SECONDARY_STRUCTURE:
+        selected = dehydron_classes[site_classes == site_class]
+        print("{:>8}".format(SECONDARY_STRUCTURE_NAMES[site_class]) +
+              "".join("{:>12}".format(int((selected == x).sum())) for x in columns))
+
+def print_slowest(structures, count):
+    """
+    Print the structures that took longest to analyze, with the time of the
+    main stages and the size of each one.
+    """
+
+    wall = structures["wall_seconds"]
+    timed = numpy.nonzero(~numpy.isnan(wall))[0]
+    if not len(timed):
+        return
+    slowest = timed[numpy.argsort(-wall[timed], kind="mergesort")[:count]]
+    columns = ("wall_seconds", "parse_seconds", "residues_seconds", "distances_seconds", "atoms", "dehydrons",
+               "sites", "peak_growth_kb")
+    print("{:<12}".format("pdb") + "".join("{:>19}".format(x) for x in columns))
+    for i in slowest.tolist():
+        print("{:<12}".format(structures["pdb_name"][i]) +
+              "".join("{:>19.4g}".format(structures[x][i]) for x in columns))
+
+def plot_histogram(pairs_per_structure, file_name=None):
+    """
+    Plot a histogram of the number of pairs per structure, saving it to
+    file_name or showing it if file_name is None. This is the only place
+    matplotlib is imported, so nothing else depends on it.
+    """
+
+    import matplotlib
+    if file_name is not None:
+        matplotlib.use("Agg")
+    from matplotlib import pyplot
+
+    pyplot.hist(pairs_per_structure)
+    pyplot.xlabel('Number of phosphorylated TYR')
+    pyplot.ylabel('Number of occurrences')
+    pyplot.title('Number of phosphorylated TYR per PDB file')
+    if file_name is None:
+        pyplot.show()
+    else:
+        pyplot.savefig(file_name)
+        pyplot.close()
+
+def main():
+    """
+    Run the main functionality for this script.
+    """
+
+    parser = argparse.ArgumentParser(description="Aggregate sharded analysis results")
+    parser.add_argument("shards", nargs="+", help="Shard files or directories of shards")
+    parser.add_argument("--plot", default=None, help="Save a histogram plot to this file")
+    parser.add_argument("--slowest", default=10, type=int,
+                        help="List this many of the structures that took longest to analyze")
+    args = parser.parse_args()
+
+    structures, sites = read_shards(args.shards)
+    print_summary(structures, sites)
+    print("")
+    print_histogram(pairs_histogram(structures["pairs"]))
+    if args.slowest:
+        print("")
+        print_slowest(structures, args.slowest)
+    if args.plot is not None:
+        plot_histogram(structures["pairs"], args.plot)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+The core of the analysis of phosphorylation sites and dehydrons. This only
+depends on numpy and the parsers, so it is cheap to import; the command line
+interface is in run_analysis.
+"""
+
+import logging
+import os
+
+import numpy
+
+import instrument
+import pdb_parser
+import wrappa
+import wrapping
+from pdb_parser import find_points_near_bonds, nearest_bond_distances, parse_pdb, parse_pdb_contents
+from wrappa import get_dehydrons, parse_wrappers
+
+# RESIDUES_OF_INTEREST = ("TYR", "SER", "THR")#, "PTR", "SEP", "TPO")
+RESIDUES_OF_INTEREST = ("TYR")#, "PTR")
+
+# Sites within this distance (in angstroms) of both ends of a dehydron are in
+# its desolvation domain
+DESOLVATION_CUTOFF = 6.5
+
+# The only atoms the analysis looks at, so nothing else is loaded
+ANALYSIS_ATOMS = ("CA",)
+
+# Where dehydrons come from: the WRAPPA output next to each PDB file or the
+# local engine in wrapping
+DEHYDRON_SOURCES = ("wrappa", "local")
+
+# Above this many (dehydron, site) pairs the spatial index is used instead of
+# a full distance matrix
+BROADCAST_PAIR_LIMIT = 1000000
+
+# Bump this whenever the analysis changes so stored results are recomputed
+ANALYSIS_VERSION = 3
+
+def count_residues(pdb_data):
+    """
+    Count the number of different residues that occur in the PDB data.
+    """
+
+    return pdb_data.count_compounds(RESIDUES_OF_INTEREST)
+
+def get_dehydron_residues(pdb_data, dehydrons):
+    """
+    Converts a list of dehydrons to a list of pairs of residues.
+    """
+
+    return [(pdb_data.get_residue_by_id(dehydron[0][0], dehydron[0][1]),
+             pdb_data.get_residue_by_id(dehydron[1][0], dehydron[1][1])) for dehydron in dehydrons]
+
+def get_dehydron_positions(pdb_data, dehydrons, dehydron_residues=None):
+    """
+    Converts a list of dehdyrons to a list of positions.
+    """
+
+    if dehydron_residues is None:
+        dehydron_residues = get_dehydron_residues(pdb_data, dehydrons)
+
+    dehydron_positions = []
+    for residue1, residue2 in dehydron_residues:
+        position1 = residue1.get_atom("CA").position
+        position2 = residue2.get_atom("CA").position
+        dehydron_positions.append((position1, position2))
+    return dehydron_positions
+
+def dehydron_site_distances(dehydron_positions, site_positions):
+    """
+    Compute the distance from both ends of every dehydron to every site in one
+    go. Takes a (D, 2, 3) array of dehydron end positions and an (S, 3) array
+    of site positions and returns a (D, 2, S) array of distances.
+    """
+
+    dehydron_positions = numpy.asarray(dehydron_positions, dtype=numpy.float64).reshape(-1, 2, 3)
+    site_positions = numpy.asarray(site_positions, dtype=numpy.float64).reshape(-1, 3)
+    delta = dehydron_positions[:, :, None, :] - site_positions[None, None, :, :]
+    return numpy.sqrt((delta * delta).sum(axis=-1))
+
+def desolvation_mask(dehydron_positions, site_positions, cutoff=DESOLVATION_CUTOFF):
+    """
+    Returns a (D, S) boolean array that is true where a site is within cutoff
+    of both ends of a dehydron.
+    """
+
+    return (dehydron_site_distances(dehydron_positions, site_positions) <= cutoff).all(axis=1)
+
+def min_dehydron_distances(dehydron_positions, site_positions):
+    """
+    Returns an array with the minimum (over all dehydrons) of the mean distance
+    from each site to the two ends of a dehydron. This is inf if there are no
+    dehydrons.
+    """
+
+    distances = dehydron_site_distances(dehydron_positions, site_positions)
+    if not len(distances):
+        return numpy.full(distances.shape[2], numpy.inf)
+    return distances.mean(axis=1).min(axis=0)
+
+def desolvation_reach(dehydron_positions, site_positions, max_cutoff):
+    """
+    Find every (dehydron, site) pair where the site is within max_cutoff of
+    both ends of the dehydron, along with the larger of the two end distances.
+    That distance is the smallest cutoff at which the site is in the
+    dehydron's desolvation domain, so one call answers the question for every
+    cutoff up to max_cutoff. Returns arrays of dehydron indices, site indices
+    and distances.
+    """
+
+    dehydron_positions = numpy.asarray(dehydron_positions, dtype=numpy.float64).reshape(-1, 2, 3)
+    site_positions = numpy.asarray(site_positions, dtype=numpy.float64).reshape(-1, 3)
+    if len(dehydron_positions) * len(site_positions) <= BROADCAST_PAIR_LIMIT:
+        reach = dehydron_site_distances(dehydron_positions, site_positions).max(axis=1)
+        bonds, near = numpy.nonzero(reach <= max_cutoff)
+        return bonds, near, reach[bonds, near]
+
+    bonds, near = find_points_near_bonds(dehydron_positions, site_positions, max_cutoff)
+    instrument.count("distance_evaluations", 2 * len(bonds))
+    reach = numpy.maximum(numpy.linalg.norm(dehydron_positions[bonds, 0] - site_positions[near], axis=1),
+                          numpy.linalg.norm(dehydron_positions[bonds, 1] - site_positions[near], axis=1))
+    return bonds, near, reach
+
+def phosphorylation_in_desolvation(pdb_data, sites, dehydrons, cutoff=DESOLVATION_CUTOFF):
+    """
+    This will identify all sites that fall within a desolvation domain of a dehydron.
+    This will return a list of tuples where the first element represents the phosphorylation
+    site and the second represents the dehydron which it is close to.
+    """
+
+    with instrument.stage("residues"):
+        dehydron_residues = get_dehydron_residues(pdb_data, dehydrons)
+        dehydron_positions = get_dehydron_positions(pdb_data, dehydrons, dehydron_residues)
+
+    errors = 0
+    located_sites = []
+    for site in sites:
+        if site.get_atom("CA") is None:
+            logging.debug("Site %s has no CA atom", site)
+            errors += len(dehydrons)
+        else:
+            located_sites.append(site)
+    site_positions = [site.get_atom("CA").position for site in located_sites]
+
+    with instrument.stage("distances"):
+        if len(dehydron_positions) * len(site_positions) <= BROADCAST_PAIR_LIMIT:
+            instrument.count("distance_evaluations", 2 * len(dehydron_positions) * len(site_positions))
+            bonds, near = numpy.nonzero(desolvation_mask(dehydron_positions, site_positions, cutoff))
+        else:
+            bonds, near = find_points_near_bonds(dehydron_positions, site_positions, cutoff)
+    results = [(located_sites[j], dehydron_residues[i]) for i, j in zip(bonds.tolist(), near.tolist())]
+    if errors:
+        logging.debug("Skipped %d (site, dehydron) pairs without a CA atom", errors)
+    return results
+
+def min_distance_to_dehydron(pdb_data, sites, dehydrons):
+    """
+    Get the minimum distance to a dehydron.
+    """
+
+    dehydron_positions = get_dehydron_positions(pdb_data, dehydrons)
+    site_alphas = [site.get_atom("CA") for site in sites]
+    site_positions = [x.position for x in site_alphas if x is not None]
+
+    if len(dehydron_positions) * len(site_positions) <= BROADCAST_PAIR_LIMIT:
+        min_distances = min_dehydron_distances(dehydron_positions, site_positions)
+    else:
+        min_distances, _ = nearest_bond_distances(dehydron_positions, site_positions)
+    return [x for x in min_distances.tolist() if x != float("inf")]
+
+
+def load_structure(pdb_name, data_directory, dehydron_source="wrappa", contents=None):
+    """
+    Load the parts of a PDB file the analysis needs and its dehydrons, either
+    from the PDB_NAME_wrappers.txt file or (with a dehydron_source of local)
+    found from the structure itself by wrapping.find_dehydrons.
+
+    If contents is given it is a tuple of the contents of the PDB file and
+    the wrappers file (as read from an archive, see corpus.iter_archive),
+    which are parsed instead of the files in data_directory. The wrappers
+    may be None with a dehydron_source of local.
+    """
+
+    atom_names = ANALYSIS_ATOMS
+    if dehydron_source == "local":
+        atom_names = tuple(sorted(set(ANALYSIS_ATOMS + wrapping.WRAPPING_ATOMS)))
+    records = ("ATOM", "HETATM", "HELIX", "SHEET")
+    with instrument.stage("parse"):
+        if contents is not None:
+            pdb_data = parse_pdb_contents(contents[0], atom_names=atom_names, records=records,
+                                          file_name=pdb_name + ".pdb")
+        else:
+            pdb_data = parse_pdb(os.path.join(data_directory, pdb_name + ".pdb"), atom_names=atom_names,
+                                 records=records)
+    instrument.count("atoms", len(pdb_data.atoms))
+    with instrument.stage("dehydrons"):
+        if dehydron_source == "local":
+            dehydrons = wrapping.find_dehydrons(pdb_data)
+        elif contents is not None:
+            dehydrons = parse_wrappers(contents[1].splitlines(True)).dehydrons()
+        else:
+            dehydrons = get_dehydrons(os.path.join(data_directory, pdb_name + "_wrappers.txt"))
+    instrument.count("dehydrons", len(dehydrons))
+    return pdb_data, dehydrons
+
+def run_analysis(pdb_name, data_directory, dehydron_source="wrappa", contents=None):
+    """
+    This will run the analysis on a single pdb file. The PDB name should be a raw
+    PDB name (i.e. 1a81H) and the data directory should contain the following files:
+
+        1) PDB_NAME.pdb
+        2) PDB_NAME_wrappers.txt
+        3) PDB_NAME_bonds.txt
+
+    (only the PDB file is needed if dehydron_source is local, and the files
+    can be passed in as contents instead, see load_structure).
+
+    The analysis consists of the following substeps (all of which will be returned)
+
+        1) Count each occurance of a residue of interest (see above). Returns a dictionary
+           of the counts of each residue of interest.
+        2) Counts the number of phosphorylation sites. Returns an integer containing
+           the number of phosphorylation sites.
+        3) Generate a list of phosprohylation sites that are within a desolvation sphere
+           of a dehydron. Returns this list of tuples.
+    """
+
+    logging.info("Running analysis for PDB %s", pdb_name)
+
+    # Load all of the data
+    pdb_data, dehydrons = load_structure(pdb_name, data_directory, dehydron_source, contents)
+    return site_pairs(pdb_data, dehydrons)
+
+def site_pairs(pdb_data, dehydrons):
+    """
+    The sites of interest of a loaded structure that are within a desolvation
+    sphere of a dehydron (see phosphorylation_in_desolvation).
+    """
+
+    # Get the sites of interest
+    with instrument.stage("sites"):
+        phospo_sites = pdb_data.get_phoso_sites()
+        #non_phospo_sites = pdb_data.get_compounds(names=["TYR", "THR", "SER"])
+        non_phospo_sites = pdb_data.get_compounds(names=["TYR"])
+    instrument.count("sites", len(phospo_sites))
+
+    #return min_distance_to_dehydron(pdb_data, non_phospo_sites, dehydrons)
+    #return count_residues(pdb_data), len(phospo_sites), phosphorylation_in_desolvation(pdb_data, phospo_sites, dehydrons)
+    return phosphorylation_in_desolvation(pdb_data, phospo_sites, dehydrons)
+
+def sweep_structure(pdb_name, data_directory, cutoffs, residue_sets, dehydron_source="wrappa", contents=None):
+    """
+    Run the desolvation analysis of run_analysis for every combination of
+    cutoff and set of site residue names at once. The structure is loaded and
+    the site to dehydron distances are computed a single time. Returns a list
+    with, for each residue set, the number of (site, dehydron) pairs within
+    each cutoff.
+    """
+
+    pdb_data, dehydrons = load_structure(pdb_name, data_directory, dehydron_source, contents)
+    with instrument.stage("residues"):
+        dehydron_positions = get_dehydron_positions(pdb_data, dehydrons)
+
+    with instrument.stage("sites"):
+        sites = [x for x in pdb_data.get_compounds(sorted(set().union(*residue_sets)))
+                 if x.get_atom("CA") is not None]
+        site_names = numpy.array([x.name for x in sites], dtype=str)
+        site_positions = [x.get_atom("CA").position for x in sites]
+    instrument.count("sites", len(sites))
+
+    with instrument.stage("distances"):
+        if len(dehydron_positions) * len(site_positions) <= BROADCAST_PAIR_LIMIT:
+            instrument.count("distance_evaluations", 2 * len(dehydron_positions) * len(site_positions))
+        _, near, reach = desolvation_reach(dehydron_positions, site_positions, max(cutoffs))
+
+    counts = []
+    for residue_set in residue_sets:
+        selected = numpy.sort(reach[numpy.isin(site_names[near], list(residue_set))])
+        counts.append(numpy.searchsorted(selected, cutoffs, side="right").tolist())
+    return counts
+
+def analyze_pairs(pdb_name, data_directory, dehydron_source="wrappa", contents=None):
+    """
+    The default analysis: run_analysis with its results summarized (see
+    summarize_pairs), including the secondary structure of every residue.
+    """
+
+    logging.info("Running analysis for PDB %s", pdb_name)
+    pdb_data, dehydrons = load_structure(pdb_name, data_directory, dehydron_source, contents)
+    pairs = site_pairs(pdb_data, dehydrons)
+    with instrument.stage("summarize"):
+        return summarize_pairs(pairs, pdb_data.get_secondary_structure_index())
+
+def analysis_parameters(dehydron_source="wrappa"):
+    """
+    Everything other than the input files that the result of run_analysis
+    depends on, used to tell whether stored results are still valid.
+    """
+
+    parameters = {"version": ANALYSIS_VERSION, "cutoff": DESOLVATION_CUTOFF, "atoms": ANALYSIS_ATOMS,
+                  "sites": ("PTR",), "pdb_parser": pdb_parser.PARSER_VERSION, "wrappa": wrappa.PARSER_VERSION}
+    if dehydron_source == "local":
+        parameters.update(dehydrons=dehydron_source, wrapping=wrapping.WRAPPING_VERSION)
+    return parameters
+
+def analysis_inputs(pdb_file, dehydron_source="wrappa"):
+    """
+    The files that run_analysis reads for a PDB file.
+    """
+
+    if dehydron_source == "local":
+        return [pdb_file]
+    return [pdb_file, pdb_file[:-4] + "_wrappers.txt", pdb_file[:-4] + "_bonds.txt"]
+
+def summarize_pairs(pairs, secondary_structure=None):
+    """
+    Converts the output of phosphorylation_in_desolvation into plain tuples,
+    which are much cheaper to send between processes than the compounds. Each
+    entry is ((chain, sequence id, name) of the site, ((chain, sequence id),
+    (chain, sequence id)) of the dehydron, (distance, distance) from the site
+    to each end of the dehydron, (site, donor, acceptor) secondary structure
+    classes). The classes are looked up in secondary_structure (a
+    SecondaryStructureIndex); without one every residue is coil.
+    """
+
+    if secondary_structure is None:
+        secondary_structure = pdb_parser.SecondaryStructureIndex([], [])
+    summary = []
+    for site, (residue1, residue2) in pairs:
+        position = numpy.array(site.get_atom("CA").position)
+        distances = tuple(float(numpy.linalg.norm(position - numpy.array(x.get_atom("CA").position)))
+                          for x in (residue1, residue2))
+        summary.append(((site.chain_id, site.compound_id, site.name),
+                        ((residue1.chain_id, residue1.compound_id), (residue2.chain_id, residue2.compound_id)),
+                        distances,
+                        tuple(secondary_structure.classify(x.compound_id, x.chain_id)
+                              for x in (site, residue1, residue2))))
+    return summary
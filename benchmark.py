@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the PDB parsers, residue lookups, the WRAPPA reader and the
+analysis.
+
+    benchmark.py run [--output RESULTS.json] [--compare BASELINE.json]
+    benchmark.py compare BASELINE.json RESULTS.json
+
+Each case runs in a process of its own, so the peak memory reported for it
+(the maximum resident set size of that process while the case body runs)
+isn't affected by the other cases. Every repeat of a case gets fresh input
+from its setup, which isn't timed or (on Linux) counted in the peak. Besides
+1a81H.pdb the parsers and lookups are run on synthetic structures of the
+requested sizes (see write_synthetic_pdb).
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import numpy
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+DEFAULT_REPEAT = 5
+# Stop repeating a case once it has run for this many seconds in total
+DEFAULT_MAX_TIME = 10.0
+# Flag a case when it gets this much (as a fraction) slower or bigger
+DEFAULT_THRESHOLD = 0.1
+
+STRUCTURE_CASES = ("parse_pdb_text", "parse_pdb_bulk", "parse_pdb_mmap", "get_compounds", "get_residue_by_id",
+                   "get_helixes", "get_adjacent_compounds", "find_dehydrons")
+
+SYNTHETIC_RESIDUES = ("ALA", "GLY", "SER", "TYR", "LEU", "LYS", "ASP", "PTR")
+SYNTHETIC_ATOMS = ("N", "CA", "C", "O", "CB", "CG", "CD", "CE")
+CHAIN_IDS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def write_synthetic_pdb(file_name, atom_count, chain_count=len(CHAIN_IDS), seed=0):
+    """
+    Write a synthetic PDB file of about atom_count atoms spread over
+    chain_count chains. Each chain is a random walk of residues with
+    SYNTHETIC_ATOMS around each one. Every tenth residue has an insertion code
+    (reusing the previous sequence number), every eighth is a HETATM PTR and
+    each chain has a HELIX record every 20 residues, so every part of the
+    parsers is exercised.
+    """
+
+    random = numpy.random.RandomState(seed)
+    residue_count = max(1, atom_count // len(SYNTHETIC_ATOMS))
+    per_chain = max(1, -(-residue_count // chain_count))
+
+    residue_ids = []
+    sequence_id = 0
+    for residue in range(per_chain):
+        if residue % 10 == 9:
+            residue_ids.append((sequence_id, "A"))
+        else:
+            sequence_id += 1
+            residue_ids.append((sequence_id, ""))
+
+    with open(file_name, "w") as pdb_file:
+        helix = 0
+        for chain_id in CHAIN_IDS[:chain_count]:
+            for start in range(0, per_chain - 10, 20):
+                # The serial number and helix ID columns only have room for three digits
+                helix = helix % 999 + 1
+                (start_id, start_code), (end_id, end_code) = residue_ids[start], residue_ids[start + 10]
+                pdb_file.write("HELIX  {:>3} {:>3} {} {} {:>4}{} {} {} {:>4}{:1}{:>2}\n".format(
+                    helix, helix, SYNTHETIC_RESIDUES[start % 8], chain_id, start_id, start_code or " ",
+                    SYNTHETIC_RESIDUES[(start + 10) % 8], chain_id, end_id, end_code, 1))
+
+        serial = 0
+        for chain_number, chain_id in enumerate(CHAIN_IDS[:chain_count]):
+            steps = random.normal(size=(per_chain, 3))
+            steps *= 3.8 / numpy.linalg.norm(steps, axis=1)[:, None]
+            centers = numpy.cumsum(steps, axis=0) + 50.0 * chain_number
+            positions = centers[:, None, :] + random.normal(scale=1.0, size=(per_chain, len(SYNTHETIC_ATOMS), 3))
+            lines = []
+            for residue, (sequence_id, insertion_code) in enumerate(residue_ids):
+                name = SYNTHETIC_RESIDUES[residue % len(SYNTHETIC_RESIDUES)]
+                record = "HETATM" if name == "PTR" else "ATOM"
+                for atom, (x, y, z) in zip(SYNTHETIC_ATOMS, positions[residue].tolist()):
+                    serial += 1
+                    lines.append("{:<6}{:>5} {:<4} {:>3} {}{:>4}{:1}   {:>8.3f}{:>8.3f}{:>8.3f}{:>6.2f}{:>6.2f}"
+                                 "          {:>2}\n".format(record, serial % 100000, " " + atom, name, chain_id,
+                                                            sequence_id, insertion_code, x, y, z, 1.0, 20.0,
+                                                            atom[0]))
+            pdb_file.writelines(lines)
+        pdb_file.write("END\n")
+
+def case_names(sizes):
+    """
+    The names of all of the benchmark cases, of the form KIND/INPUT.
+    """
+
+    inputs = ["1a81H"] + ["synthetic-{}".format(x) for x in sizes]
+    names = ["{}/{}".format(kind, x) for kind in STRUCTURE_CASES for x in inputs]
+    return names + ["get_dehydrons/wrappers", "run_analysis/1a81H"]
+
+def input_file(input_name, work_directory):
+    """
+    The PDB file a structure case reads.
+    """
+
+    if input_name == "1a81H":
+        return os.path.join(REPOSITORY, "1a81H.pdb")
+    return os.path.join(work_directory, input_name + ".pdb")
+
+def prepare_inputs(names, work_directory):
+    """
+    Write the synthetic structures and the analysis data directory the given
+    cases need, unless they are already in the work directory.
+    """
+
+    for name in names:
+        input_name = name.split("/")[1]
+        if input_name.startswith("synthetic-"):
+            file_name = input_file(input_name, work_directory)
+            if not os.path.exists(file_name):
+                print("Writing {}".format(file_name))
+                write_synthetic_pdb(file_name + ".tmp", int(input_name.split("-")[1]))
+                os.rename(file_name + ".tmp", file_name)
+
+    analysis_directory = os.path.join(work_directory, "analysis")
+    if not os.path.isdir(analysis_directory):
+        os.makedirs(analysis_directory)
+        shutil.copy(os.path.join(REPOSITORY, "1a81H.pdb"), analysis_directory)
+        shutil.copy(os.path.join(REPOSITORY, "wrappers.txt"), os.path.join(analysis_directory, "1a81H_wrappers.txt"))
+
+def load_case(name, work_directory):
+    """
+    Get the setup and body functions of a case. The body is timed on whatever
+    setup returns.
+    """
+
+    import analysis
+    import pdb_parser
+    import wrappa
+
+    kind, input_name = name.split("/")
+    if kind == "get_dehydrons":
+        file_name = os.path.join(REPOSITORY, "wrappers.txt")
+        return (lambda: file_name), wrappa.get_dehydrons
+    if kind == "run_analysis":
+        directory = os.path.join(work_directory, "analysis")
+        return (lambda: directory), lambda x: analysis.run_analysis(input_name, x)
+
+    file_name = input_file(input_name, work_directory)
+    if kind.startswith("parse_pdb_"):
+        return (lambda: file_name), getattr(pdb_parser, kind)
+    if kind == "get_compounds":
+        return (lambda: pdb_parser.parse_pdb(file_name)), lambda data: data.get_compounds()
+    if kind == "get_helixes":
+        return (lambda: pdb_parser.parse_pdb(file_name)), lambda data: data.get_helixes()
+    if kind == "get_adjacent_compounds":
+        return (lambda: pdb_parser.parse_pdb(file_name)), lambda data: data.get_adjacent_compounds()
+    if kind == "find_dehydrons":
+        import wrapping
+        return (lambda: pdb_parser.parse_pdb(file_name)), wrapping.find_dehydrons
+    if kind == "get_residue_by_id":
+        residue_ids = [(x.compound_id, x.chain_id) for x in pdb_parser.parse_pdb(file_name).get_compounds()]
+
+        def lookup_all(data):
+            for residue_id, chain_id in residue_ids:
+                data.get_residue_by_id(residue_id, chain_id)
+        return (lambda: pdb_parser.parse_pdb(file_name)), lookup_all
+    raise ValueError("Unknown benchmark case {}".format(name))
+
+def time_case(name, work_directory, repeat, max_time):
+    """
+    Run a case in this process. Returns the time of each repeat and the peak
+    memory use of the body. The peak is reset after every setup, where the
+    platform allows it (see instrument.reset_peak_memory).
+    """
+
+    import parse_cache
+    from instrument import peak_memory, reset_peak_memory
+    parse_cache.configure(None)
+
+    setup, body = load_case(name, work_directory)
+    times = []
+    peak = None
+    for _ in range(repeat):
+        state = setup()
+        reset_peak_memory()
+        start = timeit.default_timer()
+        body(state)
+        times.append(timeit.default_timer() - start)
+        peak = max(peak, peak_memory()) if peak is not None else peak_memory()
+        if sum(times) >= max_time:
+            break
+    return {"times": times, "peak_rss_kb": peak}
+
+def run_case(name, work_directory, repeat, max_time):
+    """
+    Run a case in a new process and summarize its times. A case that fails is
+    recorded as a dictionary holding the error rather than stopping the run.
+    """
+
+    handle, result_file = tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+    try:
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), "case", name, "--work-dir",
+                                   work_directory, "--repeat", str(repeat), "--max-time", str(max_time),
+                                   "--result-file", result_file], cwd=REPOSITORY, stdout=devnull)
+        with open(result_file) as results:
+            result = json.load(results)
+    except (subprocess.CalledProcessError, IOError, ValueError) as e:
+        return {"error": str(e)}
+    finally:
+        os.remove(result_file)
+
+    times = sorted(result["times"])
+    return {"best": times[0], "median": times[len(times) // 2], "repeats": len(times),
+            "peak_rss_kb": result["peak_rss_kb"]}
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Print a comparison of two sets of results. Returns the names of the cases
+    whose median time or peak memory grew by more than threshold.
+    """
+
+    regressions = []
+    print("{:<40} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+        "case", "base (s)", "now (s)", "change", "base (MB)", "now (MB)", "change"))
+    for name in sorted(set(baseline["cases"]) & set(current["cases"])):
+        before, after = baseline["cases"][name], current["cases"][name]
+        if "error" in before or "error" in after:
+            # A case that stopped working is a regression; one that was broken has nothing to compare
+            if "error" in after and "error" not in before:
+                regressions.append(name)
+            print("{:<40} {}".format(name, "FAILED: " + after["error"] if "error" in after else "fixed"))
+            continue
+        changes = []
+        for key in ("median", "peak_rss_kb"):
+            if before[key] and after[key] is not None:
+                changes.append(after[key] / float(before[key]) - 1)
+            else:
+                changes.append(0.0)
+        regressed = any(x > threshold for x in changes)
+        if regressed:
+            regressions.append(name)
+        print("{:<40} {:>10.4f} {:>10.4f} {:>+7.0%} {:>10.1f} {:>10.1f} {:>+7.0%}{}".format(
+            name, before["median"], after["median"], changes[0], (before["peak_rss_kb"] or 0) / 1024.0,
+            (after["peak_rss_kb"] or 0) / 1024.0, changes[1], "  REGRESSION" if regressed else ""))
+    return regressions
+
+def load_results(file_name):
+    with open(file_name) as results:
+        return json.load(results)
+
+def main():
+    """
+    Run the main functionality for this script.
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark the parsers and the analysis")
+    commands = parser.add_subparsers(dest="command")
+    # Subcommands are optional by default on Python 3
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--cases", nargs="+", default=["*"],
+                            help="Only run cases matching these patterns (e.g. 'parse_pdb_*/1a81H')")
+    run_parser.add_argument("--sizes", default=",".join(str(x) for x in DEFAULT_SIZES),
+                            help="Comma separated atom counts of the synthetic structures")
+    run_parser.add_argument("--repeat", default=DEFAULT_REPEAT, type=int, help="Maximum repeats of each case")
+    run_parser.add_argument("--max-time", default=DEFAULT_MAX_TIME, type=float,
+                            help="Stop repeating a case after this many seconds")
+    run_parser.add_argument("--work-dir", default=None,
+                            help="Keep generated inputs in this directory so later runs can reuse them")
+    run_parser.add_argument("--output", default=None, help="Save the results (a baseline) as JSON")
+    run_parser.add_argument("--compare", default=None, help="Compare the results against this baseline")
+    run_parser.add_argument("--threshold", default=DEFAULT_THRESHOLD, type=float,
+                            help="Relative slowdown or memory growth counted as a regression")
+
+    compare_parser = commands.add_parser("compare", help="Compare two sets of results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", default=DEFAULT_THRESHOLD, type=float,
+                                help="Relative slowdown or memory growth counted as a regression")
+
+    case_parser = commands.add_parser("case")
+    case_parser.add_argument("name")
+    case_parser.add_argument("--work-dir", required=True)
+    case_parser.add_argument("--repeat", type=int, required=True)
+    case_parser.add_argument("--max-time", type=float, required=True)
+    case_parser.add_argument("--result-file", required=True)
+
+    args = parser.parse_args()
+
+    if args.command == "case":
+        result = time_case(args.name, args.work_dir, args.repeat, args.max_time)
+        with open(args.result_file, "w") as result_file:
+            json.dump(result, result_file)
+        return
+
+    if args.command == "compare":
+        sys.exit(1 if compare(load_results(args.baseline), load_results(args.current), args.threshold) else 0)
+
+    sizes = [int(x) for x in args.sizes.split(",") if x]
+    names = [x for x in case_names(sizes) if any(fnmatch.fnmatch(x, pattern) for pattern in args.cases)]
+    work_directory = args.work_dir or tempfile.mkdtemp(prefix="benchmark-")
+    if not os.path.isdir(work_directory):
+        os.makedirs(work_directory)
+    try:
+        prepare_inputs(names, work_directory)
+        results = {"python": platform.python_version(), "numpy": numpy.__version__, "platform": platform.platform(),
+                   "date": time.strftime("%Y-%m-%d %H:%M:%S"), "cases": {}}
+        for name in names:
+            result = run_case(name, work_directory, args.repeat, args.max_time)
+            results["cases"][name] = result
+            if "error" in result:
+                print("{:<40} FAILED: {}".format(name, result["error"]))
+                continue
+            print("{:<40} {:>10.4f} s {:>10.1f} MB".format(name, result["median"],
+                                                           (result["peak_rss_kb"] or 0) / 1024.0))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare is not None:
+        sys.exit(1 if compare(load_results(args.compare), results, args.threshold) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Streaming access to a whole corpus of structures and their dehydrons, either
+from a directory or straight from a tar archive (such as phospho.tar.gz)
+without extracting it.
+"""
+
+import logging
+import os
+import tarfile
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from pdb_parser import iter_pdb_files, parse_pdb, parse_pdb_contents
+from wrappa import get_dehydrons, parse_wrappers
+
+_DONE = object()
+
+
+def prefetch(items, size):
+    """
+    Iterate over items on a background thread, keeping up to size items ready
+    ahead of the consumer. Exceptions raised while producing items are raised
+    again in the consumer. Closing the generator stops the background thread
+    once it finishes the item it is working on.
+    """
+
+    ready = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except Exception as error:
+            put((_DONE, error))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+def pdb_name_of(file_name):
+    """
+    The PDB name (i.e. 1a81H) of a .pdb or .pdb.gz file.
+    """
+
+    file_name = os.path.basename(file_name)
+    return file_name[:-7] if file_name.endswith(".pdb.gz") else file_name[:-4]
+
+def load_structure(pdb_file, **parse_options):
+    """
+    Load a PDB file (optionally gzipped) and the dehydrons from the
+    PDB_NAME_wrappers.txt file (or PDB_NAME_wrappers.txt.gz) next to it.
+    Returns a tuple of (pdb_name, structure, dehydrons).
+    """
+
+    pdb_name = pdb_name_of(pdb_file)
+    wrappers_file = os.path.join(os.path.dirname(pdb_file), pdb_name + "_wrappers.txt")
+    if not os.path.exists(wrappers_file) and os.path.exists(wrappers_file + ".gz"):
+        wrappers_file += ".gz"
+    structure = parse_pdb(pdb_file, **parse_options)
+    dehydrons = get_dehydrons(wrappers_file)
+    return pdb_name, structure, dehydrons
+
+def iter_archive(file_name, wrappers=True):
+    """
+    Yields (pdb_name, pdb contents, wrappers contents) for every PDB file in a
+    tar archive (compressed or not) that has a PDB_NAME_wrappers.txt member.
+    The archive is read as a stream in a single pass; a member is only held
+    until its partner turns up, so an archive that keeps the two together
+    never holds more than a structure at once. PDB files without wrappers are
+    skipped with a warning. If wrappers is false the wrappers members are
+    ignored and every PDB file is yielded as soon as it is read, with None
+    for its wrappers.
+    """
+
+    pending = {}
+    with tarfile.open(file_name, "r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            base_name = os.path.basename(member.name)
+            if base_name.endswith(".pdb"):
+                pdb_name, part = base_name[:-4], "pdb"
+            elif base_name.endswith("_wrappers.txt"):
+                pdb_name, part = base_name[:-len("_wrappers.txt")], "wrappers"
+            else:
+                continue
+            if not wrappers:
+                if part == "pdb":
+                    yield pdb_name, archive.extractfile(member).read(), None
+                continue
+            parts = pending.setdefault(pdb_name, {})
+            parts[part] = archive.extractfile(member).read()
+            if len(parts) == 2:
+                del pending[pdb_name]
+                yield pdb_name, parts["pdb"], parts["wrappers"]
+    for pdb_name in sorted(x for x, parts in pending.items() if "pdb" in parts):
+        logging.warning("No wrappers for %s in %s", pdb_name, file_name)
+
+def load_archived_structure(pdb_name, pdb_contents, wrappers_contents, **parse_options):
+    """
+    Load a structure and its dehydrons from the contents of the files (as
+    yielded by iter_archive). Returns a tuple of (pdb_name, structure,
+    dehydrons).
+    """
+
+    structure = parse_pdb_contents(pdb_contents, file_name=pdb_name + ".pdb", **parse_options)
+    dehydrons = parse_wrappers(wrappers_contents.splitlines(True)).dehydrons()
+    return pdb_name, structure, dehydrons
+
+def iter_corpus(source, readahead=0, **parse_options):
+    """
+    Yields (pdb_name, structure, dehydrons) for every PDB file in a corpus,
+    loading each one only when it is needed, so memory use does not grow with
+    the size of the corpus. The source is either a directory of .pdb (or
+    .pdb.gz) files and their wrappers files or a tar archive of them (see
+    iter_archive). With readahead set the next readahead structures are
+    loaded on a background thread while the current one is being used; for
+    an archive decompression gets a background thread of its own as well.
+    Any remaining keyword arguments are passed on to parse_pdb.
+    """
+
+    if os.path.isdir(source):
+        structures = (load_structure(pdb_file, **parse_options)
+                      for pdb_file in iter_pdb_files(source, compressed=True))
+    else:
+        members = iter_archive(source)
+        if readahead > 0:
+            members = prefetch(members, readahead)
+        structures = (load_archived_structure(*x, **parse_options) for x in members)
+    if readahead <= 0:
+        for structure in structures:
+            yield structure
+    else:
+        for structure in prefetch(structures, readahead):
+            yield structure
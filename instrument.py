@@ -0,0 +1,213 @@
+"""
+Lightweight instrumentation of the analysis. While a Recorder is active (see
+recording) the analysis records the wall and CPU time spent in each of its
+stages and counts of the work it did. Outside of recording stage and count do
+nothing, so the analysis can call them unconditionally.
+"""
+
+import contextlib
+import os
+import sys
+import time
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The stages and counts recorded by the analysis module
+STAGES = ("parse", "dehydrons", "sites", "residues", "distances", "summarize")
+COUNTS = ("atoms", "dehydrons", "sites", "distance_evaluations")
+
+_recorder = None
+
+
+if hasattr(time, "process_time"):
+    cpu_time = time.process_time
+elif resource is not None:
+    def cpu_time():
+        """
+        The CPU time used by this process so far.
+        """
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+else:
+    def cpu_time():
+        """
+        The CPU time used by this process so far.
+        """
+
+        return sum(os.times()[:2])
+
+def _memory_status(field):
+    """
+    Read a memory size in kilobytes (such as VmRSS) from /proc/self/status.
+    Returns None where that isn't available.
+    """
+
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+def peak_memory():
+    """
+    The peak resident set size of this process in kilobytes, since it started
+    or since the last reset_peak_memory (None if it can't be measured on this
+    platform).
+    """
+
+    peak = _memory_status("VmHWM")
+    if peak is not None or resource is None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def current_memory():
+    """
+    The resident set size of this process in kilobytes (None if it can't be
+    measured on this platform).
+    """
+
+    return _memory_status("VmRSS")
+
+def reset_peak_memory():
+    """
+    Reset the peak resident set size reported by peak_memory to the current
+    size. This needs Linux; returns whether it worked.
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+class Recorder(object):
+    """
+    The stage times and counts of one run of the analysis.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss_kb = None
+        self.peak_growth_kb = None
+
+    def add_stage(self, name, wall, cpu):
+        totals = self.stages.setdefault(name, [0.0, 0.0])
+        totals[0] += wall
+        totals[1] += cpu
+
+    def add_count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def summary(self):
+        """
+        The recorded values as a dictionary of plain values (cheap to send
+        between processes): wall and cpu totals, a dictionary of [wall, cpu]
+        per stage, a dictionary of counts, the peak memory in kilobytes while
+        recording and how far that peak rose above the memory in use when
+        recording started (see recording).
+        """
+
+        return {"wall": self.wall, "cpu": self.cpu, "stages": self.stages, "counts": self.counts,
+                "peak_rss_kb": self.peak_rss_kb, "peak_growth_kb": self.peak_growth_kb}
+
+@contextlib.contextmanager
+def recording(recorder):
+    """
+    Record into recorder for the duration of the block. The total wall and CPU
+    time of the block is recorded too, along with its peak memory. Where the
+    peak can be reset (Linux) this is the peak during the block, so a worker
+    that runs many blocks reports the peak of each one; elsewhere it is the
+    peak of the whole process and the growth isn't known.
+    """
+
+    global _recorder
+    previous = _recorder
+    _recorder = recorder
+    start_rss = current_memory() if reset_peak_memory() else None
+    start_wall, start_cpu = timeit.default_timer(), cpu_time()
+    try:
+        yield recorder
+    finally:
+        recorder.wall += timeit.default_timer() - start_wall
+        recorder.cpu += cpu_time() - start_cpu
+        recorder.peak_rss_kb = peak_memory()
+        if start_rss is not None and recorder.peak_rss_kb is not None:
+            recorder.peak_growth_kb = recorder.peak_rss_kb - start_rss
+        _recorder = previous
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Record the time spent in the block as part of a stage.
+    """
+
+    recorder = _recorder
+    if recorder is None:
+        yield
+        return
+    start_wall, start_cpu = timeit.default_timer(), cpu_time()
+    try:
+        yield
+    finally:
+        recorder.add_stage(name, timeit.default_timer() - start_wall, cpu_time() - start_cpu)
+
+def count(name, value):
+    """
+    Add to one of the counts.
+    """
+
+    if _recorder is not None:
+        _recorder.add_count(name, value)
+
+def combine(summaries):
+    """
+    Add up the summaries of many runs (for instance from different worker
+    processes) into one. The peak memory and growth are the largest of any
+    run.
+    """
+
+    total = Recorder()
+    for summary in summaries:
+        total.wall += summary["wall"]
+        total.cpu += summary["cpu"]
+        for name, (wall, cpu) in summary["stages"].items():
+            total.add_stage(name, wall, cpu)
+        for name, value in summary["counts"].items():
+            total.add_count(name, value)
+        for name in ("peak_rss_kb", "peak_growth_kb"):
+            if summary.get(name) is not None:
+                setattr(total, name, max(getattr(total, name) or 0, summary[name]))
+    return total.summary()
+
+def format_summary(summary):
+    """
+    Format a summary as a table of the stages and counts.
+    """
+
+    lines = ["{:<12} {:>12} {:>12} {:>8}".format("stage", "wall (s)", "cpu (s)", "wall %")]
+    wall = summary["wall"] or 1.0
+    stages = sorted(summary["stages"].items(), key=lambda x: -x[1][0])
+    for name, (stage_wall, stage_cpu) in stages + [("total", (summary["wall"], summary["cpu"]))]:
+        lines.append("{:<12} {:>12.3f} {:>12.3f} {:>7.1f}%".format(name, stage_wall, stage_cpu,
+                                                                   100.0 * stage_wall / wall))
+    for name, value in sorted(summary["counts"].items()):
+        lines.append("{:<24} {:>12}".format(name, value))
+    if summary["peak_rss_kb"] is not None:
+        lines.append("{:<24} {:>12.1f}".format("peak memory (MB)", summary["peak_rss_kb"] / 1024.0))
+    if summary.get("peak_growth_kb") is not None:
+        lines.append("{:<24} {:>12.1f}".format("peak growth (MB)", summary["peak_growth_kb"] / 1024.0))
+    return "\n".join(lines)
@@ -0,0 +1,245 @@
+"""
+A persistent on-disk cache of parsed files. Parsing results are stored as a
+set of .npy arrays plus a small JSON file of metadata, keyed by the content
+hash of the source file, the kind of parse and a parser version tag. Loading a
+cached entry only has to read a few binary arrays, which is much faster than
+re-parsing the text.
+
+The cache is disabled unless it is configured (either with configure or the
+PDB_PARSE_CACHE / PDB_PARSE_CACHE_SIZE environment variables).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# Eviction makes room down to this fraction of the size limit, so a full cache
+# isn't scanned again on every store
+EVICT_TO = 0.9
+
+_cache = None
+_configured = False
+
+
+def native_strings(value):
+    """
+    JSON decodes strings as unicode on Python 2; convert them back to native
+    strings (recursively) so cached results look exactly like fresh ones.
+    """
+
+    if sys.version_info[0] < 3:
+        if isinstance(value, unicode):
+            return str(value)
+    if isinstance(value, list):
+        return [native_strings(x) for x in value]
+    if isinstance(value, dict):
+        return dict((native_strings(k), native_strings(v)) for k, v in value.items())
+    return value
+
+def write_json(file_name, value):
+    """
+    Atomically write a value as JSON.
+    """
+
+    directory = os.path.dirname(os.path.abspath(file_name))
+    handle, temp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(handle, "w") as temp_file:
+        json.dump(value, temp_file)
+    os.rename(temp_name, file_name)
+
+def file_hash(file_name):
+    """
+    Hash the contents of a file.
+    """
+
+    digest = hashlib.sha1()
+    with open(file_name, "rb") as source:
+        for block in iter(lambda: source.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ParseCache(object):
+    """
+    A directory of cached parse results. Each entry is a directory holding the
+    arrays of one parse result. Entries are evicted least recently used first
+    once the cache grows past max_bytes.
+
+    To avoid hashing a file on every lookup, the hash of each source path is
+    remembered along with its size and modification time and only recomputed
+    when those change.
+
+    The total size of the entries is found by scanning the cache once and then
+    kept up to date as entries are stored, so the cache is only scanned again
+    when it grows past max_bytes. Entries stored by other processes aren't
+    counted until that scan, so a cache shared between processes can overshoot
+    max_bytes by what they store in the meantime.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+        self.entry_directory = os.path.join(directory, "entries")
+        self.path_directory = os.path.join(directory, "paths")
+        for path in (self.entry_directory, self.path_directory):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    if not os.path.isdir(path):
+                        raise
+
+    def content_hash(self, file_name):
+        """
+        Get the content hash of a file, reusing the remembered hash if the
+        file's size and modification time haven't changed.
+        """
+
+        full_path = os.path.abspath(file_name)
+        stat = os.stat(full_path)
+        record_name = os.path.join(self.path_directory, hashlib.sha1(full_path.encode("utf-8")).hexdigest() + ".json")
+        try:
+            with open(record_name) as record_file:
+                record = json.load(record_file)
+            if record["path"] == full_path and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime:
+                return record["hash"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        content = file_hash(full_path)
+        write_json(record_name, {"path": full_path, "size": stat.st_size, "mtime": stat.st_mtime, "hash": content})
+        return content
+
+    def _entry_path(self, file_name, kind, version):
+        key = "{}-{}-v{}".format(self.content_hash(file_name), kind, version)
+        return os.path.join(self.entry_directory, key)
+
+    def load(self, file_name, kind, version):
+        """
+        Look up the cached result of parsing file_name. Returns a tuple of a
+        dictionary of arrays and the metadata, or None on a cache miss.
+        """
+
+        entry = self._entry_path(file_name, kind, version)
+        meta_name = os.path.join(entry, "meta.json")
+        try:
+            with open(meta_name) as meta_file:
+                meta = native_strings(json.load(meta_file))
+            arrays = dict((name, numpy.load(os.path.join(entry, name + ".npy"))) for name in meta["arrays"])
+            # Mark the entry as recently used
+            os.utime(meta_name, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        return arrays, meta["meta"]
+
+    def store(self, file_name, kind, version, arrays, meta):
+        """
+        Store the result of parsing file_name as a dictionary of arrays and some
+        JSON serializable metadata.
+        """
+
+        entry = self._entry_path(file_name, kind, version)
+        if os.path.isdir(entry):
+            return
+        temp_entry = tempfile.mkdtemp(dir=self.entry_directory, suffix=".tmp")
+        try:
+            for name, values in arrays.items():
+                numpy.save(os.path.join(temp_entry, name + ".npy"), numpy.asarray(values))
+            with open(os.path.join(temp_entry, "meta.json"), "w") as meta_file:
+                json.dump({"arrays": sorted(arrays), "meta": meta}, meta_file)
+            size = sum(os.path.getsize(os.path.join(temp_entry, x)) for x in os.listdir(temp_entry))
+            os.rename(temp_entry, entry)
+        except OSError:
+            # Most likely another process stored the same entry first
+            shutil.rmtree(temp_entry, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+            return
+
+        if self.total_bytes is not None:
+            self.total_bytes += size
+        if self.total_bytes is None or self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Scan the cache and, if it is over its size limit, remove the least
+        recently used entries until it is down to EVICT_TO of the limit.
+        """
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.entry_directory):
+            entry = os.path.join(self.entry_directory, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, x)) for x in os.listdir(entry))
+                last_used = os.path.getmtime(os.path.join(entry, "meta.json"))
+            except OSError:
+                continue
+            entries.append((last_used, size, entry))
+            total += size
+
+        if total <= self.max_bytes:
+            entries = []
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            logging.info("Evicting %s from the parse cache", entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self.total_bytes = total
+
+def configure(directory, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Set up the cache used by cached_parse. Passing a directory of None turns
+    caching off.
+    """
+
+    global _cache, _configured
+    _cache = ParseCache(directory, max_bytes) if directory is not None else None
+    _configured = True
+
+def get_cache():
+    """
+    Returns the configured cache (or None if caching is off). If configure has
+    not been called the cache is set up from the environment.
+    """
+
+    if not _configured:
+        configure(os.environ.get("PDB_PARSE_CACHE"),
+                  int(os.environ.get("PDB_PARSE_CACHE_SIZE", DEFAULT_MAX_BYTES)))
+    return _cache
+
+def cached_parse(file_name, kind, version, parse, to_arrays, from_arrays, store=True):
+    """
+    Parse a file through the cache. On a miss parse(file_name) is called and
+    its result stored using to_arrays(result), which should return a tuple of
+    a dictionary of arrays and JSON serializable metadata. On a hit the result
+    is rebuilt with from_arrays(arrays, meta).
+
+    Storing a result means converting all of it to arrays, so callers that
+    want to avoid that (such as lazy parses) can pass store=False to only
+    read from the cache.
+    """
+
+    cache = get_cache()
+    if cache is None:
+        return parse(file_name)
+
+    entry = cache.load(file_name, kind, version)
+    if entry is not None:
+        return from_arrays(*entry)
+
+    result = parse(file_name)
+    if not store:
+        return result
+    arrays, meta = to_arrays(result)
+    cache.store(file_name, kind, version, arrays, meta)
+    return result
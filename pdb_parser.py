@@ -2,11 +2,46 @@
 This file provides an easy interface for reading from PDB files.
 """
 
+import functools
+import gzip
+import hashlib
 import itertools
 import logging
 import math
+import mmap
 import os
+import re
 
+import numpy
+
+import instrument
+import parse_cache
+
+try:
+    from sys import intern
+except ImportError:
+    pass # Python 2 has intern as a builtin
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Bump this whenever the parsed data changes so stale cache entries are ignored
+PARSER_VERSION = 1
+
+
+def intern_name(value):
+    """
+    Intern a name (atom, residue or chain) so that every atom and compound
+    with the same name shares a single string. Anything other than a native
+    string is returned as it is.
+    """
+
+    return intern(value) if isinstance(value, str) else value
 
 def distance(position1, position2):
     """
@@ -52,24 +87,634 @@ def compound_id_to_float(compound_id):
     except ValueError:
         return float(int(compound_id[:-1])) + iCodeOrder(compound_id[-1]) / 12.0
 
+ATOM_COLUMNS = ("atom", "compound", "sequence_id", "insertion_code", "alt_id", "chain_id")
+
+def split_sequence_id(sequence_id):
+    """
+    Split a sequence ID (i.e. 100A) into the residue number and the insertion
+    code. Sequence IDs without an insertion code get an empty string.
+    """
+
+    if sequence_id and sequence_id[-1].isalpha():
+        return sequence_id[:-1], sequence_id[-1]
+    return sequence_id, ""
+
+def _code_dtype(category_count):
+    """
+    The smallest unsigned integer type that can index category_count categories.
+    """
+
+    return numpy.min_scalar_type(max(category_count - 1, 0))
+
+# How many appended atoms are buffered before they are encoded
+APPEND_CHUNK = 4096
+
+class AtomTable(object):
+    """
+    Structure-of-arrays storage for the atoms in a PDB file. Positions are kept
+    in an (N, 3) float array and each of the string fields (see ATOM_COLUMNS) is
+    stored as an array of small integer codes into a list of categories, so
+    every distinct atom name, residue name, chain, etc. is only stored once.
+
+    Atoms can be appended one at a time (they are buffered as rows, encoded
+    APPEND_CHUNK at a time and folded into the numpy columns the next time the
+    table is read) or added in bulk with extend. A table can also be set up
+    with defer so that each column is only decoded the first time it is used.
+    The decoded values AtomView reads are cached until atoms are added.
+    """
+
+    def __init__(self):
+        self._positions = numpy.empty((0, 3))
+        self._codes = dict((name, numpy.empty(0, dtype=numpy.uint8)) for name in ATOM_COLUMNS)
+        self._lookup = dict((name, {}) for name in ATOM_COLUMNS)
+        self.categories = dict((name, []) for name in ATOM_COLUMNS)
+        self._pending = []
+        self._chunks = []
+        self._chunk_count = 0
+        # Bumped whenever atoms are added so derived data can be invalidated
+        self.version = 0
+        self._deferred = {}
+        self._deferred_count = 0
+        self._decoded = {}
+
+    def __len__(self):
+        if self._deferred:
+            return self._deferred_count
+        return len(self._positions) + self._chunk_count + len(self._pending)
+
+    def defer(self, count, load_positions, load_columns):
+        """
+        Fill an empty table with count atoms whose data is only decoded when it
+        is first used. load_positions should return the (N, 3) positions and
+        load_columns maps every column name to a function returning a (codes,
+        categories) pair.
+        """
+
+        if len(self):
+            raise ValueError("Only an empty AtomTable can be deferred")
+        self.version += 1
+        self._decoded = {}
+        self._deferred = dict(load_columns)
+        self._deferred["positions"] = load_positions
+        self._deferred_count = count
+
+    def _load(self, name):
+        """
+        Decode a deferred column (or the positions) if it hasn't been yet.
+        """
+
+        loader = self._deferred.pop(name, None)
+        if loader is None:
+            return
+        if name == "positions":
+            self._positions = numpy.asarray(loader(), dtype=numpy.float64).reshape(-1, 3)
+        else:
+            codes, categories = loader()
+            self._codes[name] = self._merge_codes(name, self._codes[name], codes, categories)
+
+    def _load_all(self):
+        for name in list(self._deferred):
+            self._load(name)
+
+    def _merge_codes(self, name, existing, codes, categories):
+        """
+        Append codes from another set of categories to the codes of a column.
+        """
+
+        mapping = numpy.array([self._code(name, x) for x in categories], dtype=numpy.int64)
+        new_codes = mapping[numpy.asarray(codes, dtype=numpy.int64)] if len(mapping) else numpy.empty(0, dtype=numpy.int64)
+        return numpy.concatenate((existing, new_codes)).astype(_code_dtype(len(self.categories[name])))
+
+    def _code(self, name, value):
+        """
+        Get the code for a value in a column, registering a new category if
+        this value has not been seen before.
+        """
+
+        lookup = self._lookup[name]
+        code = lookup.get(value)
+        if code is None:
+            code = lookup[value] = len(self.categories[name])
+            self.categories[name].append(intern_name(value))
+        return code
+
+    def append(self, position, atom, compound, sequence_id, insertion_code, alt_id, chain_id):
+        """
+        Add a single atom to the table.
+        """
+
+        self.version += 1
+        if self._deferred:
+            self._load_all()
+        if self._decoded:
+            self._decoded = {}
+        pending = self._pending
+        pending.append((position, atom, compound, sequence_id, insertion_code, alt_id, chain_id))
+        if len(pending) >= APPEND_CHUNK:
+            self._encode_pending()
+
+    def append_rows(self, rows):
+        """
+        Add a list of atoms, each a tuple of the arguments to append.
+        """
+
+        self.version += 1
+        if self._deferred:
+            self._load_all()
+        self._decoded = {}
+        self._encode_pending()
+        self._pending = rows
+        self._encode_pending()
+
+    def _encode_pending(self):
+        """
+        Encode the rows added with append into a chunk of arrays.
+        """
+
+        if not self._pending:
+            return
+        count = len(self._pending)
+        rows = list(zip(*self._pending))
+        codes = {}
+        for name, values in zip(ATOM_COLUMNS, rows[1:]):
+            lookup = self._lookup[name]
+            # Register new values in the order they first appear
+            for value in dict.fromkeys(values):
+                if value not in lookup:
+                    self._code(name, value)
+            codes[name] = numpy.fromiter(map(lookup.__getitem__, values), numpy.int64, count)
+        positions = numpy.fromiter(itertools.chain.from_iterable(rows[0]), numpy.float64, 3 * count)
+        self._chunks.append((positions.reshape(-1, 3), codes))
+        self._chunk_count += count
+        self._pending = []
+
+    def extend(self, positions, columns):
+        """
+        Add a block of atoms at once. Positions should be an (N, 3) array and
+        columns a dictionary mapping every column name to a (codes, categories)
+        pair.
+        """
+
+        self.version += 1
+        self._decoded = {}
+        self._load_all()
+        self._flush()
+        self._positions = numpy.concatenate((self._positions, numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)))
+        for name in ATOM_COLUMNS:
+            codes, categories = columns[name]
+            self._codes[name] = self._merge_codes(name, self._codes[name], codes, categories)
+
+    def _flush(self):
+        """
+        Fold any atoms added with append into the numpy columns. All of the
+        chunks are joined onto the columns at once.
+        """
+
+        self._encode_pending()
+        if not self._chunks:
+            return
+        self._positions = numpy.concatenate([self._positions] + [x[0] for x in self._chunks])
+        for name in ATOM_COLUMNS:
+            dtype = _code_dtype(len(self.categories[name]))
+            self._codes[name] = numpy.concatenate([self._codes[name]] +
+                                                  [x[1][name] for x in self._chunks]).astype(dtype)
+        self._chunks = []
+        self._chunk_count = 0
+
+    @property
+    def positions(self):
+        """
+        An (N, 3) array of all atom positions.
+        """
+
+        self._load("positions")
+        self._flush()
+        return self._positions
+
+    def codes(self, name):
+        """
+        The array of category codes for a column.
+        """
+
+        self._load(name)
+        self._flush()
+        return self._codes[name]
+
+    def value(self, name, index):
+        """
+        Get the value of a column for a single atom.
+        """
+
+        return self.decoded(name)[index]
+
+    def decoded(self, name):
+        """
+        A list of the values of a column (or "positions", as tuples) for every
+        atom. The list is cached until atoms are added, so it must not be
+        modified.
+        """
+
+        values = self._decoded.get(name)
+        if values is None:
+            if name == "positions":
+                values = [tuple(x) for x in self.positions.tolist()]
+            else:
+                values = self.values(name)
+            self._decoded[name] = values
+        return values
+
+    def values(self, name, indices=None):
+        """
+        Decode a column (optionally restricted to some atom indices) into a list.
+        """
+
+        codes = self.codes(name)
+        if indices is not None:
+            codes = codes[indices]
+        categories = self.categories[name]
+        return [categories[x] for x in codes.tolist()]
+
+    def mask(self, name, values):
+        """
+        Returns a boolean array that is true for every atom whose value in the
+        given column is in values. The membership test is done once per category
+        rather than once per atom.
+        """
+
+        codes = self.codes(name)
+        selected = numpy.array([x in values for x in self.categories[name]], dtype=bool)
+        if not len(selected):
+            return numpy.zeros(len(self), dtype=bool)
+        return selected[codes]
+
+def _column_property(name):
+    """
+    Build a read only property that looks up a column of an atom in its table.
+    """
+
+    def getter(self):
+        try:
+            return self.table._decoded[name][self.index]
+        except KeyError:
+            return self.table.decoded(name)[self.index]
+    return property(getter)
+
+class AtomView(object):
+    """
+    A lightweight view of a single atom stored in an AtomTable. It exposes the
+    same attributes as PDBAtom.
+    """
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    position = _column_property("positions")
+
+    atom = _column_property("atom")
+    compound = _column_property("compound")
+    sequence_id = _column_property("sequence_id")
+    insertion_code = _column_property("insertion_code")
+    alt_id = _column_property("alt_id")
+    chain_id = _column_property("chain_id")
+
+    def __eq__(self, other):
+        return isinstance(other, AtomView) and self.table is other.table and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.table), self.index))
+
+    def __str__(self):
+        return "{} in compound {} at position {} (Sequence ID: {}, Chain ID: {})".format(self.atom, self.compound, self.position, self.sequence_id, self.chain_id)
+
+    def __repr__(self):
+        return "{} in compound {} at position {} (Sequence ID: {}, Chain ID: {})".format(self.atom, self.compound, self.position, self.sequence_id, self.chain_id)
+
+class AtomSelection(object):
+    """
+    A list-like view of a subset of the atoms in an AtomTable. Iterating over
+    it yields AtomView objects.
+    """
+
+    __slots__ = ("table", "indices")
+
+    def __init__(self, table, indices):
+        self.table = table
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        table = self.table
+        for index in self.indices.tolist():
+            yield AtomView(table, index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return AtomSelection(self.table, self.indices[key])
+        return AtomView(self.table, int(self.indices[key]))
+
+    @property
+    def positions(self):
+        """
+        An (N, 3) array of the positions of the selected atoms.
+        """
+
+        return self.table.positions[self.indices]
+
+    def __repr__(self):
+        return repr(list(self))
+
+def _residue_key(sequence_id):
+    """
+    Normalize a sequence ID (including insertion code) so that equivalent IDs
+    compare equal. IDs that can't be converted are kept as they are.
+    """
+
+    try:
+        return compound_id_to_float(sequence_id)
+    except (ValueError, TypeError):
+        return sequence_id
+
+def _sequence_number(sequence_id):
+    """
+    The sequence ID as an integer, or NaN if it isn't one (for instance if it
+    has an insertion code).
+    """
+
+    try:
+        return int(sequence_id)
+    except ValueError:
+        return float("nan")
+
+class ResidueIndex(object):
+    """
+    An index over the residues of an AtomTable. A residue is a run of
+    consecutive atoms sharing a chain and sequence ID. The index records the
+    atom range of every residue along with lookups by (chain ID, sequence ID),
+    by residue name and by position along each chain, the boundaries between
+    runs of residues on the same chain and which neighbouring residues are
+    adjacent (see adjacent_pairs).
+    """
+
+    def __init__(self, table):
+        self.version = table.version
+        self.atom_indices = numpy.arange(len(table))
+
+        chains = table.codes("chain_id")
+        sequences = table.codes("sequence_id")
+        breaks = numpy.flatnonzero((chains[1:] != chains[:-1]) | (sequences[1:] != sequences[:-1])) + 1
+        if len(table):
+            self.starts = numpy.concatenate(([0], breaks))
+            self.stops = numpy.concatenate((breaks, [len(table)]))
+        else:
+            self.starts = self.stops = breaks
+
+        residue_chains = chains[self.starts]
+        self.chain_breaks = numpy.flatnonzero(residue_chains[1:] != residue_chains[:-1]) + 1
+        self._adjacent_pairs = None
+
+        self.chain_ids = table.values("chain_id", self.starts)
+        self.sequence_ids = table.values("sequence_id", self.starts)
+        self.names = table.values("compound", self.starts)
+
+        self.by_id = {}
+        self.by_name = {}
+        chain_residues = {}
+        for residue, (chain_id, sequence_id, name) in enumerate(zip(self.chain_ids, self.sequence_ids, self.names)):
+            self.by_id.setdefault((chain_id, _residue_key(sequence_id)), []).append(residue)
+            self.by_name.setdefault(name, []).append(residue)
+            chain_residues.setdefault(chain_id, []).append(residue)
+
+        # For range queries keep every chain's residues sorted by sequence ID
+        self.by_chain = {}
+        for chain_id, residues in chain_residues.items():
+            keys = numpy.array([_residue_key(self.sequence_ids[x]) for x in residues], dtype=object)
+            numeric = numpy.array([isinstance(x, float) for x in keys], dtype=bool)
+            keys = keys[numeric].astype(numpy.float64)
+            residues = numpy.array(residues)[numeric]
+            order = numpy.argsort(keys, kind="mergesort")
+            self.by_chain[chain_id] = (keys[order], residues[order])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def atoms(self, residue):
+        """
+        The indices of the atoms in a residue.
+        """
+
+        return self.atom_indices[self.starts[residue]:self.stops[residue]]
+
+    def find(self, sequence_id, chain_id):
+        """
+        Returns the residues with a given sequence ID on a chain.
+        """
+
+        return self.by_id.get((chain_id, _residue_key(sequence_id)), [])
+
+    def with_names(self, names):
+        """
+        Returns the residues (in order) whose name is in names.
+        """
+
+        matches = [residues for name, residues in self.by_name.items() if name in names]
+        return sorted(itertools.chain.from_iterable(matches))
+
+    def counts(self, names):
+        """
+        Returns a dictionary of the number of residues with each name in names.
+        """
+
+        return dict((name, len(self.by_name.get(name, []))) for name in names)
+
+    def adjacent_pairs(self):
+        """
+        Returns an (N, 2) array of the neighbouring residues that are adjacent:
+        on the same chain with consecutive sequence IDs. A residue with an
+        insertion code (or any other ID that isn't a plain integer) is assumed
+        to be adjacent to both of its neighbours. Computed on first use.
+        """
+
+        if self._adjacent_pairs is None:
+            numbers = numpy.array([_sequence_number(x) for x in self.sequence_ids], dtype=numpy.float64)
+            first = numpy.arange(max(len(self) - 1, 0))
+            same_chain = numpy.ones(len(first), dtype=bool)
+            same_chain[self.chain_breaks - 1] = False
+            with numpy.errstate(invalid="ignore"):
+                consecutive = (numbers[first] + 1 == numbers[first + 1]) | numpy.isnan(numbers[first]) | \
+                              numpy.isnan(numbers[first + 1])
+            first = first[same_chain & consecutive]
+            self._adjacent_pairs = numpy.column_stack((first, first + 1))
+        return self._adjacent_pairs
+
+    def in_range(self, chain_id, start_id, end_id):
+        """
+        Returns the residues (in order) on a chain whose sequence ID falls
+        between start_id and end_id inclusive.
+        """
+
+        if chain_id not in self.by_chain:
+            return []
+        keys, residues = self.by_chain[chain_id]
+        low = numpy.searchsorted(keys, compound_id_to_float(start_id), side="left")
+        high = numpy.searchsorted(keys, compound_id_to_float(end_id), side="right")
+        return sorted(residues[low:high].tolist())
+
+# Secondary structure classes (H and S as in WRAPPA's output)
+HELIX = "H"
+SHEET = "S"
+COIL = "C"
+
+def _merge_intervals(spans):
+    """
+    Merge overlapping (start, end) spans, returning sorted arrays of the
+    starts and ends of the disjoint intervals left.
+    """
+
+    starts = []
+    ends = []
+    for start, end in sorted((min(x), max(x)) for x in spans):
+        if starts and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return numpy.array(starts, dtype=numpy.float64), numpy.array(ends, dtype=numpy.float64)
+
+class SecondaryStructureIndex(object):
+    """
+    An interval index over the HELIX and SHEET ranges of a structure. Sequence
+    IDs are ordered by compound_id_to_float, so residues with insertion codes
+    fall between their neighbours (see iCodeOrder). For every chain the ranges
+    of each class are merged into sorted, disjoint intervals, so looking up a
+    residue is a binary search. Where a helix and a sheet overlap the residue
+    counts as helix.
+    """
+
+    def __init__(self, helixes, sheets):
+        self.intervals = {}
+        for ss_class, ranges in ((HELIX, helixes), (SHEET, sheets)):
+            spans = {}
+            for chain_id, start_id, end_id in ranges:
+                try:
+                    span = (compound_id_to_float(start_id), compound_id_to_float(end_id))
+                except ValueError:
+                    logging.warning("Ignoring secondary structure range %s-%s on chain %s", start_id, end_id,
+                                    chain_id)
+                    continue
+                spans.setdefault(chain_id, []).append(span)
+            for chain_id, chain_spans in spans.items():
+                self.intervals[(chain_id, ss_class)] = _merge_intervals(chain_spans)
+
+    def classify_keys(self, chain_id, keys):
+        """
+        Returns an array with the class (HELIX, SHEET or COIL) of each of the
+        residues on a chain with the given sequence ID keys (as returned by
+        compound_id_to_float).
+        """
+
+        keys = numpy.asarray(keys, dtype=numpy.float64)
+        classes = numpy.array([COIL] * len(keys), dtype="S1" if str is bytes else "U1")
+        for ss_class in (SHEET, HELIX):
+            if (chain_id, ss_class) not in self.intervals:
+                continue
+            starts, ends = self.intervals[(chain_id, ss_class)]
+            interval = numpy.searchsorted(starts, keys, side="right") - 1
+            inside = (interval >= 0) & (keys <= ends[numpy.maximum(interval, 0)])
+            classes[inside] = ss_class
+        return classes
+
+    def classify(self, sequence_id, chain_id):
+        """
+        Returns the class of the residue with a given sequence ID on a chain.
+        """
+
+        key = _residue_key(sequence_id)
+        if not isinstance(key, float):
+            return COIL
+        return str(self.classify_keys(chain_id, [key])[0])
+
+    def annotate(self, residue_index):
+        """
+        Returns an array with the class of every residue in a ResidueIndex,
+        classifying each chain's residues in a single pass.
+        """
+
+        classes = numpy.array([COIL] * len(residue_index), dtype="S1" if str is bytes else "U1")
+        for chain_id, (keys, residues) in residue_index.by_chain.items():
+            classes[residues] = self.classify_keys(chain_id, keys)
+        return classes
+
 class PDBData(object):
     """
     This is the container for all data pertaining to a PDB file. At it's core
     it is nothing other than a collection of atoms and secondary structure.
     However, this includes logic to do useful things with these atoms.
+
+    The atoms themselves are stored column-wise in an AtomTable; the atoms
+    handed out by this class are lightweight views into that table.
     """
 
     def __init__(self):
-        self.atoms = []
-        self.helixes = []
-        self.sheets = []
+        self.atom_table = AtomTable()
+        self._helixes = []
+        self._sheets = []
+        self._residue_index = None
+        self._secondary_structure = None
+        self._compounds = None
+
+    @property
+    def helixes(self):
+        """
+        The (chain_id, start_id, end_id) of every alpha helix. Use add_helix
+        (or assign a new list) rather than editing the list in place, so the
+        secondary structure index is rebuilt.
+        """
+
+        return self._helixes
+
+    @helixes.setter
+    def helixes(self, helixes):
+        self._helixes = helixes
+        self._secondary_structure = None
+
+    @property
+    def sheets(self):
+        """
+        The (chain_id, start_id, end_id) of every beta sheet. As with helixes,
+        use add_sheet rather than editing the list in place.
+        """
+
+        return self._sheets
+
+    @sheets.setter
+    def sheets(self, sheets):
+        self._sheets = sheets
+        self._secondary_structure = None
+
+    @property
+    def atoms(self):
+        """
+        All of the atoms in this data.
+        """
+
+        return AtomSelection(self.atom_table, numpy.arange(len(self.atom_table)))
 
     def add_atom(self, atom):
         """
         Add an atom to this set of data.
         """
 
-        self.atoms.append(atom)
+        insertion_code = getattr(atom, "insertion_code", "") or split_sequence_id(atom.sequence_id)[1]
+        self.atom_table.append(atom.position, atom.atom, atom.compound, atom.sequence_id,
+                               insertion_code, atom.alt_id, atom.chain_id)
 
     def add_helix(self, chain_id, start_id, end_id):
         """
@@ -77,14 +722,16 @@ class PDBData(object):
         should be in the form of a string and include insertion codes
         """
 
-        self.helixes.append((chain_id, start_id, end_id))
+        self._helixes.append((chain_id, start_id, end_id))
+        self._secondary_structure = None
 
     def add_sheet(self, chain_id, start_id, end_id):
         """
         Register a beta sheet with this data.
         """
 
-        self.sheets.append((chain_id, start_id, end_id))
+        self._sheets.append((chain_id, start_id, end_id))
+        self._secondary_structure = None
 
     def get_atoms(self, atom_names=None, in_residue=None):
         """
@@ -92,12 +739,13 @@ class PDBData(object):
         are membership in a list of atoms or membership in a specific residue.
         """
 
-        result = self.atoms
+        table = self.atom_table
+        mask = numpy.ones(len(table), dtype=bool)
         if atom_names is not None:
-            result = [x for x in result if x.atom in atom_names]
+            mask &= table.mask("atom", atom_names)
         if in_residue is not None:
-            result = [x for x in result if x.compound in in_residue]
-        return result
+            mask &= table.mask("compound", in_residue)
+        return AtomSelection(table, numpy.flatnonzero(mask))
 
     def get_phoso_sites(self):
         """
@@ -108,29 +756,80 @@ class PDBData(object):
         return [x for x in self.get_compounds() if x.name in ("PTR")]
 
 
+    def get_residue_index(self):
+        """
+        Returns the ResidueIndex for this data. It is built on first use and
+        rebuilt whenever atoms have been added since.
+        """
+
+        if self._residue_index is None or self._residue_index.version != self.atom_table.version:
+            self._residue_index = ResidueIndex(self.atom_table)
+        return self._residue_index
+
+    def get_secondary_structure_index(self):
+        """
+        Returns the SecondaryStructureIndex over the helixes and sheets of this
+        data. It is built on first use and dropped whenever a helix or sheet is
+        added (or either list is replaced).
+        """
+
+        if self._secondary_structure is None:
+            self._secondary_structure = SecondaryStructureIndex(self._helixes, self._sheets)
+        return self._secondary_structure
+
+    def get_secondary_structure(self):
+        """
+        Returns an array with the secondary structure class (HELIX, SHEET or
+        COIL) of every residue, in the order get_compounds returns them.
+        """
+
+        return self.get_secondary_structure_index().annotate(self.get_residue_index())
+
+    def get_residue_secondary_structure(self, residue_id, chain_id):
+        """
+        Returns the secondary structure class of the residue with a given ID.
+        """
+
+        return self.get_secondary_structure_index().classify(residue_id, chain_id)
+
+    def _make_compound(self, index, residue):
+        """
+        Get the PDBCompound for a residue in the index. Compounds are built on
+        first use and then shared by every call until the index is rebuilt.
+        """
+
+        if self._compounds is None or self._compounds[0] is not index:
+            self._compounds = (index, [None] * len(index))
+        compounds = self._compounds[1]
+        compound = compounds[residue]
+        if compound is None:
+            compound = compounds[residue] = PDBCompound(index.sequence_ids[residue],
+                                                        AtomSelection(self.atom_table, index.atoms(residue)),
+                                                        index.chain_ids[residue], index.names[residue])
+        return compound
+
     def get_residue_by_id(self, residue_id, chain_id):
         """
         Get's a residue with a specific ID.
         """
 
-
-        return PDBCompound(residue_id, [x for x in self.atoms if
-                                        compound_id_to_float(x.sequence_id) == compound_id_to_float(residue_id) and
-                                        chain_id == x.chain_id])
+        index = self.get_residue_index()
+        residues = index.find(residue_id, chain_id)
+        if len(residues) == 1:
+            atoms = index.atoms(residues[0])
+        else:
+            atoms = numpy.concatenate([index.atoms(x) for x in residues] or [numpy.empty(0, dtype=int)])
+        return PDBCompound(residue_id, AtomSelection(self.atom_table, atoms))
 
     def get_compounds(self, names=None):
         """
-        Breaks up the atoms into sets of compounds.
+        Breaks up the atoms into sets of compounds. The compounds are shared
+        between calls (see _make_compound); only the list is new.
         """
 
-        compounds = []
-        for _, atoms in itertools.groupby(self.atoms, lambda x: x.chain_id):
-            for sequence_id, compound in itertools.groupby(atoms, lambda x: x.sequence_id):
-                compounds.append(PDBCompound(sequence_id, list(compound)))
-        if names == None:
-            return compounds
-        else:
-            return [x for x in compounds if x.name in names]
+        index = self.get_residue_index()
+        residues = range(len(index)) if names is None else index.with_names(names)
+        return [self._make_compound(index, x) for x in residues]
 
     def get_adjacent_compounds(self):
         """
@@ -149,35 +848,34 @@ class PDBData(object):
         """
 
 
-        all_pairs = []
-        for _, chain in itertools.groupby(self.get_compounds(), lambda x: x.chain_id):
-            last_compound = None
-            for compound in chain:
-                if last_compound is not None:
-                    try:
-                        if int(last_compound.compound_id) + 1 == int(compound.compound_id):
-                            all_pairs.append((last_compound, compound))
-                    except ValueError: # We assume that insertion codes mean that they are adjacent
-                        all_pairs.append((last_compound, compound))
-                last_compound = compound
-        return all_pairs
+        index = self.get_residue_index()
+        return [(self._make_compound(index, x), self._make_compound(index, y))
+                for x, y in index.adjacent_pairs().tolist()]
+
+    def count_compounds(self, names):
+        """
+        Returns a dictionary of the number of compounds with each name in names.
+        """
+
+        return self.get_residue_index().counts(names)
 
     def get_helixes(self):
         """
         Returns a list of lists each of which represents an alpah helix.
         """
 
-        compounds = self.get_compounds()
-        result = []
-        for chain_id, start, end in self.helixes:
-            helix = []
-            for compound in compounds:
-                if (compound.chain_id == chain_id and
-                    compound_id_to_float(compound.compound_id) >= compound_id_to_float(start) and
-                    compound_id_to_float(compound.compound_id) <= compound_id_to_float(end)):
-                    helix.append(compound)
-            result.append(helix)
-        return result
+        index = self.get_residue_index()
+        return [[self._make_compound(index, x) for x in index.in_range(chain_id, start, end)]
+                for chain_id, start, end in self.helixes]
+
+    def get_sheets(self):
+        """
+        Returns a list of lists each of which represents a beta sheet strand.
+        """
+
+        index = self.get_residue_index()
+        return [[self._make_compound(index, x) for x in index.in_range(chain_id, start, end)]
+                for chain_id, start, end in self.sheets]
 
 class PDBCompound(object):
     """
@@ -185,13 +883,15 @@ class PDBCompound(object):
     group but could possibly be something else.
     """
 
-    def __init__(self, compound_id, atoms):
+    __slots__ = ("compound_id", "atoms", "chain_id", "name")
+
+    def __init__(self, compound_id, atoms, chain_id=None, name=None):
         self.compound_id = compound_id
         self.atoms = atoms
-        # Copy some data off of the first atom (assumed to be true for the rest
-        # of the atoms)
-        self.chain_id = atoms[0].chain_id
-        self.name = atoms[0].compound
+        # Unless they are given copy some data off of the first atom (assumed
+        # to be true for the rest of the atoms)
+        self.chain_id = intern_name(atoms[0].chain_id if chain_id is None else chain_id)
+        self.name = intern_name(atoms[0].compound if name is None else name)
 
     def get_atom(self, atom_name):
         """
@@ -215,13 +915,17 @@ class PDBAtom(object):
     Represents a single atom in a PDB file.
     """
 
-    def __init__(self):
-        self.position = (0, 0, 0)
-        self.compound = None
-        self.atom = None
-        self.sequence_id = None
-        self.alt_id = None
-        self.chain_id = 0
+    __slots__ = ("position", "compound", "atom", "sequence_id", "insertion_code", "alt_id", "chain_id")
+
+    def __init__(self, position=(0, 0, 0), compound=None, atom=None, sequence_id=None, insertion_code="",
+                 alt_id=None, chain_id=0):
+        self.position = position
+        self.compound = intern_name(compound)
+        self.atom = intern_name(atom)
+        self.sequence_id = sequence_id
+        self.insertion_code = insertion_code
+        self.alt_id = alt_id
+        self.chain_id = intern_name(chain_id)
 
     def __str__(self):
         return "{} in compound {} at position {} (Sequence ID: {}, Chain ID: {})".format(self.atom, self.compound, self.position, self.sequence_id, self.chain_id)
@@ -231,32 +935,388 @@ class PDBAtom(object):
 
 
 
+def _expand_ranges(starts, counts):
+    """
+    Concatenate the ranges start:start + count into one index array.
+    """
+
+    offsets = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts)
+    return numpy.arange(counts.sum()) + offsets
+
+class CellList(object):
+    """
+    A uniform grid spatial index over a set of points. Every point is binned
+    into a cubic cell of side cell_size, so all of the points within a radius
+    of a query can be found by only looking at the surrounding cells. Queries
+    are answered for many points at once. The number of candidate pairs whose
+    distances the queries have checked is kept in evaluations.
+    """
+
+    def __init__(self, positions, cell_size):
+        self.positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+        self.cell_size = float(cell_size)
+        self.evaluations = 0
+        if len(self.positions):
+            self.origin = self.positions.min(axis=0)
+            self.shape = numpy.floor((self.positions.max(axis=0) - self.origin) / self.cell_size).astype(numpy.int64) + 1
+        else:
+            self.origin = numpy.zeros(3)
+            self.shape = numpy.ones(3, dtype=numpy.int64)
+
+        keys = self._keys(self._cells(self.positions))
+        self.order = numpy.argsort(keys, kind="mergesort")
+        self.cell_keys, self.cell_starts, self.cell_counts = numpy.unique(keys[self.order], return_index=True,
+                                                                         return_counts=True)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _cells(self, points):
+        return numpy.floor((points - self.origin) / self.cell_size).astype(numpy.int64)
+
+    def _keys(self, cells):
+        return (cells[:, 0] * self.shape[1] + cells[:, 1]) * self.shape[2] + cells[:, 2]
+
+    def offset_count(self, radius):
+        """
+        The number of cells around each query a search within radius looks at.
+        """
+
+        return (2 * int(math.ceil(radius / self.cell_size)) + 1) ** 3
+
+    def query_radius(self, points, radius):
+        """
+        Find every (query, point) pair that is within radius of each other.
+        Returns two index arrays, sorted by query and then point.
+        """
+
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+        empty = numpy.empty(0, dtype=numpy.int64)
+        if not len(points) or not len(self.positions):
+            return empty, empty
+
+        if self.offset_count(radius) >= len(self.positions):
+            # Each cell looked at costs a pass over the queries, so past this
+            # it is cheaper to compare every query against every point
+            found_queries = [numpy.repeat(numpy.arange(len(points)), len(self.positions))]
+            found_points = [numpy.tile(numpy.arange(len(self.positions)), len(points))]
+            offsets = []
+        else:
+            reach = int(math.ceil(radius / self.cell_size))
+            steps = numpy.arange(-reach, reach + 1)
+            offsets = numpy.stack(numpy.meshgrid(steps, steps, steps, indexing="ij"), axis=-1).reshape(-1, 3)
+            found_queries, found_points = [empty], [empty]
+            query_cells = self._cells(points)
+        for offset in offsets:
+            cells = query_cells + offset
+            inside = numpy.flatnonzero(((cells >= 0) & (cells < self.shape)).all(axis=1))
+            keys = self._keys(cells[inside])
+            slots = numpy.minimum(numpy.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+            occupied = self.cell_keys[slots] == keys
+            slots = slots[occupied]
+            counts = self.cell_counts[slots]
+            found_queries.append(numpy.repeat(inside[occupied], counts))
+            found_points.append(self.order[_expand_ranges(self.cell_starts[slots], counts)])
+
+        queries = numpy.concatenate(found_queries)
+        neighbors = numpy.concatenate(found_points)
+        self.evaluations += len(queries)
+        delta = points[queries] - self.positions[neighbors]
+        close = numpy.einsum("ij,ij->i", delta, delta) <= radius * radius
+        queries, neighbors = queries[close], neighbors[close]
+        order = numpy.lexsort((neighbors, queries))
+        return queries[order], neighbors[order]
+
+def find_points_near_bonds(bond_positions, points, cutoff):
+    """
+    Find every (bond, point) pair where the point is within cutoff of both
+    ends of the bond. bond_positions should be a (B, 2, 3) array holding the
+    positions of the two ends of each bond. Returns two index arrays sorted by
+    bond and then point.
+    """
+
+    bond_positions = numpy.asarray(bond_positions, dtype=numpy.float64).reshape(-1, 2, 3)
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    cells = CellList(points, cutoff)
+    bonds, near = cells.query_radius(bond_positions[:, 0], cutoff)
+    instrument.count("distance_evaluations", cells.evaluations + len(bonds))
+    delta = bond_positions[bonds, 1] - points[near]
+    close = numpy.einsum("ij,ij->i", delta, delta) <= cutoff * cutoff
+    return bonds[close], near[close]
+
+def _mean_end_distances(bond_positions, points, bonds, queries):
+    """
+    The mean distance from each of the given points to both ends of the
+    matching bond.
+    """
+
+    return (numpy.linalg.norm(bond_positions[bonds, 0] - points[queries], axis=1) +
+            numpy.linalg.norm(bond_positions[bonds, 1] - points[queries], axis=1)) / 2.0
+
+def nearest_bond_distances(bond_positions, points, cell_size=6.5):
+    """
+    For each point find the bond minimizing the mean distance from the point to
+    the two ends of the bond. Returns arrays of that distance and the bond
+    index (inf and -1 if there are no bonds).
+
+    The mean distance to the ends is never less than the distance to the bond's
+    midpoint, so the midpoints are indexed and searched with a growing radius;
+    once the best bond found is within the searched radius no bond outside it
+    can be closer.
+    """
+
+    bond_positions = numpy.asarray(bond_positions, dtype=numpy.float64).reshape(-1, 2, 3)
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    best = numpy.full(len(points), numpy.inf)
+    best_bond = numpy.full(len(points), -1, dtype=numpy.int64)
+    if not len(bond_positions):
+        return best, best_bond
+
+    midpoints = bond_positions.mean(axis=1)
+    index = CellList(midpoints, cell_size)
+    remaining = numpy.arange(len(points))
+    radius = cell_size
+    while len(remaining):
+        if index.offset_count(radius) >= len(midpoints):
+            # The search would look at more cells than there are bonds, so
+            # just compare against every bond; that finds the best one
+            queries = numpy.repeat(numpy.arange(len(remaining)), len(midpoints))
+            bonds = numpy.tile(numpy.arange(len(midpoints)), len(remaining))
+            radius = numpy.inf
+        else:
+            queries, bonds = index.query_radius(points[remaining], radius)
+        scores = _mean_end_distances(bond_positions, points[remaining], bonds, queries)
+        order = numpy.lexsort((scores, queries))
+        queries, bonds, scores = queries[order], bonds[order], scores[order]
+        first = numpy.flatnonzero(numpy.concatenate(([True], queries[1:] != queries[:-1]))) if len(queries) else queries
+        done = scores[first] <= radius
+        best[remaining[queries[first[done]]]] = scores[first[done]]
+        best_bond[remaining[queries[first[done]]]] = bonds[first[done]]
+        resolved = numpy.zeros(len(remaining), dtype=bool)
+        resolved[queries[first[done]]] = True
+        remaining = remaining[~resolved]
+        radius *= 2
+    return best, best_bond
+
+# The kinds of records the parsers know how to load
+RECORD_TYPES = ("ATOM", "HETATM", "HELIX", "SHEET")
+
+def element_from_name(name):
+    """
+    Guess the element of an atom from its name, for records that leave the
+    element column blank.
+    """
+
+    return name.strip().lstrip("0123456789")[:1]
+
+class ParseFilter(object):
+    """
+    Describes which parts of a PDB file should be loaded. atom_names,
+    residue_names, chains and elements are collections of the allowed values
+    (None allows anything), skip_hydrogens drops hydrogen and deuterium atoms
+    and records lists which of RECORD_TYPES are loaded.
+    """
+
+    HYDROGENS = ("H", "D")
+
+    def __init__(self, atom_names=None, residue_names=None, chains=None, elements=None,
+                 skip_hydrogens=False, records=RECORD_TYPES):
+        self.atom_names = atom_names
+        self.residue_names = residue_names
+        self.chains = chains
+        self.elements = elements
+        self.skip_hydrogens = skip_hydrogens
+        self.records = records
+
+    def _settings(self):
+        return (self.atom_names, self.residue_names, self.chains, self.elements, self.skip_hydrogens,
+                tuple(x for x in RECORD_TYPES if x in self.records))
+
+    def is_default(self):
+        """
+        Whether this filter lets everything through.
+        """
+
+        return self._settings() == ParseFilter()._settings()
+
+    def key(self):
+        """
+        A short string identifying this filter (used in parse cache keys).
+        """
+
+        return hashlib.sha1(repr(self._settings()).encode("utf-8")).hexdigest()[:12]
+
+    def needs_elements(self):
+        """
+        Whether this filter looks at the element of each atom.
+        """
+
+        return self.elements is not None or self.skip_hydrogens
+
+    def accepts_element(self, element):
+        if self.skip_hydrogens and element in self.HYDROGENS:
+            return False
+        return self.elements is None or element in self.elements
+
+    def accepts(self, atom, compound, chain_id, element=None):
+        """
+        Whether an atom with the given (stripped) fields should be loaded.
+        """
+
+        return ((self.atom_names is None or atom in self.atom_names) and
+                (self.residue_names is None or compound in self.residue_names) and
+                (self.chains is None or chain_id in self.chains) and
+                (not self.needs_elements() or self.accepts_element(element)))
+
+def iter_pdb_files(folder, compressed=False):
+    """
+    Lazily finds all PDB files in a given folder, without building a list of
+    the whole directory. If compressed is set gzipped PDB files (.pdb.gz) are
+    included too.
+    """
+
+    def is_pdb(file_name):
+        return file_name[-3:] == "pdb" or (compressed and file_name[-7:] == ".pdb.gz")
+
+    if scandir is None:
+        for file_name in os.listdir(folder):
+            if is_pdb(file_name):
+                yield os.path.join(folder, file_name)
+        return
+
+    entries = scandir(folder)
+    try:
+        for entry in entries:
+            if is_pdb(entry.name):
+                yield entry.path
+    finally:
+        if hasattr(entries, "close"):
+            entries.close()
+
 def find_pdb_files(folder):
     """
     Finds all PDB files in a given folder.
     """
 
-    return [os.path.join(folder, file_name) for file_name in os.listdir(folder) if file_name[-3:] == "pdb"]
+    return list(iter_pdb_files(folder))
 
-def parse_pdb(file_name):
+def _data_to_arrays(data):
     """
-    This is the function that should be called from external files.
+    Split PDBData into arrays and metadata for the parse cache.
     """
 
-    return parse_pdb_text(file_name)
+    table = data.atom_table
+    arrays = dict((name, table.codes(name)) for name in ATOM_COLUMNS)
+    arrays["positions"] = table.positions
+    meta = {"categories": table.categories, "helixes": data.helixes, "sheets": data.sheets}
+    return arrays, meta
 
-def parse_pdb_text(file_name):
+def _data_from_arrays(arrays, meta):
     """
-    Parse a text formatted PDB file.
+    Rebuild PDBData from arrays and metadata stored in the parse cache.
     """
 
     data = PDBData()
+    data.atom_table.extend(arrays["positions"],
+                           dict((name, (arrays[name], meta["categories"][name])) for name in ATOM_COLUMNS))
+    data.helixes = [tuple(x) for x in meta["helixes"]]
+    data.sheets = [tuple(x) for x in meta["sheets"]]
+    return data
+
+def parse_pdb(file_name, atom_names=None, residue_names=None, chains=None, elements=None,
+              skip_hydrogens=False, records=RECORD_TYPES, lazy=False):
+    """
+    This is the function that should be called from external files. The file
+    is parsed with the backend chosen by set_parser_backend (bulk by default)
+    and results are served from the parse cache when it is enabled.
+
+    The remaining arguments restrict what is loaded (see ParseFilter). If lazy
+    is set atom data is decoded the first time it is used (bulk and mmap
+    backends only). Lazy parses are served from the parse cache but never
+    stored in it, since storing would decode everything up front.
+
+    Gzipped files (.gz) are decompressed in memory and parsed with
+    parse_pdb_bytes whatever the backend.
+    """
+
+    parse_filter = ParseFilter(atom_names, residue_names, chains, elements, skip_hydrogens, records)
+    kind = "pdb" if parse_filter.is_default() else "pdb-" + parse_filter.key()
+    parser = parse_pdb_gzip if file_name.endswith(".gz") else PARSERS[_backend]
+    parse = functools.partial(parser, parse_filter=parse_filter, lazy=lazy)
+    return parse_cache.cached_parse(file_name, kind, PARSER_VERSION, parse, _data_to_arrays, _data_from_arrays,
+                                    store=not lazy)
+
+def parse_pdb_contents(text, atom_names=None, residue_names=None, chains=None, elements=None,
+                       skip_hydrogens=False, records=RECORD_TYPES, lazy=False, file_name="<bytes>"):
+    """
+    Parse the contents of a PDB file that has already been read (for instance
+    from an archive), with the same options as parse_pdb. The result is not
+    cached.
+    """
+
+    parse_filter = ParseFilter(atom_names, residue_names, chains, elements, skip_hydrogens, records)
+    return parse_pdb_bytes(text, file_name, parse_filter=parse_filter, lazy=lazy)
+
+def _to_str(raw):
+    """
+    Convert raw bytes read from a PDB file into a native string.
+    """
+
+    return raw if isinstance(raw, str) else raw.decode("latin-1")
+
+def _add_helix_record(data, line):
+    """
+    Register the alpha helix described by a HELIX line.
+    """
+
+    chain_id = line[19].strip()
+    start_seq = (line[21:25].strip())
+    start_insertion = line[25].strip()
+    end_seq = (line[33:37].strip())
+    end_insertion = line[37].strip()
+    data.add_helix(chain_id, start_seq + start_insertion, end_seq + end_insertion)
+
+def _add_sheet_record(data, line):
+    """
+    Register the beta sheet described by a SHEET line.
+    """
+
+    chain_id = line[21].strip()
+    start_seq = (line[22:26].strip())
+    start_insertion = line[26].strip()
+    end_seq = (line[33:37].strip())
+    end_insertion = line[37].strip()
+    data.add_sheet(chain_id, start_seq + start_insertion, end_seq +  end_insertion)
+
+def parse_pdb_text(file_name, parse_filter=None, lazy=False):
+    """
+    Parse a text formatted PDB file. Only the parts of the file allowed by
+    parse_filter (a ParseFilter) are loaded. This parser always decodes
+    everything up front, so lazy is ignored.
+    """
+
+    data = PDBData()
+    rows = []
+    if parse_filter is None:
+        parse_filter = ParseFilter()
+    load_atoms = "ATOM" in parse_filter.records
+    load_hetatms = "HETATM" in parse_filter.records
+    load_helixes = "HELIX" in parse_filter.records
+    load_sheets = "SHEET" in parse_filter.records
+    filter_atoms = not parse_filter.is_default()
+    needs_elements = parse_filter.needs_elements()
 
     atom_count = 0
     processed_model = False
     with open(file_name) as pdb_file:
         for line in pdb_file:
-            if "ATOM" == line[0:4] or "HETATM" == line[0:6]:
+            if (load_atoms and "ATOM" == line[0:4]) or (load_hetatms and "HETATM" == line[0:6]):
+                if filter_atoms:
+                    element = None
+                    if needs_elements:
+                        element = line[76:78].strip() or element_from_name(line[12:16])
+                    if not parse_filter.accepts(line[12:16].strip(), line[17:20].strip(), line[21:22].strip(), element):
+                        continue
                 x = float(line[30:38].strip())
                 y = float(line[38:46].strip())
                 z = float(line[46:54].strip())
@@ -267,33 +1327,504 @@ def parse_pdb_text(file_name):
                 alt_id = line[16:17].strip()
                 chain_id = line[21:22].strip()
 
-                pdb_atom = PDBAtom()
-                pdb_atom.position = (x, y, z)
-                pdb_atom.compound = compound
-                pdb_atom.atom = atom
-                pdb_atom.sequence_id = sequence_id + insertion_code
-                pdb_atom.alt_id = alt_id
-                pdb_atom.chain_id = chain_id
-                data.add_atom(pdb_atom)
+                rows.append(((x, y, z), atom, compound, sequence_id + insertion_code,
+                             insertion_code, alt_id, chain_id))
                 atom_count += 1
             if "MODEL" == line[0:5]:
                 if processed_model:
                     break
                 processed_model = True
-            if "HELIX" == line[0:5]:
-                chain_id = line[19].strip()
-                start_seq = (line[21:25].strip())
-                start_insertion = line[25].strip()
-                end_seq = (line[33:37].strip())
-                end_insertion = line[37].strip()
-                data.add_helix(chain_id, start_seq + start_insertion, end_seq + end_insertion)
-            if "SHEET" == line[0:5]:
-                chain_id = line[21].strip()
-                start_seq = (line[22:26].strip())
-                start_insertion = line[26].strip()
-                end_seq = (line[33:37].strip())
-                end_insertion = line[37].strip()
-                data.add_sheet(chain_id, start_seq + start_insertion, end_seq +  end_insertion)
+            if load_helixes and "HELIX" == line[0:5]:
+                _add_helix_record(data, line)
+            if load_sheets and "SHEET" == line[0:5]:
+                _add_sheet_record(data, line)
 
+    data.atom_table.append_rows(rows)
     logging.info("Loaded %s (%d atoms)", file_name, atom_count)
     return data
+
+# Fixed column layout of the fields we read from ATOM/HETATM records. Nothing
+# past the z coordinate is needed.
+RECORD_WIDTH = 54
+ATOM_FIELDS = (
+    ("atom", 12, 16),
+    ("alt_id", 16, 17),
+    ("compound", 17, 20),
+    ("chain_id", 21, 22),
+    ("sequence_id", 22, 27),
+    ("insertion_code", 26, 27),
+)
+
+def _line_bounds(buf):
+    """
+    Returns arrays of the start offset and length of every line in a buffer of
+    bytes.
+    """
+
+    newlines = numpy.flatnonzero(buf == ord("\n"))
+    starts = numpy.concatenate(([0], newlines + 1))
+    ends = numpy.concatenate((newlines, [len(buf)]))
+    return starts, ends - starts
+
+def _line_windows(buf):
+    """
+    View a buffer of bytes as overlapping rows of RECORD_WIDTH characters
+    starting at every offset (without copying it). Indexing this with line
+    starts copies out whole records with a single row copy each.
+    """
+
+    return numpy.lib.stride_tricks.as_strided(buf, shape=(max(len(buf) - RECORD_WIDTH + 1, 0), RECORD_WIDTH),
+                                              strides=(1, 1))
+
+def _record_mask(heads, prefix):
+    """
+    Given the first eight characters of every line packed into integers (see
+    _line_heads) returns a boolean array that is true for every line that
+    begins with prefix.
+    """
+
+    key = numpy.frombuffer(prefix.ljust(8, b"\0"), dtype=numpy.uint64)[0]
+    mask = numpy.frombuffer((b"\xff" * len(prefix)).ljust(8, b"\0"), dtype=numpy.uint64)[0]
+    return (heads & mask) == key
+
+def _line_heads(buf, windows, starts, lengths):
+    """
+    Pack the first eight characters of every line into a single integer so
+    record types can be checked with one comparison per line.
+    """
+
+    return _gather_records(buf, windows, starts, lengths, 8).view(numpy.uint64).ravel()
+
+def _gather_records(buf, windows, starts, lengths, width=RECORD_WIDTH):
+    """
+    Copy the first width characters of each of the given lines into an
+    (N, width) character array, padding short lines with spaces.
+    """
+
+    # Short lines and lines starting too close to the end of the buffer to
+    # have a whole window would run off the end of the windows, so copy them a
+    # character at a time
+    records = numpy.ascontiguousarray(windows[numpy.minimum(starts, len(windows) - 1), :width])
+    short = (lengths < width) | (starts >= len(windows))
+    if short.any():
+        records[short] = _gather_columns(buf, starts[short], lengths[short], 0, width)
+    return records
+
+def _gather_columns(buf, starts, lengths, start, end):
+    """
+    Copy the characters start:end of each of the given lines into an (N, end -
+    start) character array a character at a time, padding short lines with
+    spaces.
+    """
+
+    offsets = numpy.arange(start, end)
+    indices = numpy.minimum(starts[:, None] + offsets, len(buf) - 1)
+    return numpy.where(offsets < lengths[:, None], buf[indices], numpy.uint8(ord(" ")))
+
+# How many atom records have their coordinates decoded at once
+POSITION_BLOCK = 1 << 14
+
+# The characters that can appear in a fixed width decimal field
+DECIMAL_CHARACTERS = numpy.zeros(256, dtype=bool)
+DECIMAL_CHARACTERS[bytearray(b" +-.0123456789")] = True
+
+def _record_lines(text, starts, lengths, mask):
+    """
+    Returns the lines selected by mask as native strings.
+    """
+
+    return [_to_str(text[start:start + length]) for start, length in
+            zip(starts[mask].tolist(), lengths[mask].tolist())]
+
+def _in_every_byte(byte):
+    """
+    A 64 bit integer holding byte in each of its eight bytes.
+    """
+
+    return numpy.uint64(byte * 0x0101010101010101)
+
+def _parse_coordinates(fields):
+    """
+    The fast path of _parse_fixed_floats for 8 character fields with the
+    decimal point in the same column (the %8.3f coordinates of a well formed
+    file). Each field is read as a single 64 bit integer, so checking and
+    combining its eight characters takes a handful of integer operations
+    rather than a pass per character. Returns None if the fields don't have
+    that layout (digits, spaces, a leading "-" and the point).
+    """
+
+    point_column = bytearray(fields[0].tobytes()).find(b".")
+    if point_column < 0:
+        return None
+    # The first character is the lowest byte
+    words = fields.view("<u8").ravel()
+    point = numpy.uint64(0xFF << (8 * point_column))
+    if not ((words & point) == numpy.uint64(ord(".") << (8 * point_column))).all():
+        return None
+    # Every character should be between 0x20 and 0x3F, and those from 0x30 up
+    # digits; is_digit holds 0xFF in the bytes of digits
+    if not ((words & _in_every_byte(0xE0)) == _in_every_byte(0x20)).all():
+        return None
+    is_digit = ((words >> numpy.uint64(4)) & _in_every_byte(0x01)) * numpy.uint64(0xFF)
+    digits = words & is_digit & _in_every_byte(0x0F)
+    if ((digits + _in_every_byte(0x06)) & _in_every_byte(0x10)).any():
+        return None
+    if (is_digit == 0).any():
+        raise ValueError("could not convert string to float: {!r}".format(
+            _to_str(fields[numpy.flatnonzero(is_digit == 0)[0]].tobytes())))
+    # The rest (other than the point) should be spaces (0x20) or "-" (0x2D):
+    # their low halves are 0 or 0xD
+    signs = words & ~is_digit & ~point & _in_every_byte(0x0F)
+    nonzero = ((signs + _in_every_byte(0x0F)) >> numpy.uint64(4)) & _in_every_byte(0x01)
+    if (signs ^ nonzero * numpy.uint64(0x0D)).any():
+        return None
+
+    # Join neighbouring digits into pairs, then fours, then all eight. Each
+    # mask drops the halves that were merged into their neighbour.
+    value = (digits * numpy.uint64(10) + (digits >> numpy.uint64(8))) & numpy.uint64(0x00FF00FF00FF00FF)
+    value = (value * numpy.uint64(100) + (value >> numpy.uint64(16))) & numpy.uint64(0x0000FFFF0000FFFF)
+    value = (value * numpy.uint64(10000) + (value >> numpy.uint64(32))) & numpy.uint64(0xFFFFFFFF)
+    # The point counted as a 0 digit. Dropping it from the middle takes the
+    # digits before it (high) down a place: high * 10 ** (decimals + 1)
+    # becomes high * 10 ** decimals.
+    decimals = 7 - point_column
+    high = value // numpy.uint64(10 ** (decimals + 1))
+    mantissa = value - high * numpy.uint64(9 * 10 ** decimals)
+    # The mantissa is below 10 ** 8, and signed integers convert to floats faster
+    values = mantissa.view(numpy.int64) / 10.0 ** decimals
+    return numpy.negative(values, out=values, where=signs != 0)
+
+def _parse_fixed_floats(fields):
+    """
+    Parse an (N, width) character array of fixed width decimal numbers (like
+    the %8.3f coordinates). The digits are accumulated into an exact integer
+    which is divided by a power of ten once, so the result is identical to
+    calling float on each field. Fields that are not plain decimals fall back
+    to numpy's string conversion. As with float, a field without any digits
+    (such as a blank one) raises a ValueError.
+    """
+
+    fields = numpy.ascontiguousarray(fields)
+    width = fields.shape[1]
+    if width == 8 and len(fields):
+        values = _parse_coordinates(fields)
+        if values is not None:
+            return values
+    is_digit = (fields >= ord("0")) & (fields <= ord("9"))
+    has_digits = is_digit.any(axis=1)
+    if not has_digits.all():
+        field = _to_str(fields[numpy.flatnonzero(~has_digits)[0]].tobytes())
+        raise ValueError("could not convert string to float: {!r}".format(field))
+
+    if numpy.bincount(fields.ravel(), minlength=256)[~DECIMAL_CHARACTERS].any():
+        return fields.view("S%d" % width).ravel().astype(numpy.float64)
+
+    point = fields == ord(".")
+    point_columns = numpy.flatnonzero(point.any(axis=0))
+    if len(point_columns) == 1 and point[:, point_columns[0]].all():
+        # Fast path: the decimal point is in the same column for every field
+        # (this is the case for well formed files). Every character other than
+        # a digit is below "0" so clipping there zeroes them out.
+        decimals = width - point_columns[0] - 1
+        exponents = numpy.concatenate((numpy.arange(point_columns[0] - 1, -1, -1) + decimals,
+                                       [0], numpy.arange(decimals - 1, -1, -1)))
+        weights = numpy.where(numpy.arange(width) == point_columns[0], 0, 10 ** exponents)
+        digits = numpy.maximum(fields, numpy.uint8(ord("0"))) - numpy.uint8(ord("0"))
+        # Every partial sum is an integer well below 2**53 so this is exact
+        mantissa = digits.dot(weights.astype(numpy.float64))
+    else:
+        digits_after = is_digit[:, ::-1].cumsum(axis=1)[:, ::-1] - is_digit
+        mantissa = ((fields.astype(numpy.int64) - ord("0")) * numpy.where(is_digit, 10 ** numpy.minimum(digits_after, 18), 0)).sum(axis=1)
+        decimals = (is_digit & (point.cumsum(axis=1) > 0)).sum(axis=1)
+    values = mantissa / 10.0 ** decimals
+    negative = (fields == ord("-")).view(numpy.uint8).dot(numpy.ones(width, dtype=numpy.uint8))
+    return numpy.where(negative, -values, values)
+
+def _column_block(records, start, end):
+    """
+    Slice the characters start:end out of every row of a 2D character array and
+    return them as a 1D array of fixed width byte strings.
+    """
+
+    return numpy.ascontiguousarray(records[:, start:end]).view("S%d" % (end - start)).ravel()
+
+def _categorize(records, start, end, decode):
+    """
+    Turn the characters start:end of every record into a (codes, categories)
+    pair. The columns are packed into integers so they can be grouped without
+    any string comparisons, and each distinct value is decoded only once.
+    """
+
+    keys = numpy.zeros((len(records), 8), dtype=numpy.uint8)
+    keys[:, :end - start] = records[:, start:end]
+    keys = keys.view(numpy.uint64).ravel()
+
+    # Most columns come in long runs (every atom in a residue shares its
+    # name, chain, etc.) so only the first row of each run is sorted.
+    heads = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+    _, first, head_codes = numpy.unique(keys[heads], return_index=True, return_inverse=True)
+    codes = numpy.repeat(head_codes, numpy.diff(numpy.concatenate((heads, [len(keys)]))))
+    raw = _column_block(records[heads[first]], start, end)
+    return codes, [decode(x) for x in raw.tolist()]
+
+def _decode_field(raw):
+    """
+    Decode a raw fixed width field into a stripped string.
+    """
+
+    return _to_str(raw).strip()
+
+def _decode_element(raw):
+    """
+    Decode the raw element column followed by the raw atom name into an
+    element, falling back on the atom name if the element column is blank.
+    """
+
+    raw = _to_str(raw)
+    return raw[:2].strip() or element_from_name(raw[2:])
+
+def _select_atoms(buf, starts, lengths, records, parse_filter):
+    """
+    Returns a boolean array that is true for every atom record allowed by
+    parse_filter. Each filter is checked once per distinct value.
+    """
+
+    keep = numpy.ones(len(records), dtype=bool)
+    for start, end, allowed in ((12, 16, parse_filter.atom_names), (17, 20, parse_filter.residue_names),
+                                (21, 22, parse_filter.chains)):
+        if allowed is not None:
+            codes, categories = _categorize(records, start, end, _decode_field)
+            keep &= numpy.array([x in allowed for x in categories], dtype=bool)[codes]
+    if parse_filter.needs_elements():
+        names = numpy.concatenate((_gather_columns(buf, starts, lengths, 76, 78), records[:, 12:16]), axis=1)
+        codes, categories = _categorize(names, 0, 6, _decode_element)
+        keep &= numpy.array([parse_filter.accepts_element(x) for x in categories], dtype=bool)[codes]
+    return keep
+
+def _decode_positions(records):
+    """
+    Decode the coordinates of a block of atom records. The records are
+    decoded POSITION_BLOCK at a time so the temporary arrays stay small no
+    matter how many atoms there are.
+    """
+
+    positions = numpy.empty((len(records), 3), dtype=numpy.float64)
+    for start in range(0, len(records), POSITION_BLOCK):
+        block = records[start:start + POSITION_BLOCK, 30:54]
+        positions[start:start + POSITION_BLOCK] = _parse_fixed_floats(block.reshape(-1, 8)).reshape(-1, 3)
+    return positions
+
+def _decode_column(records, name, start, end, fields):
+    """
+    Decode one of ATOM_COLUMNS from a block of atom records into a (codes,
+    categories) pair. Columns not in fields (if given) are left empty.
+    """
+
+    if fields is not None and name not in fields:
+        return numpy.zeros(len(records), dtype=numpy.uint8), [""]
+    decode = _decode_sequence_id if name == "sequence_id" else _decode_field
+    return _categorize(records, start, end, decode)
+
+def _decode_sequence_id(raw):
+    """
+    Decode the raw resSeq + iCode columns into a sequence ID (i.e. 100A).
+    """
+
+    raw = _to_str(raw)
+    return raw[:4].strip() + raw[4:].strip()
+
+def parse_pdb_bytes(text, file_name="<bytes>", fields=None, parse_filter=None, lazy=False):
+    """
+    Parse the raw contents of a PDB file (anything supporting the buffer
+    protocol, such as bytes or an mmap). Rather than processing the file line
+    by line, all of the ATOM/HETATM records are found at once and their fixed
+    width columns are decoded together as numpy array operations.
+
+    If fields is given only those ATOM_COLUMNS are decoded; the others are left
+    empty. Note that grouping atoms into compounds needs the chain_id and
+    sequence_id columns. Only the parts of the file allowed by parse_filter (a
+    ParseFilter) are loaded, and unwanted atoms are dropped before their
+    coordinates are decoded. If lazy is set the atom columns are decoded the
+    first time they are used rather than up front.
+    """
+
+    data = PDBData()
+    if parse_filter is None:
+        parse_filter = ParseFilter()
+
+    buf = numpy.frombuffer(text, dtype=numpy.uint8)
+    starts, lengths = _line_bounds(buf)
+    if len(buf) < RECORD_WIDTH:
+        buf = numpy.concatenate((buf, numpy.full(RECORD_WIDTH, ord(" "), dtype=numpy.uint8)))
+    windows = _line_windows(buf)
+    heads = _line_heads(buf, windows, starts, lengths)
+
+    # Only the first model is loaded
+    models = numpy.flatnonzero(_record_mask(heads, b"MODEL"))
+    if len(models) >= 2:
+        starts, lengths, heads = starts[:models[1]], lengths[:models[1]], heads[:models[1]]
+
+    atoms = numpy.zeros(len(starts), dtype=bool)
+    if "ATOM" in parse_filter.records:
+        atoms |= _record_mask(heads, b"ATOM")
+    if "HETATM" in parse_filter.records:
+        atoms |= _record_mask(heads, b"HETATM")
+    records = _gather_records(buf, windows, starts[atoms], lengths[atoms])
+    if len(records) and not parse_filter.is_default():
+        records = records[_select_atoms(buf, starts[atoms], lengths[atoms], records, parse_filter)]
+
+    if len(records):
+        load_positions = functools.partial(_decode_positions, records)
+        load_columns = dict((name, functools.partial(_decode_column, records, name, start, end, fields))
+                            for name, start, end in ATOM_FIELDS)
+        if lazy:
+            data.atom_table.defer(len(records), load_positions, load_columns)
+        else:
+            data.atom_table.extend(load_positions(), dict((name, load()) for name, load in load_columns.items()))
+
+    if "HELIX" in parse_filter.records:
+        for line in _record_lines(text, starts, lengths, _record_mask(heads, b"HELIX")):
+            _add_helix_record(data, line)
+    if "SHEET" in parse_filter.records:
+        for line in _record_lines(text, starts, lengths, _record_mask(heads, b"SHEET")):
+            _add_sheet_record(data, line)
+
+    logging.info("Loaded %s (%d atoms)", file_name, len(records))
+    return data
+
+def parse_pdb_bulk(file_name, parse_filter=None, lazy=False):
+    """
+    Parse a PDB file by reading it as bytes and decoding it in bulk (see
+    parse_pdb_bytes). Produces the same data as parse_pdb_text.
+    """
+
+    with open(file_name, "rb") as pdb_file:
+        return parse_pdb_bytes(pdb_file.read(), file_name, parse_filter=parse_filter, lazy=lazy)
+
+def parse_pdb_mmap(file_name, fields=None, parse_filter=None, lazy=False):
+    """
+    Parse a PDB file through a read only memory map (see parse_pdb_bytes).
+    Records are located and sliced straight out of the mapped pages, so the
+    file is never copied into memory as a whole and processes reading the same
+    file share the operating system's page cache.
+    """
+
+    with open(file_name, "rb") as pdb_file:
+        if os.fstat(pdb_file.fileno()).st_size == 0:
+            return parse_pdb_bytes(b"", file_name, fields, parse_filter, lazy)
+        mapped = mmap.mmap(pdb_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return parse_pdb_bytes(mapped, file_name, fields, parse_filter, lazy)
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # Something (i.e. a traceback) still holds a view of the map; it
+            # will be unmapped once that is released.
+            pass
+
+# The available ways of parsing a PDB file, by name
+PARSERS = {
+    "text": parse_pdb_text,
+    "bulk": parse_pdb_bulk,
+    "mmap": parse_pdb_mmap,
+}
+
+_backend = "bulk"
+
+def parse_pdb_gzip(file_name, parse_filter=None, lazy=False):
+    """
+    Parse a gzipped PDB file by decompressing it into memory and parsing the
+    result with parse_pdb_bytes.
+    """
+
+    with gzip.open(file_name, "rb") as source:
+        text = source.read()
+    return parse_pdb_bytes(text, file_name, parse_filter=parse_filter, lazy=lazy)
+
+def set_parser_backend(name):
+    """
+    Choose which of PARSERS parse_pdb uses.
+    """
+
+    global _backend
+    if name not in PARSERS:
+        raise ValueError("Unknown PDB parser backend {}".format(name))
+    _backend = name
+
+# How much of a file the streaming readers decode at a time
+CHUNK_SIZE = 1 << 20
+
+MODEL_RECORD = re.compile(b"^MODEL", re.M)
+
+def iter_pdb_chunks(file_name, chunk_size=CHUNK_SIZE, parse_filter=None):
+    """
+    Parse a PDB file a block of complete lines at a time, yielding a PDBData
+    for each block (see parse_pdb_bytes). Memory use is bounded by the chunk
+    size rather than the size of the file. As with the other parsers only the
+    first model is loaded.
+    """
+
+    models_seen = 0
+    remainder = b""
+    with open(file_name, "rb") as pdb_file:
+        while True:
+            block = pdb_file.read(chunk_size)
+            text = remainder + block
+            if not text:
+                break
+            if block:
+                cut = text.rfind(b"\n") + 1
+                if cut == 0:
+                    # A single line longer than the chunk; keep reading
+                    remainder = text
+                    continue
+                text, remainder = text[:cut], text[cut:]
+            else:
+                remainder = b""
+
+            last_chunk = not block
+            for match in MODEL_RECORD.finditer(text):
+                models_seen += 1
+                if models_seen == 2:
+                    text = text[:match.start()]
+                    last_chunk = True
+                    break
+            yield parse_pdb_bytes(text, file_name, parse_filter=parse_filter)
+            if last_chunk:
+                break
+
+def iter_atoms(file_name, chunk_size=CHUNK_SIZE, parse_filter=None):
+    """
+    Yields the atoms in a PDB file one at a time, only holding a chunk of the
+    file in memory at once.
+    """
+
+    for data in iter_pdb_chunks(file_name, chunk_size, parse_filter):
+        for atom in data.atoms:
+            yield atom
+
+def iter_residues(file_name, chunk_size=CHUNK_SIZE, parse_filter=None):
+    """
+    Yields the compounds in a PDB file (as get_compounds would return them) as
+    soon as each one is complete, only holding a chunk of the file in memory at
+    once. A residue split across two chunks is stitched back together.
+    """
+
+    pending = None
+    for data in iter_pdb_chunks(file_name, chunk_size, parse_filter):
+        compounds = data.get_compounds()
+        if not compounds:
+            continue
+        if pending is not None:
+            first = compounds[0]
+            if (first.chain_id, first.compound_id) == (pending.chain_id, pending.compound_id):
+                compounds[0] = PDBCompound(first.compound_id, list(pending.atoms) + list(first.atoms), first.chain_id,
+                                           first.name)
+            else:
+                yield pending
+        for compound in compounds[:-1]:
+            yield compound
+        pending = compounds[-1]
+    if pending is not None:
+        yield pending
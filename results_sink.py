@@ -0,0 +1,235 @@
+"""
+Append-only columnar output of analysis results. Each writer produces its own
+shards, so any number of worker processes or machines can write to the same
+directory; the aggregate script merges them afterwards.
+
+A shard holds two tables: one row per structure (its name, number of (site,
+dehydron) pairs and how long each stage of its analysis took, see
+instrument) and one row per pair (see SITE_COLUMNS). Shards are
+written either as a single .npz file or as a pair of .structures.csv and
+.sites.csv files.
+"""
+
+import csv
+import glob
+import itertools
+import os
+import socket
+import sys
+import time
+
+import numpy
+
+import instrument
+
+# Stage timings, counts, peak memory and how much it grew during the analysis
+# of the structure, from the instrumentation summary; NaN for results that
+# weren't computed in this run
+TIMING_COLUMNS = (("wall_seconds", "cpu_seconds") + tuple(x + "_seconds" for x in instrument.STAGES) +
+                  instrument.COUNTS + ("peak_rss_kb", "peak_growth_kb"))
+STRUCTURE_COLUMNS = ("pdb_name", "pairs") + TIMING_COLUMNS
+SITE_COLUMNS = ("pdb_name", "site_chain", "site_sequence_id", "site_name", "donor_chain", "donor_sequence_id",
+                "acceptor_chain", "acceptor_sequence_id", "donor_distance", "acceptor_distance", "site_ss", "donor_ss",
+                "acceptor_ss")
+INTEGER_COLUMNS = ("pairs",)
+FLOAT_COLUMNS = ("donor_distance", "acceptor_distance") + TIMING_COLUMNS
+
+FORMATS = ("npz", "csv")
+
+
+def _column_array(name, values):
+    """
+    Convert a list of column values to an array of the right type.
+    """
+
+    if name in INTEGER_COLUMNS:
+        return numpy.array(values, dtype=int)
+    if name in FLOAT_COLUMNS:
+        return numpy.array(values, dtype=numpy.float64)
+    return numpy.array(values, dtype=str)
+
+def _summary_columns(summary):
+    """
+    Get the values of the timing columns from an instrumentation summary.
+    """
+
+    if summary is None:
+        return {}
+    columns = {"wall_seconds": summary["wall"], "cpu_seconds": summary["cpu"],
+               "peak_rss_kb": summary["peak_rss_kb"], "peak_growth_kb": summary.get("peak_growth_kb")}
+    for name, (wall, _) in summary["stages"].items():
+        columns[name + "_seconds"] = wall
+    columns.update(summary["counts"])
+    return columns
+
+def _fill_missing(columns, names):
+    """
+    Add any columns missing from a shard written by an older version, as NaN
+    for numeric columns and empty strings otherwise.
+    """
+
+    size = len(columns["pdb_name"])
+    for name in names:
+        if name not in columns:
+            columns[name] = numpy.full(size, numpy.nan) if name in FLOAT_COLUMNS else _column_array(name, [""] * size)
+    return columns
+
+def _open_csv(file_name, mode):
+    """
+    Open a file for the csv module on either Python 2 or 3.
+    """
+
+    if sys.version_info[0] < 3:
+        return open(file_name, mode + "b")
+    return open(file_name, mode, newline="")
+
+def _write_csv(file_name, names, columns):
+    with _open_csv(file_name, "w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(names)
+        writer.writerows(zip(*[columns[x] for x in names]))
+
+def _read_csv(file_name, names):
+    with _open_csv(file_name, "r") as csv_file:
+        rows = list(csv.reader(csv_file))
+    header = rows[0]
+    values = list(zip(*rows[1:])) if len(rows) > 1 else [()] * len(header)
+    columns = dict((name, _column_array(name, list(x))) for name, x in zip(header, values) if name in names)
+    return _fill_missing(columns, names)
+
+class ShardWriter(object):
+    """
+    Buffers the results of run_analysis and writes them to a new shard in
+    directory every rows_per_shard sites (and when flushed or closed). Shard
+    names include the host, process and start time so writers never clash.
+    Each shard is written under a temporary name and then renamed, so readers
+    only ever see complete shards.
+    """
+
+    def __init__(self, directory, file_format="npz", rows_per_shard=100000):
+        if file_format not in FORMATS:
+            raise ValueError("Unknown shard format {}".format(file_format))
+        self.directory = directory
+        self.file_format = file_format
+        self.rows_per_shard = rows_per_shard
+        self.prefix = "{}-{}-{}".format(socket.gethostname(), os.getpid(), int(time.time()))
+        self.shard_count = 0
+        self._structures = dict((name, []) for name in STRUCTURE_COLUMNS)
+        self._sites = dict((name, []) for name in SITE_COLUMNS)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, pdb_name, pairs, summary=None):
+        """
+        Add the summarized pairs (see analysis.summarize_pairs) of a structure
+        and optionally the instrumentation summary of its analysis.
+        """
+
+        self._structures["pdb_name"].append(pdb_name)
+        self._structures["pairs"].append(len(pairs))
+        timings = _summary_columns(summary)
+        for name in TIMING_COLUMNS:
+            value = timings.get(name)
+            self._structures[name].append(numpy.nan if value is None else value)
+        for (site_chain, site_sequence_id, site_name), dehydron, distances, classes in pairs:
+            (donor_chain, donor_sequence_id), (acceptor_chain, acceptor_sequence_id) = dehydron
+            row = (pdb_name, site_chain, site_sequence_id, site_name, donor_chain, donor_sequence_id,
+                   acceptor_chain, acceptor_sequence_id, distances[0], distances[1]) + tuple(classes)
+            for name, value in zip(SITE_COLUMNS, row):
+                self._sites[name].append(value)
+        if len(self._sites["pdb_name"]) >= self.rows_per_shard:
+            self.flush()
+
+    def flush(self):
+        """
+        Write everything buffered so far to a new shard.
+        """
+
+        if not self._structures["pdb_name"]:
+            return
+        structures = dict((name, _column_array(name, x)) for name, x in self._structures.items())
+        sites = dict((name, _column_array(name, x)) for name, x in self._sites.items())
+        base = os.path.join(self.directory, "{}-{:05d}".format(self.prefix, self.shard_count))
+        if self.file_format == "npz":
+            arrays = dict(("structures-" + name, x) for name, x in structures.items())
+            arrays.update(("sites-" + name, x) for name, x in sites.items())
+            with open(base + ".npz.tmp", "wb") as shard_file:
+                numpy.savez_compressed(shard_file, **arrays)
+            os.rename(base + ".npz.tmp", base + ".npz")
+        else:
+            _write_csv(base + ".sites.csv.tmp", SITE_COLUMNS, sites)
+            _write_csv(base + ".structures.csv.tmp", STRUCTURE_COLUMNS, structures)
+            # The structures file marks the shard as complete, so it goes last
+            os.rename(base + ".sites.csv.tmp", base + ".sites.csv")
+            os.rename(base + ".structures.csv.tmp", base + ".structures.csv")
+        self.shard_count += 1
+        for values in itertools.chain(self._structures.values(), self._sites.values()):
+            del values[:]
+
+    def close(self):
+        self.flush()
+
+def find_shards(paths):
+    """
+    Find the shards in a list of shard files and directories, oldest first.
+    """
+
+    shards = []
+    for path in paths:
+        if os.path.isdir(path):
+            shards.extend(glob.glob(os.path.join(path, "*.npz")))
+            shards.extend(glob.glob(os.path.join(path, "*.structures.csv")))
+        else:
+            shards.append(path)
+    return sorted(shards, key=os.path.getmtime)
+
+def read_shard(file_name):
+    """
+    Read a shard, returning dictionaries of the structure and site columns.
+    """
+
+    if file_name.endswith(".npz"):
+        with numpy.load(file_name) as shard:
+            structures = _fill_missing(dict((name, shard["structures-" + name]) for name in STRUCTURE_COLUMNS
+                                            if "structures-" + name in shard.files), STRUCTURE_COLUMNS)
+            sites = _fill_missing(dict((name, shard["sites-" + name]) for name in SITE_COLUMNS
+                                       if "sites-" + name in shard.files), SITE_COLUMNS)
+        # Shards written by another Python version may have other string types
+        for columns in (structures, sites):
+            for name, values in columns.items():
+                if values.dtype.kind in "SU":
+                    columns[name] = values.astype(str)
+        return structures, sites
+
+    base = file_name[:-len(".structures.csv")]
+    return _read_csv(file_name, STRUCTURE_COLUMNS), _read_csv(base + ".sites.csv", SITE_COLUMNS)
+
+def _concatenate_columns(parts):
+    """
+    Join lists of column arrays into single arrays.
+    """
+
+    return dict((name, _column_array(name, numpy.concatenate(x) if x else [])) for name, x in parts.items())
+
+def read_shards(paths):
+    """
+    Read and merge all of the shards in a list of shard files and directories.
+    If a structure was written more than once (for instance by a rerun) only
+    the newest shard's results for it are kept. Returns dictionaries of the
+    structure and site columns.
+    """
+
+    shards = [read_shard(x) for x in find_shards(paths)]
+    newest = {}
+    for shard_number, (structures, _) in enumerate(shards):
+        for pdb_name in structures["pdb_name"].tolist():
+            newest[pdb_name] = shard_number
+
+    merged_structures = dict((name, []) for name in STRUCTURE_COLUMNS)
+    merged_sites = dict((name, []) for name in SITE_COLUMNS)
+    for shard_number, (structures, sites) in enumerate(shards):
+        for columns, merged in ((structures, merged_structures), (sites, merged_sites)):
+            keep = numpy.array([newest[x] == shard_number for x in columns["pdb_name"].tolist()], dtype=bool)
+            for name, values in columns.items():
+                merged[name].append(values[keep])
+    return _concatenate_columns(merged_structures), _concatenate_columns(merged_sites)
@@ -0,0 +1,131 @@
+"""
+A store of per-structure analysis results, so that a rerun over a mostly
+unchanged data directory only recomputes the structures whose inputs changed.
+"""
+
+import json
+import logging
+import os
+
+from parse_cache import file_hash, native_strings, write_json
+
+STORE_VERSION = 1
+
+
+def _as_tuples(value):
+    """
+    JSON has no tuples; turn the lists in a stored result back into tuples.
+    """
+
+    if isinstance(value, list):
+        return tuple(_as_tuples(x) for x in value)
+    return value
+
+def fingerprint(file_name, previous=None):
+    """
+    Fingerprint a file by its size, modification time and content hash (or
+    None if it doesn't exist). If the size and modification time match the
+    previous fingerprint its hash is reused rather than reading the file.
+    """
+
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    if previous is not None and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime:
+        return previous
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": file_hash(file_name)}
+
+def _same_inputs(current, previous):
+    """
+    Check whether two sets of input fingerprints describe the same contents.
+    """
+
+    if sorted(current) != sorted(previous):
+        return False
+    for name, value in current.items():
+        if value is None or previous[name] is None:
+            if value != previous[name]:
+                return False
+        elif value["hash"] != previous[name]["hash"]:
+            return False
+    return True
+
+class ResultsStore(object):
+    """
+    Results of an analysis, one entry per structure, kept in a JSON manifest
+    along with fingerprints of the input files each result was computed from
+    and the analysis parameters. An entry is only reused while its inputs and
+    the parameters are unchanged.
+
+    Call lookup before analyzing a structure and store afterwards; store
+    records the fingerprints taken by lookup, so a file that changes during
+    the analysis is picked up on the next run. Nothing is written until save
+    is called.
+    """
+
+    def __init__(self, file_name, parameters):
+        self.file_name = file_name
+        # Round trip through JSON so parameters compare equal to stored ones
+        self.parameters = native_strings(json.loads(json.dumps(parameters)))
+        self.entries = {}
+        self._pending = {}
+        self._dirty = False
+        try:
+            with open(file_name) as manifest_file:
+                manifest = native_strings(json.load(manifest_file))
+            if manifest.get("version") == STORE_VERSION:
+                self.entries = manifest["entries"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, name, input_files):
+        """
+        Get the stored result for a structure, or None if there isn't one or
+        it is stale.
+        """
+
+        entry = self.entries.get(name)
+        previous = entry["inputs"] if entry is not None else {}
+        inputs = dict((os.path.basename(x), fingerprint(x, previous.get(os.path.basename(x))))
+                      for x in input_files)
+        self._pending[name] = inputs
+        if entry is None or entry["parameters"] != self.parameters or not _same_inputs(inputs, previous):
+            return None
+        if inputs != previous:
+            # Touched but not changed; remember the new times to skip hashing
+            entry["inputs"] = inputs
+            self._dirty = True
+        return _as_tuples(entry["result"])
+
+    def store(self, name, result):
+        """
+        Store the result for a structure previously passed to lookup.
+        """
+
+        self.entries[name] = {"inputs": self._pending.pop(name), "parameters": self.parameters,
+                              "result": result}
+        self._dirty = True
+
+    def prune(self, names):
+        """
+        Drop the entries of all structures not in names.
+        """
+
+        names = set(names)
+        for name in [x for x in self.entries if x not in names]:
+            logging.info("Dropping stored result for %s", name)
+            del self.entries[name]
+            self._dirty = True
+
+    def save(self):
+        """
+        Write the manifest if anything has changed.
+        """
+
+        if self._dirty:
+            write_json(self.file_name, {"version": STORE_VERSION, "entries": self.entries})
+            self._dirty = False
@@ -1,130 +1,192 @@
 #!/usr/bin/env python
 """
 Run the analysis on a given set of PDB files.
+
+The analysis itself lives in the analysis module. Only what every run needs is
+imported up front: multiprocessing, the results store, result shards and
+plotting are imported when an option asks for them, so starting the script
+(or one of many short jobs) stays cheap.
 """
 
 import argparse
+import functools
+import itertools
 import logging
 import os
+import signal
+
+import numpy
 
-from matplotlib import pyplot
 # from progressbar import ProgressBar
 
-from pdb_parser import distance, find_pdb_files, parse_pdb
-from wrappa import get_dehydrons
+import instrument
+import parse_cache
+# run_analysis, phosphorylation_in_desolvation, min_distance_to_dehydron and
+# summarize_pairs are also imported so existing callers can still find them here
+from analysis import (DEHYDRON_SOURCES, DESOLVATION_CUTOFF, analysis_inputs, analysis_parameters, analyze_pairs,
+                      min_distance_to_dehydron, phosphorylation_in_desolvation, run_analysis, summarize_pairs,
+                      sweep_structure)
+from pdb_parser import PARSERS, iter_pdb_files, set_parser_backend
 
-# RESIDUES_OF_INTEREST = ("TYR", "SER", "THR")#, "PTR", "SEP", "TPO")
-RESIDUES_OF_INTEREST = ("TYR")#, "PTR")
+__all__ = ["AnalysisTimeout", "analyze_files", "analyze_pdb_file", "configure_worker", "find_stale_files",
+           "main", "min_distance_to_dehydron", "parse_cutoffs", "phosphorylation_in_desolvation",
+           "print_sweep", "run_analysis", "source_name", "summarize_pairs"]
 
-def count_residues(pdb_data):
+class AnalysisTimeout(Exception):
     """
-    Count the number of different residues that occur in the PDB data.
+    Raised when the analysis of a single PDB file runs for too long.
     """
 
-    return {x: len(pdb_data.get_compounds([x])) for x in RESIDUES_OF_INTEREST}
+def _raise_timeout(signum, frame):
+    raise AnalysisTimeout()
 
-def get_dehydron_positions(pdb_data, dehydrons):
+def source_name(source):
     """
-    Converts a list of dehdyrons to a list of positions.
+    The PDB name of a source of a structure: either the path to a PDB file or
+    a (pdb_name, pdb contents, wrappers contents) tuple read from an archive
+    (see corpus.iter_archive).
     """
 
+    if isinstance(source, tuple):
+        return source[0]
+    return os.path.split(source[:-4])[1]
 
-    dehydron_positions = []
-    for dehydron in dehydrons:
-        residue1 = pdb_data.get_residue_by_id(dehydron[0][0], dehydron[0][1])
-        residue2 = pdb_data.get_residue_by_id(dehydron[1][0], dehydron[1][1])
-
-        position1 = residue1.get_atom("CA").position
-        position2 = residue2.get_atom("CA").position
-        dehydron_positions.append((position1, position2))
-    return dehydron_positions
-
-def phosphorylation_in_desolvation(pdb_data, sites, dehydrons):
+def analyze_pdb_file(job):
     """
-    This will identify all sites that fall within a desolvation domain of a dehydron.
-    This will return a list of tuples where the first element represents the phosphorylation
-    site and the second represents the dehydron which it is close to.
+    Run the analysis on a single PDB file. The job is a tuple of the source
+    (see source_name), the data directory, a timeout in seconds (or None),
+    the analysis function and a directory for cProfile stats (or None). The
+    analysis is called with the PDB name and data directory, plus the file
+    contents for a source read from an archive.
+
+    This never raises. It returns a tuple of the PDB name, the result, an
+    error message and the instrumentation summary (see
+    instrument.Recorder.summary); either the result or the error is None.
     """
 
-    results = []
-    errors = 0
-    for dehydron in dehydrons:
-        residue1 = pdb_data.get_residue_by_id(dehydron[0][0], dehydron[0][1])
-        residue2 = pdb_data.get_residue_by_id(dehydron[1][0], dehydron[1][1])
-
-        position1 = residue1.get_atom("CA").position
-        position2 = residue2.get_atom("CA").position
-
-        for site in sites:
-            try: 
-                phospo_position = site.get_atom("CA").position
-                distance1 = distance(position1, phospo_position)
-                distance2 = distance(position2, phospo_position)
-                if distance1 <= 6.5 and distance2 <= 6.5:
-                    results.append((site, (residue1, residue2)))
-            except AttributeError:
-                print site
-                errors+=1
-    print errors
-    return results
-
-def min_distance_to_dehydron(pdb_data, sites, dehydrons):
+    source, data_directory, timeout, analysis, profile_directory = job
+    pdb_name = source_name(source)
+    options = {"contents": source[1:]} if isinstance(source, tuple) else {}
+    recorder = instrument.Recorder()
+    profiler = None
+    if profile_directory is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    use_alarm = timeout is not None and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with instrument.recording(recorder):
+            if profiler is not None:
+                result = profiler.runcall(analysis, pdb_name, data_directory, **options)
+            else:
+                result = analysis(pdb_name, data_directory, **options)
+        return pdb_name, result, None, recorder.summary()
+    except AnalysisTimeout:
+        logging.error("Analysis of %s timed out after %s seconds", pdb_name, timeout)
+        return pdb_name, None, "Timed out after {} seconds".format(timeout), recorder.summary()
+    except Exception as e:
+        logging.exception("Analysis of %s failed", pdb_name)
+        return pdb_name, None, "{}: {}".format(type(e).__name__, e), recorder.summary()
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+        if profiler is not None:
+            profiler.dump_stats(os.path.join(profile_directory, pdb_name + ".prof"))
+
+def configure_worker(cache_dir, cache_size, parser):
     """
-    Get the minimum distance to a dehydron.
+    Set up the parse cache and the PDB parser backend in a worker process.
+    Workers that aren't forked from the parent (under the spawn or forkserver
+    start methods) don't inherit either.
     """
 
-    dehydron_positions = get_dehydron_positions(pdb_data, dehydrons)
-    results = []
-
-
-    for site in sites:
-        site_alpha = site.get_atom("CA")
-        if site_alpha is None:
-            continue
-        site_position = site_alpha.position
-        min_distance = float("inf")
-        for position1, position2 in dehydron_positions:
-            dist = (distance(position1, site_position) + distance(position2, site_position)) / 2.0
-            if dist < min_distance:
-                min_distance = dist
-        if min_distance != float("inf"):
-            results.append(min_distance)
-    return results
-
+    parse_cache.configure(cache_dir, cache_size)
+    set_parser_backend(parser)
 
-def run_analysis(pdb_name, data_directory):
+def analyze_files(pdb_files, data_directory, workers=1, chunksize=1, ordered=True, timeout=None,
+                  analysis=analyze_pairs, profile_directory=None, worker_setup=None):
+    """
+    Run an analysis (analyze_pairs by default) over many PDB files, yielding
+    the result of analyze_pdb_file for each one. A file that fails or times
+    out only produces an error result.
+
+    With more than one worker the files are spread over a process pool,
+    chunksize at a time, so the analysis must be picklable. worker_setup is
+    passed to configure_worker in each worker. If ordered is False results
+    are yielded as they finish rather than in the order of pdb_files.
+
+    pdb_files can be any iterable, so the directory is never listed up front.
+    It can also hold archive members (see source_name), whose contents are
+    sent to the workers with the jobs. If profile_directory is set each file
+    is profiled and its stats saved there as PDB_NAME.prof.
     """
-    This will run the analysis on a single pdb file. The PDB name should be a raw
-    PDB name (i.e. 1a81H) and the data directory should contain the following files:
-
-        1) PDB_NAME.pdb
-        2) PDB_NAME_wrappers.txt
-        3) PDB_NAME_bonds.txt
-
-    The analysis consists of the following substeps (all of which will be returned)
 
-        1) Count each occurance of a residue of interest (see above). Returns a dictionary
-           of the counts of each residue of interest.
-        2) Counts the number of phosphorylation sites. Returns an integer containing
-           the number of phosphorylation sites.
-        3) Generate a list of phosprohylation sites that are within a desolvation sphere
-           of a dehydron. Returns this list of tuples.
+    if profile_directory is not None and not os.path.isdir(profile_directory):
+        os.makedirs(profile_directory)
+    jobs = ((pdb_file, data_directory, timeout, analysis, profile_directory) for pdb_file in pdb_files)
+    if workers <= 1:
+        for job in jobs:
+            yield analyze_pdb_file(job)
+        return
+
+    import multiprocessing
+    if worker_setup is not None:
+        pool = multiprocessing.Pool(workers, configure_worker, worker_setup)
+    else:
+        pool = multiprocessing.Pool(workers)
+    try:
+        map_jobs = pool.imap if ordered else pool.imap_unordered
+        for result in map_jobs(analyze_pdb_file, jobs, chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def find_stale_files(pdb_files, store, stored, dehydron_source="wrappa", stale=None):
+    """
+    Yields the PDB files that have no up to date result in the results store
+    (all of them if store is None). The (pdb_name, pairs) of the rest are
+    appended to stored and, if stale is given, the names of the yielded files
+    to stale. The files are checked as they are consumed, so the directory
+    is never listed up front.
     """
 
-    logging.info("Running analysis for PDB %s", pdb_name)
+    for pdb_file in pdb_files:
+        pdb_name = source_name(pdb_file)
+        pairs = store.lookup(pdb_name, analysis_inputs(pdb_file, dehydron_source)) if store is not None else None
+        if pairs is None:
+            if stale is not None:
+                stale.append(pdb_name)
+            yield pdb_file
+        else:
+            stored.append((pdb_name, pairs))
+
+def parse_cutoffs(text):
+    """
+    Parse a list of cutoffs given either as comma separated values or as an
+    inclusive START:STOP:STEP range.
+    """
 
-    # Load all of the data
-    pdb_data = parse_pdb(os.path.join(data_directory, pdb_name + ".pdb"))
-    dehydrons = get_dehydrons(os.path.join(data_directory, pdb_name + "_wrappers.txt"))
+    if ":" in text:
+        start, stop, step = [float(x) for x in text.split(":")]
+        return [round(x, 6) for x in numpy.arange(start, stop + step / 2.0, step)]
+    return [float(x) for x in text.split(",")]
 
-    # Get the sites of interest
-    phospo_sites = pdb_data.get_phoso_sites()
-    #non_phospo_sites = pdb_data.get_compounds(names=["TYR", "THR", "SER"])
-    non_phospo_sites = pdb_data.get_compounds(names=["TYR"])
+def print_sweep(cutoffs, residue_sets, totals, structures):
+    """
+    Print the results of a sweep as a table with a row per residue set and a
+    column per cutoff. Each cell is the total number of (site, dehydron) pairs
+    and, in brackets, the number of structures with at least one.
+    """
 
-    #return min_distance_to_dehydron(pdb_data, non_phospo_sites, dehydrons)
-    #return count_residues(pdb_data), len(phospo_sites), phosphorylation_in_desolvation(pdb_data, phospo_sites, dehydrons)
-    return phosphorylation_in_desolvation(pdb_data, phospo_sites, dehydrons)
+    print("{:<16}".format("residues") + "".join("{:>16}".format(x) for x in cutoffs))
+    for residue_set, row, structure_row in zip(residue_sets, totals, structures):
+        cells = ["{} ({})".format(x, y) for x, y in zip(row, structure_row)]
+        print("{:<16}".format(",".join(residue_set)) + "".join("{:>16}".format(x) for x in cells))
 
 def main():
     """
@@ -132,41 +194,140 @@ def main():
     """
 
     parser = argparse.ArgumentParser(description="Analyze phosphorylation sites and dehydrons")
-    parser.add_argument("data_directory", help="The directory where the data is stored")
+    parser.add_argument("data_directory",
+                        help="The directory where the data is stored, or a tar archive of it (such as phospho.tar.gz)")
     parser.add_argument("--limit", default=None, type=int,
                         help="Set a limit on the number of files to process")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of worker processes to analyze files with")
+    parser.add_argument("--chunksize", default=1, type=int,
+                        help="Number of files handed to a worker at a time")
+    parser.add_argument("--unordered", action="store_true",
+                        help="Collect results as they finish instead of in file order")
+    parser.add_argument("--timeout", default=None, type=float,
+                        help="Give up on a single file after this many seconds")
+    parser.add_argument("--cache-dir", default=os.environ.get("PDB_PARSE_CACHE"),
+                        help="Cache parsed PDB and wrappers files in this directory")
+    parser.add_argument("--cache-size", default=parse_cache.DEFAULT_MAX_BYTES, type=int,
+                        help="Maximum size of the parse cache in bytes")
+    parser.add_argument("--parser", default="bulk", choices=sorted(PARSERS),
+                        help="How to read PDB files (mmap shares pages between worker processes)")
+    parser.add_argument("--dehydrons", default="wrappa", choices=DEHYDRON_SOURCES,
+                        help="Read dehydrons from the WRAPPA output or find them locally from the structure")
+    parser.add_argument("--cutoffs", default=None, type=parse_cutoffs,
+                        help="Sweep over these desolvation cutoffs (e.g. 5,6.5,8 or 4:8:0.5)")
+    parser.add_argument("--residue-sets", default=None, nargs="+",
+                        help="Sweep over these sets of site residues (e.g. PTR PTR,SEP,TPO)")
+    parser.add_argument("--output", default=None,
+                        help="Write per-site results as shards in this directory (see aggregate.py)")
+    parser.add_argument("--format", default="npz", choices=("npz", "csv"),
+                        help="File format of the result shards")
+    parser.add_argument("--plot", default=None, help="Save a histogram plot to this file")
+    parser.add_argument("--show", action="store_true", help="Show the histogram plot")
+    parser.add_argument("--timings", action="store_true",
+                        help="Print the time spent in each stage of the analysis")
+    parser.add_argument("--profile", default=None,
+                        help="Save cProfile stats for each file to this directory")
+    parser.add_argument("--results", default=None,
+                        help="Keep results in this file and only reanalyze files whose inputs changed")
     args = parser.parse_args()
+    if args.output is not None and (args.cutoffs is not None or args.residue_sets is not None):
+        parser.error("--output can't be used with a sweep")
+    archive = not os.path.isdir(args.data_directory)
+    if archive and args.results is not None:
+        parser.error("--results needs a data directory rather than an archive")
+
+    worker_setup = (args.cache_dir, args.cache_size, args.parser)
+    configure_worker(*worker_setup)
 
     # all_residue_counts = {x: 0 for x in RESIDUES_OF_INTEREST}
     # num_phospo_sites = []
     # all_pairs = {}
 
     # min_distances = []
-    phospho_sites_count = []
-    files = find_pdb_files(args.data_directory)
-    # with ProgressBar(maxval=len(files)) as progress:
-    # progress = ProgressBar(maxval=len(files))
-    for i, pdb_file in enumerate(files):
-        if args.limit is not None and i >= args.limit:
-            break
-
-            #residue_counts, num_sites, pairs = run_analysis(os.path.split(pdb_file[:-4])[1], args.data_directory)
-
-            # Merge in the data
-            # for x in RESIDUES_OF_INTEREST:
-            #     all_residue_counts[x] += residue_counts[x]
-            #
-            # num_phospo_sites.append(num_sites)
-            # all_pairs[os.path.split(pdb_file[:-4])] = pairs
-        # min_distances += run_analysis(os.path.split(pdb_file[:-4])[1], args.data_directory)
-        # progress.update(i)
-        phospho_sites_count.append(len(run_analysis(os.path.split(pdb_file[:-4])[1], args.data_directory)))
-    #progress.finish()
-    pyplot.hist(phospho_sites_count)
-    pyplot.xlabel('Number of phosphorylated TYR')
-    pyplot.ylabel('Number of occurrences')
-    pyplot.title('Number of phosphorylated TYR per PDB file')
-    pyplot.show()
+    failures = []
+    parameters = analysis_parameters(args.dehydrons)
+    analysis = functools.partial(analyze_pairs, dehydron_source=args.dehydrons)
+    sweep = args.cutoffs is not None or args.residue_sets is not None
+    if sweep:
+        cutoffs = args.cutoffs or [DESOLVATION_CUTOFF]
+        residue_sets = [tuple(x.split(",")) for x in args.residue_sets or ["PTR"]]
+        parameters.update(cutoffs=cutoffs, residue_sets=residue_sets)
+        analysis = functools.partial(sweep_structure, cutoffs=cutoffs, residue_sets=residue_sets,
+                                     dehydron_source=args.dehydrons)
+
+    if archive:
+        # Members are streamed out of the archive and their contents handed
+        # to the workers, so nothing is extracted
+        from corpus import iter_archive
+        files = itertools.islice(iter_archive(args.data_directory, wrappers=args.dehydrons != "local"), args.limit)
+    else:
+        files = itertools.islice(iter_pdb_files(args.data_directory), args.limit)
+    store = None
+    if args.results is not None:
+        from results_store import ResultsStore
+        store = ResultsStore(args.results, parameters)
+    # The stale files are streamed straight into the analysis; the stored
+    # results found along the way are collected once it is done
+    stored = []
+    stale = []
+    stale_files = find_stale_files(files, store, stored, args.dehydrons, stale)
+    all_results = []
+    sink = None
+    if args.output is not None:
+        from results_sink import ShardWriter
+        sink = ShardWriter(args.output, args.format)
+
+    results = analyze_files(stale_files, args.data_directory, workers=args.workers, chunksize=args.chunksize,
+                            ordered=not args.unordered, timeout=args.timeout, analysis=analysis,
+                            profile_directory=args.profile, worker_setup=worker_setup)
+    summaries = []
+    finished = False
+    try:
+        for pdb_name, pairs, error, summary in results:
+            summaries.append(summary)
+            if error is not None:
+                failures.append((pdb_name, error))
+                continue
+            all_results.append(pairs)
+            if sink is not None:
+                sink.write(pdb_name, pairs, summary)
+            if store is not None:
+                store.store(pdb_name, pairs)
+        for pdb_name, pairs in stored:
+            all_results.append(pairs)
+            if sink is not None:
+                sink.write(pdb_name, pairs)
+        finished = True
+    finally:
+        if sink is not None:
+            sink.close()
+        if store is not None:
+            # Only a complete pass over the directory knows which files are gone
+            if finished and args.limit is None:
+                store.prune([x[0] for x in stored] + stale)
+            store.save()
+    file_count = len(stale) + len(stored)
+    if store is not None:
+        logging.info("Reused %d stored results, analyzed %d files", len(stored), len(stale))
+    if failures:
+        logging.warning("Analysis failed for %d of %d files: %s", len(failures), file_count,
+                        ", ".join(x[0] for x in failures))
+    timings = instrument.format_summary(instrument.combine(summaries))
+    logging.info("Time spent analyzing %d files:\n%s", len(summaries), timings)
+    if args.timings:
+        print(timings)
+
+    if sweep:
+        counts = numpy.array(all_results, dtype=int).reshape(-1, len(residue_sets), len(cutoffs))
+        print_sweep(cutoffs, residue_sets, counts.sum(axis=0), (counts > 0).sum(axis=0))
+        return
+
+    from aggregate import pairs_histogram, plot_histogram, print_histogram
+    phospho_sites_count = [len(x) for x in all_results]
+    print_histogram(pairs_histogram(phospho_sites_count))
+    if args.plot is not None or args.show:
+        plot_histogram(phospho_sites_count, args.plot)
 
     # Display the final data
     #print(all_pairs)
@@ -2,4 +2,5 @@
 virtualenv env
 source env
 pip install -r requirements.txt
-cd data && tar -xvzf phospho.tar.gz
+# The analysis reads data/phospho.tar.gz as it is (run_analysis.py data/phospho.tar.gz),
+# so there is no need to extract it
@@ -0,0 +1,135 @@
+"""
+Checks that every PDB parser backend (and lazy parsing) produces exactly the
+same data as the original line by line parser, parse_pdb_text.
+
+    python -m unittest test_pdb_parser
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import pdb_parser
+from pdb_parser import parse_pdb_bulk, parse_pdb_mmap, parse_pdb_text
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE_PDB = os.path.join(REPOSITORY, "1a81H.pdb")
+
+ATOM_LINE = "ATOM      1  CA  ALA A  10      11.104  -6.134  20.507  1.00 10.00           C\n"
+
+
+def atom_rows(data):
+    """
+    Every atom of the data as a tuple of its fields.
+    """
+
+    return [(x.position, x.atom, x.compound, x.sequence_id, x.insertion_code, x.alt_id, x.chain_id)
+            for x in data.atoms]
+
+def compound_rows(compounds):
+    """
+    A list of compounds as tuples of their ID, chain, name and atom indices.
+    """
+
+    return [(x.compound_id, x.chain_id, x.name, list(x.atoms.indices)) for x in compounds]
+
+def residue_rows(groups):
+    """
+    A list of helixes or sheets (lists of compounds) as lists of compound IDs.
+    """
+
+    return [[(x.chain_id, x.compound_id) for x in group] for group in groups]
+
+class ParserParityTest(unittest.TestCase):
+    """
+    Parses a set of files with each backend and compares the results.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(EXAMPLE_PDB) as example:
+            self.lines = example.readlines()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        file_name = os.path.join(self.directory, name)
+        with open(file_name, "w") as pdb_file:
+            pdb_file.write(text)
+        return file_name
+
+    def assertSameData(self, expected, data):
+        self.assertEqual(atom_rows(expected), atom_rows(data))
+        self.assertTrue(numpy.array_equal(expected.atom_table.positions, data.atom_table.positions))
+        self.assertEqual(expected.helixes, data.helixes)
+        self.assertEqual(expected.sheets, data.sheets)
+        self.assertEqual(compound_rows(expected.get_compounds()), compound_rows(data.get_compounds()))
+        self.assertEqual([(compound_rows([x])[0], compound_rows([y])[0]) for x, y in expected.get_adjacent_compounds()],
+                         [(compound_rows([x])[0], compound_rows([y])[0]) for x, y in data.get_adjacent_compounds()])
+        self.assertEqual(residue_rows(expected.get_helixes()), residue_rows(data.get_helixes()))
+        self.assertEqual(residue_rows(expected.get_sheets()), residue_rows(data.get_sheets()))
+
+    def assertParsersAgree(self, file_name):
+        expected = parse_pdb_text(file_name)
+        for parse in (parse_pdb_bulk, parse_pdb_mmap):
+            for lazy in (False, True):
+                self.assertSameData(expected, parse(file_name, lazy=lazy))
+        return expected
+
+    def test_example(self):
+        data = self.assertParsersAgree(EXAMPLE_PDB)
+        self.assertEqual(len(data.atom_table), 24015)
+        self.assertEqual(len(data.helixes) + len(data.sheets), 96)
+
+    def test_two_models(self):
+        atoms = [x for x in self.lines if x[:6] in ("ATOM  ", "HETATM")]
+        other = [x[:30] + "{:8.3f}".format(float(x[30:38]) + 1) + x[38:] for x in atoms]
+        header = [x for x in self.lines if x[:5] in ("HELIX", "SHEET")]
+        file_name = self.write("models.pdb", "".join(header + ["MODEL        1\n"] + atoms + ["ENDMDL\n",
+                                                               "MODEL        2\n"] + other + ["ENDMDL\n", "END\n"]))
+        data = self.assertParsersAgree(file_name)
+        self.assertEqual(len(data.atom_table), len(atoms))
+
+    def test_short_trailing_lines(self):
+        helix = "HELIX    1   1 ALA A   10  ALA A   20  1"
+        for name, text in (("helix.pdb", "".join(self.lines) + helix + "\n"),
+                           ("helix_no_newline.pdb", "".join(self.lines) + helix),
+                           ("remark.pdb", "".join(self.lines[:-1]) + "REMARK   3  B VALUES.\nEND\n"),
+                           ("tiny.pdb", ATOM_LINE + "END\n"),
+                           ("tiny_helix.pdb", ATOM_LINE + helix),
+                           ("empty.pdb", "")):
+            data = self.assertParsersAgree(self.write(name, text))
+            if "helix" in name:
+                self.assertEqual(data.helixes[-1], ("A", "10", "20"))
+
+    def test_blank_coordinates(self):
+        # A blank coordinate is an error rather than an atom at the origin
+        file_name = self.write("blank.pdb", "".join(self.lines[:-1]) + ATOM_LINE[:38] + " " * 8 + ATOM_LINE[46:])
+        for parse in (parse_pdb_text, parse_pdb_bulk, parse_pdb_mmap):
+            self.assertRaises(ValueError, parse, file_name)
+
+    def test_secondary_structure_changes(self):
+        data = parse_pdb_text(self.write("tiny.pdb", ATOM_LINE))
+        self.assertEqual(data.get_residue_secondary_structure("10", "A"), pdb_parser.COIL)
+        data.add_helix("A", "5", "15")
+        self.assertEqual(data.get_residue_secondary_structure("10", "A"), pdb_parser.HELIX)
+        data.helixes = []
+        data.add_sheet("A", "10", "10")
+        self.assertEqual(data.get_residue_secondary_structure("10", "A"), pdb_parser.SHEET)
+
+    def test_streaming(self):
+        expected = parse_pdb_text(EXAMPLE_PDB)
+        for chunk_size in (4096, 1 << 16):
+            self.assertEqual(atom_rows(expected), [(x.position, x.atom, x.compound, x.sequence_id,
+                                                    x.insertion_code, x.alt_id, x.chain_id)
+                                                   for x in pdb_parser.iter_atoms(EXAMPLE_PDB, chunk_size)])
+            self.assertEqual([(x.chain_id, x.compound_id, x.name) for x in expected.get_compounds()],
+                             [(x.chain_id, x.compound_id, x.name)
+                              for x in pdb_parser.iter_residues(EXAMPLE_PDB, chunk_size)])
+
+if __name__ == "__main__":
+    unittest.main()
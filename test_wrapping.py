@@ -0,0 +1,47 @@
+"""
+Regression test for the local dehydron engine. Its criteria were tuned on
+1a81H, so it must keep finding exactly the dehydrons (and wrapper counts) in
+the wrappers.txt WRAPPA produced for that structure.
+
+    python -m unittest test_wrapping
+"""
+
+import os
+import unittest
+
+import numpy
+
+import wrapping
+from pdb_parser import parse_pdb
+from wrappa import DEHYDRON_WRAPPING, get_dehydrons, get_wrappers
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE_PDB = os.path.join(REPOSITORY, "1a81H.pdb")
+EXAMPLE_WRAPPERS = os.path.join(REPOSITORY, "wrappers.txt")
+
+
+class WrappaParityTest(unittest.TestCase):
+    """
+    Compares the local engine against the WRAPPA output for 1a81H.
+    """
+
+    def check(self, pdb_data):
+        self.assertEqual(wrapping.find_dehydrons(pdb_data), get_dehydrons(EXAMPLE_WRAPPERS))
+
+        donors, acceptors = wrapping.find_hydrogen_bonds(pdb_data)
+        alpha = wrapping.residue_atoms(pdb_data, ("CA",))
+        has_alpha = (alpha[donors] >= 0) & (alpha[acceptors] >= 0)
+        counts = wrapping.count_wrappers(pdb_data, donors[has_alpha], acceptors[has_alpha])
+        expected = get_wrappers(EXAMPLE_WRAPPERS).bonds["wrapper_counts"]
+        self.assertEqual(len(expected), 58)
+        self.assertTrue(numpy.array_equal(counts[counts < DEHYDRON_WRAPPING], expected))
+
+    def test_full_parse(self):
+        self.check(parse_pdb(EXAMPLE_PDB))
+
+    def test_wrapping_atoms(self):
+        # The analysis only loads the atoms the engine looks at
+        self.check(parse_pdb(EXAMPLE_PDB, atom_names=wrapping.WRAPPING_ATOMS))
+
+if __name__ == "__main__":
+    unittest.main()
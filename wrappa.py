@@ -1,21 +1,251 @@
+"""
+Functions for reading the output of WRAPPA.
+"""
+
+import gzip
+
+import numpy
+
+import parse_cache
+
+# Bump this whenever the parsed data changes so stale cache entries are ignored
+PARSER_VERSION = 1
+
+# Hydrogen bonds wrapped by fewer nonpolar groups than this are dehydrons
+DEHYDRON_WRAPPING = 19
+
+# Each line of a wrappers file describes one wrapper of a hydrogen bond
+BOND_ID = (0, 7)
+WRAPPER_NUMBER = (7, 11)
+
+# A wrapper line has three groups of the same columns: the wrapper atom, then
+# the donor and acceptor sites of the bond (blank when the wrapper is outside
+# that site's desolvation sphere). These are the offsets of each group.
+SITE_GROUPS = (("wrapper", 0), ("donor", 23), ("acceptor", 46))
+SITE_FIELDS = (("atom", 12, 16), ("flag", 17, 18), ("residue", 19, 22), ("chain_id", 23, 24),
+               ("sequence_id", 25, 29), ("insertion_code", 29, 30), ("secondary_structure", 31, 35))
+
+INTEGER_COLUMNS = ("bond", "number", "wrapper_starts", "sequence_id", "donor_sequence_id",
+                   "acceptor_sequence_id")
+BOOLEAN_COLUMNS = ("in_donor_sphere", "in_acceptor_sphere")
+
+
+class WrappersTable(object):
+    """
+    The hydrogen bonds in a wrappers file and the atoms wrapping them, stored
+    as columns of arrays.
+
+    bonds has a row per bond: bond_id, wrapper_starts and wrapper_counts, and
+    the atom, residue, chain_id, sequence_id, insertion_code and
+    secondary_structure of its donor and acceptor sites (prefixed with donor_
+    and acceptor_). wrappers has a row per wrapper: the row of the bond it
+    wraps, its number, the same site columns for the wrapper atom and whether
+    it is in the donor and acceptor desolvation spheres. The wrappers of bond i
+    are the rows wrapper_starts[i] to wrapper_starts[i + 1].
+    """
+
+    def __init__(self, bonds, wrappers):
+        self.bonds = bonds
+        self.wrappers = wrappers
+        self.bonds["wrapper_counts"] = numpy.diff(bonds["wrapper_starts"])
+
+        self.bond_index = dict((bond_id, i) for i, bond_id in enumerate(bonds["bond_id"].tolist()))
+        self.residue_bonds = {}
+        for role in ("donor", "acceptor"):
+            keys = zip(*[bonds[role + "_" + x].tolist() for x in ("chain_id", "sequence_id", "insertion_code")])
+            for i, (key, residue) in enumerate(zip(keys, bonds[role + "_residue"].tolist())):
+                bond_rows = self.residue_bonds.setdefault(key, [])
+                if residue and i not in bond_rows:
+                    bond_rows.append(i)
+        self.residue_wrappers = {}
+        keys = zip(*[wrappers[x].tolist() for x in ("chain_id", "sequence_id", "insertion_code")])
+        for i, key in enumerate(keys):
+            self.residue_wrappers.setdefault(key, []).append(i)
+
+    def __len__(self):
+        return len(self.bonds["bond_id"])
+
+    def bond(self, bond_id):
+        """
+        Get the row of a bond from its ID (e.g. HB_0001).
+        """
+
+        return self.bond_index[bond_id]
+
+    def wrapper_rows(self, bond_id):
+        """
+        Get the rows of the wrappers of a bond.
+        """
+
+        i = self.bond(bond_id)
+        return numpy.arange(self.bonds["wrapper_starts"][i], self.bonds["wrapper_starts"][i + 1])
+
+    def wrapping_count(self, bond_id):
+        """
+        Get the number of wrappers of a bond.
+        """
+
+        return int(self.bonds["wrapper_counts"][self.bond(bond_id)])
+
+    def underwrapped(self, threshold=DEHYDRON_WRAPPING):
+        """
+        Get the IDs of the bonds with fewer than threshold wrappers.
+        """
+
+        return self.bonds["bond_id"][self.bonds["wrapper_counts"] < threshold].tolist()
+
+    def bonds_of_residue(self, chain_id, sequence_id, insertion_code=""):
+        """
+        Get the IDs of the bonds a residue is the donor or acceptor of.
+        """
+
+        rows = self.residue_bonds.get((chain_id, int(sequence_id), insertion_code), [])
+        return self.bonds["bond_id"][numpy.array(rows, dtype=int)].tolist()
+
+    def wrapped_by_residue(self, chain_id, sequence_id, insertion_code=""):
+        """
+        Get the rows of the wrappers belonging to a residue.
+        """
+
+        return numpy.array(self.residue_wrappers.get((chain_id, int(sequence_id), insertion_code), []), dtype=int)
+
+    def dehydrons(self, threshold=None):
+        """
+        Get the donor and acceptor residues of each bond, in the same form as
+        get_dehydrons. If threshold is given only bonds with fewer wrappers
+        are included.
+        """
+
+        bonds = self.bonds
+        res = []
+        for i in range(len(self)):
+            if not bonds["donor_residue"][i] or not bonds["acceptor_residue"][i]:
+                continue
+            if threshold is not None and bonds["wrapper_counts"][i] >= threshold:
+                continue
+            res.append(((str(bonds["donor_sequence_id"][i]), str(bonds["donor_chain_id"][i])),
+                        (str(bonds["acceptor_sequence_id"][i]), str(bonds["acceptor_chain_id"][i]))))
+        return res
+
+def _column_array(name, values):
+    """
+    Convert a list of column values to an array of the right type.
+    """
+
+    if name in INTEGER_COLUMNS:
+        return numpy.array(values, dtype=int)
+    if name in BOOLEAN_COLUMNS:
+        return numpy.array(values, dtype=bool)
+    return numpy.array(values, dtype=str)
+
+def _read_site(line, offset):
+    """
+    Read one group of site columns from a wrapper line.
+    """
+
+    site = dict((name, line[start + offset:end + offset].strip()) for name, start, end in SITE_FIELDS)
+    site["sequence_id"] = int(site["sequence_id"]) if site["sequence_id"] else 0
+    return site
+
+def read_wrappers(file_name):
+    """
+    Read a WRAPPA wrappers file (optionally gzipped) into a WrappersTable.
+    """
+
+    if file_name.endswith(".gz"):
+        with gzip.open(file_name, "rb") as w:
+            return parse_wrappers(w)
+    with open(file_name) as w:
+        return parse_wrappers(w)
+
+def parse_wrappers(lines):
+    """
+    Parse the lines of a WRAPPA wrappers file (as strings or raw bytes) into a
+    WrappersTable.
+    """
+
+    bond_lines = {}
+    bond_ids = []
+    for line in lines:
+        if not isinstance(line, str):
+            line = line.decode("latin-1")
+        if line.find("HB_") == 0:
+            bond_id = line[BOND_ID[0]:BOND_ID[1]].strip()
+            if bond_id not in bond_lines:
+                bond_lines[bond_id] = []
+                bond_ids.append(bond_id)
+            bond_lines[bond_id].append(line)
+
+    site_names = [x[0] for x in SITE_FIELDS]
+    bonds = dict((role + "_" + name, []) for role, _ in SITE_GROUPS[1:] for name in site_names)
+    bonds["bond_id"] = bond_ids
+    bonds["wrapper_starts"] = [0]
+    wrappers = dict((name, []) for name in ["bond", "number"] + site_names + list(BOOLEAN_COLUMNS))
+    for bond, bond_id in enumerate(bond_ids):
+        sites = {}
+        for line in bond_lines[bond_id]:
+            wrappers["bond"].append(bond)
+            wrappers["number"].append(int(line[WRAPPER_NUMBER[0]:WRAPPER_NUMBER[1]]))
+            wrapper = _read_site(line, 0)
+            for name in site_names:
+                wrappers[name].append(wrapper[name])
+            for role, offset in SITE_GROUPS[1:]:
+                site = _read_site(line, offset)
+                wrappers["in_" + role + "_sphere"].append(bool(site["residue"]))
+                if site["residue"] and role not in sites:
+                    sites[role] = site
+        bonds["wrapper_starts"].append(len(wrappers["bond"]))
+        for role, offset in SITE_GROUPS[1:]:
+            site = sites.get(role) or _read_site("", offset)
+            for name in site_names:
+                bonds[role + "_" + name].append(site[name])
+
+    return WrappersTable(dict((name, _column_array(name, x)) for name, x in bonds.items()),
+                         dict((name, _column_array(name, x)) for name, x in wrappers.items()))
+
+def _wrappers_to_arrays(table):
+    """
+    Split a WrappersTable into arrays and metadata for the parse cache. String
+    columns go in the metadata so they come back as native strings.
+    """
+
+    arrays = {}
+    meta = {"bonds": {}, "wrappers": {}}
+    for part in ("bonds", "wrappers"):
+        for name, values in getattr(table, part).items():
+            if values.dtype.kind in "SU":
+                meta[part][name] = values.tolist()
+            elif name != "wrapper_counts":
+                arrays[part + "-" + name] = values
+    return arrays, meta
+
+def _wrappers_from_arrays(arrays, meta):
+    """
+    Rebuild a WrappersTable stored in the parse cache.
+    """
+
+    parts = {}
+    for part in ("bonds", "wrappers"):
+        columns = dict((name, _column_array(name, values)) for name, values in meta[part].items())
+        for key, values in arrays.items():
+            if key.startswith(part + "-"):
+                columns[key[len(part) + 1:]] = values
+        parts[part] = columns
+    return WrappersTable(parts["bonds"], parts["wrappers"])
+
+def get_wrappers(file_name):
+    """
+    Read a wrappers file into a WrappersTable. Results are served from the
+    parse cache when it is enabled.
+    """
+
+    return parse_cache.cached_parse(file_name, "wrappers", PARSER_VERSION, read_wrappers,
+                                    _wrappers_to_arrays, _wrappers_from_arrays)
+
 def get_dehydrons(file_name):
     """
     Given a wrapping file returns a list of a pairs of residue numbers that represent
-    dehydrons.
+    dehydrons, one for each bond in the file.
     """
 
-    a_prev = None
-    b_prev = None
-    res = []
-    with open(file_name) as w:
-        for line in w:
-            if line.find("HB_") == 0:
-                a = line[48:52].strip()
-                b = line[71:75].strip()
-                chain_a = line[46:47].strip()
-                chain_b = line[69:70].strip()
-                if a and b and a != a_prev and b != b_prev:
-                    a_prev = a
-                    b_prev = b
-                    res.append(((a, chain_a), (b, chain_b)))
-    return res
+    return get_wrappers(file_name).dehydrons()
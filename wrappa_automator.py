@@ -1,46 +1,143 @@
 #!/usr/bin/env python
 """
-This is a script that will run wrappa (through the web interface) on a large
-set of files.
+This is a script that will run wrappa on a large set of files. Every PDB file
+is a job in a persistent queue (a JSON file next to the data), so a run that
+is interrupted picks up where it stopped. Jobs are handed to a number of
+concurrent workers, each with its own backend: the wrappa web interface
+(through selenium), a local command or a local stand-in service speaking
+HTTP. Failed jobs are retried with an exponential backoff.
+
+For every PDB_NAME.pdb the outputs are PDB_NAME_wrappers.txt and
+PDB_NAME_bonds.txt. Both are written to a temporary file first and renamed
+into place, the bonds file last, so an existing bonds file means the job
+finished.
 """
 
+import argparse
+import heapq
+import itertools
+import json
 import logging
 import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from parse_cache import native_strings, write_json
+from pdb_parser import iter_pdb_files
+
+try:
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import HTTPError, Request, urlopen
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+QUEUE_VERSION = 1
+
+# Job states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# Too large for the backend; the reason is kept as the job's error
+SKIPPED = "skipped"
 
-from pdb_parser import find_pdb_files
-from selenium import webdriver
+# The outputs of a job, in the order they are written
+OUTPUTS = ("wrappers", "bonds")
 
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds to wait before the first retry; doubled for every later one
+DEFAULT_BACKOFF = 30.0
 
-def save_page_as(browser, file_name):
+
+def output_files(pdb_file):
     """
-    Save the output of a page.
+    The output files of a PDB file, as a dictionary from output name to path.
     """
 
-    with open(file_name, "w") as fout:
-        fout.write(browser.find_element_by_tag_name("pre").text)
+    return dict((name, pdb_file[:-4] + "_" + name + ".txt") for name in OUTPUTS)
 
-def run_wrappa(browser, pdb_file):
+def write_outputs(pdb_file, outputs):
     """
-    This will run through all of the web interface using selenium. The input
-    should be a pdb_file full path. It will download the wrappers/bonds as
-    PDB_NAME_wrappers.txt and PDB_NAME_bonds.txt.
+    Atomically write the outputs of a job (a dictionary of output name to
+    text) next to the PDB file. Each output is written under a temporary name
+    and renamed, the bonds file last, so a partial run never leaves behind a
+    half written file or a bonds file without its wrappers.
     """
 
-    # Wrappa has 3 MB limit
-    if os.path.getsize(pdb_file) > 3000000:
-        logging.warn("%s is too large (size is %d), skipping", pdb_file, os.path.getsize(pdb_file))
-        return False
-    if os.path.isfile(pdb_file[:-4] + "_bonds.txt"):
-        logging.warn("%s has already been processed, skipping", pdb_file)
-        return False
+    directory = os.path.dirname(os.path.abspath(pdb_file))
+    files = output_files(pdb_file)
+    for name in OUTPUTS:
+        file_name = files[name]
+        handle, temp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                text = outputs[name]
+                temp_file.write(text if isinstance(text, bytes) else text.encode("utf-8"))
+            os.rename(temp_name, file_name)
+        except Exception:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
 
-    full_path = os.path.abspath(pdb_file)
-    directory, file_name = os.path.split(full_path)
-    pdb_name = file_name[:-4]
+class JobError(Exception):
+    """
+    Raised by a backend when a job can't succeed no matter how often it is
+    retried (for instance a file that is too large).
+    """
 
-    try:
+class WebBackend(object):
+    """
+    Runs wrappa through the web interface using selenium. Each instance
+    drives its own browser. Wrappa has a 3 MB limit on uploads.
+    """
+
+    max_size = 3000000
+
+    def __init__(self):
+        self.browser = None
+
+    def open(self):
+        """
+        Start the browser and accept the terms of use.
+        """
+
+        from selenium import webdriver
+
+        self.browser = webdriver.Firefox()
+        self.browser.get("http://www.wrappa.org/")
+        self.browser.find_element_by_name("termsAccepted").click()
+        self.browser.find_element_by_name("termsAccepted").submit()
+
+    def close(self):
+        if self.browser is not None:
+            self.browser.close()
+            self.browser = None
+
+    def page_text(self):
+        """
+        Get the output on the current page.
+        """
+
+        return self.browser.find_element_by_tag_name("pre").text
+
+    def run(self, pdb_file):
+        """
+        Submit a PDB file and return its outputs (see OUTPUTS).
+        """
+
+        browser = self.browser
         browser.get("http://www.wrappa.org/wrappa01/wrappa")
-        browser.find_element_by_name("pdbFileName").send_keys(full_path)
+        browser.find_element_by_name("pdbFileName").send_keys(os.path.abspath(pdb_file))
         browser.find_element_by_xpath("//*[@type='submit']").click()
         # Use the default configuration
         browser.find_element_by_xpath("//*[@type='submit']").click()
@@ -48,50 +145,459 @@ def run_wrappa(browser, pdb_file):
         browser.find_element_by_xpath("//*[@type='submit']").click()
         # Download the files created
         browser.find_element_by_link_text("Bonds").click()
-        save_page_as(browser, os.path.join(directory, pdb_name + "_wrappers.txt"))
+        wrappers = self.page_text()
         browser.back()
         browser.find_element_by_link_text("Wrappers").click()
-        save_page_as(browser, os.path.join(directory, pdb_name + "_bonds.txt"))
+        bonds = self.page_text()
+        return {"wrappers": wrappers, "bonds": bonds}
+
+class CommandBackend(object):
+    """
+    Runs a local command for every job. The command is a list of arguments in
+    which {pdb_file} and {output_directory} are replaced by the path of the
+    PDB file and a fresh temporary directory. The command should write
+    PDB_NAME_wrappers.txt and PDB_NAME_bonds.txt into that directory.
+    """
+
+    max_size = None
+
+    def __init__(self, command):
+        self.command = command
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def run(self, pdb_file):
+        output_directory = tempfile.mkdtemp(suffix=".wrappa")
+        try:
+            pdb_file = os.path.abspath(pdb_file)
+            command = [x.format(pdb_file=pdb_file, output_directory=output_directory) for x in self.command]
+            if sys.version_info[0] >= 3:
+                # Run in a session of its own so Ctrl-C lets the job finish
+                subprocess.check_call(command, start_new_session=True)
+            else:
+                # preexec_fn isn't safe with threads; a command killed by
+                # Ctrl-C is put back in the queue by run_job instead
+                subprocess.check_call(command)
+            outputs = {}
+            pdb_name = os.path.basename(pdb_file)[:-4]
+            for name in OUTPUTS:
+                with open(os.path.join(output_directory, pdb_name + "_" + name + ".txt"), "rb") as output:
+                    outputs[name] = output.read()
+            return outputs
+        finally:
+            shutil.rmtree(output_directory, ignore_errors=True)
+
+class ServiceBackend(object):
+    """
+    Posts every PDB file to a local stand-in for the wrappa web site. The
+    service should answer with a JSON object holding the text of each output
+    (see OUTPUTS). A file the service rejects (a 4xx response) isn't retried.
+    """
+
+    max_size = None
+
+    def __init__(self, url, timeout=600):
+        self.url = url
+        self.timeout = timeout
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def run(self, pdb_file):
+        with open(pdb_file, "rb") as pdb:
+            request = Request(self.url, pdb.read(), {"Content-Type": "chemical/x-pdb",
+                                                     "X-PDB-Name": os.path.basename(pdb_file)})
+        try:
+            response = urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            if 400 <= e.code < 500:
+                raise JobError("Rejected by the service (HTTP {})".format(e.code))
+            raise
+        try:
+            outputs = native_strings(json.loads(response.read().decode("utf-8")))
+        finally:
+            response.close()
+        return dict((name, outputs[name]) for name in OUTPUTS)
+
+class JobQueue(object):
+    """
+    The state of every job (keyed by PDB file), kept in a JSON file. A job is
+    pending, running, done, failed or skipped; a failed job is retried after
+    a backoff until it runs out of attempts. Jobs that were running when a
+    previous run stopped go back to pending. All methods are safe to call from
+    several threads.
+
+    Every change of state is appended to a journal (FILE_NAME.journal) as a
+    line of JSON rather than rewriting the whole file, and the pending jobs
+    are kept in a heap ordered by when they are due, so claiming and updating
+    a job doesn't get slower as the queue grows. The journal is folded back
+    into the file (atomically) once it has as many lines as there are jobs,
+    and by save.
+    """
+
+    def __init__(self, file_name, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff=DEFAULT_BACKOFF):
+        self.file_name = file_name
+        self.journal_name = file_name + ".journal"
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.jobs = {}
+        self.order = []
+        self.lock = threading.Lock()
+        try:
+            with open(file_name) as queue_file:
+                stored = native_strings(json.load(queue_file))
+            if stored.get("version") == QUEUE_VERSION:
+                self.order = stored["order"]
+                self.jobs = stored["jobs"]
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        self._replay_journal()
+        for pdb_file, job in self.jobs.items():
+            if job["state"] == RUNNING:
+                logging.info("Resuming interrupted job %s", pdb_file)
+                job["state"] = PENDING
+        # Jobs due at the same time are claimed in the order they were pushed
+        self.sequence = itertools.count()
+        self.pending = [(job["not_before"], next(self.sequence), x) for x in self.order
+                        for job in [self.jobs[x]] if job["state"] == PENDING]
+        heapq.heapify(self.pending)
+        self.journal = None
+        self.journal_lines = 0
+        self._save()
+
+    def _replay_journal(self):
+        """
+        Apply the changes recorded in the journal since the file was last
+        written. A line cut short by a crash is ignored.
+        """
+
+        try:
+            with open(self.journal_name) as journal:
+                for line in journal:
+                    try:
+                        pdb_file, job = native_strings(json.loads(line))
+                    except ValueError:
+                        break
+                    if pdb_file in self.jobs:
+                        self.jobs[pdb_file] = job
+        except (IOError, OSError):
+            pass
+
+    def _save(self):
+        """
+        Write every job to the file and empty the journal. The caller must
+        hold the lock (or be the only user of the queue).
+        """
+
+        write_json(self.file_name, {"version": QUEUE_VERSION, "order": self.order, "jobs": self.jobs})
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_name, "w")
+        self.journal_lines = 0
+
+    def _record(self, pdb_file):
+        """
+        Append the current state of a job to the journal. The caller must hold
+        the lock.
+        """
+
+        self.journal.write(json.dumps([pdb_file, self.jobs[pdb_file]]) + "\n")
+        self.journal.flush()
+        self.journal_lines += 1
+        if self.journal_lines >= max(len(self.jobs), 100):
+            self._save()
+
+    def _push(self, pdb_file):
+        """
+        Put a pending job on the heap. The caller must hold the lock.
+        """
+
+        heapq.heappush(self.pending, (self.jobs[pdb_file]["not_before"], next(self.sequence), pdb_file))
+
+    def save(self):
+        """
+        Write every job to the file and empty the journal.
+        """
+
+        with self.lock:
+            self._save()
+
+    def close(self):
+        """
+        Save the queue and remove the journal.
+        """
+
+        with self.lock:
+            self._save()
+            self.journal.close()
+            self.journal = None
+            os.remove(self.journal_name)
+
+    def add(self, pdb_file, done=False):
+        """
+        Add a job unless it is already queued. Returns whether it was added.
+        New jobs are only written out by the next save.
+        """
+
+        with self.lock:
+            if pdb_file in self.jobs:
+                return False
+            self.jobs[pdb_file] = {"state": DONE if done else PENDING, "attempts": 0, "not_before": 0.0,
+                                   "error": None}
+            self.order.append(pdb_file)
+            if not done:
+                self._push(pdb_file)
+            return True
+
+    def retry_failed(self):
+        """
+        Give every failed (or skipped) job a fresh set of attempts.
+        """
+
+        with self.lock:
+            for pdb_file, job in self.jobs.items():
+                if job["state"] in (FAILED, SKIPPED):
+                    job.update(state=PENDING, attempts=0, not_before=0.0)
+                    self._push(pdb_file)
+            self._save()
+
+    def claim(self):
+        """
+        Take the next pending job that is due and mark it running. Returns a
+        tuple of the PDB file (None if no job is due) and how many seconds
+        until the next pending job is due (None if there are no pending jobs).
+        """
+
+        with self.lock:
+            if not self.pending:
+                return None, None
+            not_before, _, pdb_file = self.pending[0]
+            now = time.time()
+            if not_before > now:
+                return None, not_before - now
+            heapq.heappop(self.pending)
+            job = self.jobs[pdb_file]
+            job["state"] = RUNNING
+            job["attempts"] += 1
+            self._record(pdb_file)
+            return pdb_file, 0.0
+
+    def finish(self, pdb_file):
+        with self.lock:
+            self.jobs[pdb_file].update(state=DONE, error=None)
+            self._record(pdb_file)
+
+    def fail(self, pdb_file, error, retry=True):
+        """
+        Record a failed attempt. The job is retried after a backoff unless
+        retry is false or it has used up its attempts.
+        """
+
+        with self.lock:
+            job = self.jobs[pdb_file]
+            job["error"] = error
+            if retry and job["attempts"] < self.max_attempts:
+                job["state"] = PENDING
+                job["not_before"] = time.time() + self.backoff * 2 ** (job["attempts"] - 1)
+                self._push(pdb_file)
+            else:
+                job["state"] = FAILED
+            self._record(pdb_file)
+            return job["state"]
+
+    def skip(self, pdb_file, reason):
+        """
+        Record that a job was skipped (and why) rather than run.
+        """
+
+        with self.lock:
+            self.jobs[pdb_file].update(state=SKIPPED, error=reason)
+            self._record(pdb_file)
+
+    def release(self, pdb_file):
+        """
+        Put a running job back without counting the attempt (for a job cut
+        short by stopping the run).
+        """
+
+        with self.lock:
+            job = self.jobs[pdb_file]
+            job.update(state=PENDING, attempts=job["attempts"] - 1)
+            self._push(pdb_file)
+            self._record(pdb_file)
+
+    def counts(self):
+        """
+        The number of jobs in each state.
+        """
+
+        with self.lock:
+            counts = dict((x, 0) for x in (PENDING, RUNNING, DONE, FAILED, SKIPPED))
+            for job in self.jobs.values():
+                counts[job["state"]] += 1
+            return counts
+
+def run_job(backend, queue, pdb_file, stop=None):
+    """
+    Run a single job with a backend and record the outcome in the queue.
+    Returns whether it succeeded. A job that fails once stop is set, or whose
+    command was killed by Ctrl-C, is put back without using an attempt.
+    """
+
+    if backend.max_size is not None and os.path.getsize(pdb_file) > backend.max_size:
+        logging.warning("%s is too large (size is %d), skipping", pdb_file, os.path.getsize(pdb_file))
+        queue.skip(pdb_file, "Too large ({} bytes)".format(os.path.getsize(pdb_file)))
+        return False
+    try:
+        write_outputs(pdb_file, backend.run(pdb_file))
+    except JobError as e:
+        logging.error("Giving up on %s: %s", pdb_file, e)
+        queue.fail(pdb_file, str(e), retry=False)
+        return False
     except Exception as e:
-        logging.exception(e)
-        logging.error("Encounterd exception for %s", pdb_file)
+        interrupted = getattr(e, "returncode", None) == -signal.SIGINT
+        if interrupted or (stop is not None and stop.is_set()):
+            logging.info("Stopped while processing %s, will run it again", pdb_file)
+            queue.release(pdb_file)
+            return False
+        logging.exception("Encountered exception for %s", pdb_file)
+        state = queue.fail(pdb_file, "{}: {}".format(type(e).__name__, e))
+        if state == PENDING:
+            logging.info("Will retry %s", pdb_file)
         return False
-
+    queue.finish(pdb_file)
+    logging.info("Processed %s", pdb_file)
     return True
 
-def process_directory(browser, directory):
+def worker(make_backend, queue, stop, finished=None):
     """
-    Process an entire directory.
+    Process jobs from the queue until there are none left (or stop is set),
+    using a backend of its own. If finished (a Queue) is given, None is put on
+    it when the worker is done.
     """
 
-    count = 0
-    for pdb in find_pdb_files(directory):
-        if run_wrappa(browser, pdb):
-            logging.info("Processed %s", pdb)
-            count += 1
-    logging.info("Fully processed %d pdb files", count)
+    backend = make_backend()
+    backend.open()
+    try:
+        while not stop.is_set():
+            pdb_file, wait = queue.claim()
+            if pdb_file is not None:
+                run_job(backend, queue, pdb_file, stop)
+            elif wait is None:
+                return
+            else:
+                stop.wait(min(wait, 1.0))
+    finally:
+        backend.close()
+        if finished is not None:
+            finished.put(None)
 
-def initialize():
+def queue_directory(queue, directory):
     """
-    Initialize the browser and logging
+    Add a job for every PDB file in a directory. Files that already have
+    their outputs are recorded as done.
     """
 
-    logging.basicConfig(level=logging.INFO)
+    added = 0
+    for pdb_file in sorted(iter_pdb_files(directory)):
+        pdb_file = os.path.abspath(pdb_file)
+        if queue.add(pdb_file, done=os.path.isfile(output_files(pdb_file)["bonds"])):
+            added += 1
+    queue.save()
+    return added
+
+def process_directory(make_backend, directory, workers=1, queue_file=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                      backoff=DEFAULT_BACKOFF, retry_failed=False):
+    """
+    Process an entire directory with workers concurrent workers, each using
+    a backend made by make_backend. The job queue is kept in queue_file
+    (DIRECTORY/wrappa_jobs.json by default). Returns the number of jobs in
+    each state at the end.
+    """
 
-    browser = webdriver.Firefox()
-    browser.get("http://www.wrappa.org/")
-    browser.find_element_by_name("termsAccepted").click()
-    browser.find_element_by_name("termsAccepted").submit()
-    return browser
+    if queue_file is None:
+        queue_file = os.path.join(directory, "wrappa_jobs.json")
+    queue = JobQueue(queue_file, max_attempts, backoff)
+    if retry_failed:
+        queue.retry_failed()
+    logging.info("Queued %d new pdb files", queue_directory(queue, directory))
+
+    stop = threading.Event()
+    finished = Queue()
+    threads = [threading.Thread(target=worker, args=(make_backend, queue, stop, finished)) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        # Wait with a timeout so Ctrl-C is noticed. This doesn't join the
+        # threads, as a join interrupted by Ctrl-C can leave a thread looking
+        # finished when it isn't.
+        finished_count = 0
+        while finished_count < len(threads):
+            try:
+                finished.get(timeout=0.5)
+                finished_count += 1
+            except Empty:
+                pass
+    except KeyboardInterrupt:
+        logging.warning("Interrupted, waiting for running jobs to finish")
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    queue.close()
+    counts = queue.counts()
+    logging.info("Fully processed %d pdb files (%d failed, %d skipped, %d pending)", counts[DONE], counts[FAILED],
+                 counts[SKIPPED], counts[PENDING] + counts[RUNNING])
+    return counts
 
 def main():
     """
     Run the main functionality of this script.
     """
 
-    browser = initialize()
-    process_directory(browser, "data")
-    browser.close()
+    parser = argparse.ArgumentParser(description="Run wrappa on every PDB file in a directory")
+    parser.add_argument("directory", nargs="?", default="data", help="The directory of PDB files")
+    parser.add_argument("--workers", default=1, type=int, help="Number of jobs to run at once")
+    parser.add_argument("--backend", default="web", choices=("web", "command", "service"),
+                        help="Run wrappa through the web site, a local command or a local service")
+    parser.add_argument("--command", nargs="+", default=None,
+                        help="The command for the command backend ({pdb_file} and {output_directory} are "
+                             "replaced)")
+    parser.add_argument("--url", default=None, help="The URL of the service backend")
+    parser.add_argument("--queue", default=None, help="The job queue file (DIRECTORY/wrappa_jobs.json)")
+    parser.add_argument("--max-attempts", default=DEFAULT_MAX_ATTEMPTS, type=int,
+                        help="Give up on a file after this many attempts")
+    parser.add_argument("--backoff", default=DEFAULT_BACKOFF, type=float,
+                        help="Seconds to wait before retrying a failed file (doubled every retry)")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Try files that failed (or were skipped) before again")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+
+    if args.backend == "command":
+        if not args.command:
+            parser.error("--command is required for the command backend")
+        make_backend = lambda: CommandBackend(args.command)
+    elif args.backend == "service":
+        if not args.url:
+            parser.error("--url is required for the service backend")
+        make_backend = lambda: ServiceBackend(args.url)
+    else:
+        make_backend = WebBackend
+
+    counts = process_directory(make_backend, args.directory, args.workers, args.queue, args.max_attempts,
+                               args.backoff, args.retry_failed)
+    if counts[FAILED]:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,227 @@
+"""
+A local implementation of the WRAPPA dehydron analysis, working straight from
+the coordinates in a PDBData rather than from the output of the WRAPPA web
+site. Backbone hydrogen bonds are found geometrically and each one is wrapped
+by the nonpolar carbons within a desolvation sphere around the alpha carbons
+of its donor and acceptor residues. Bonds wrapped by too few carbons are
+dehydrons.
+
+The criteria are tuned so that the dehydrons (and the wrapper count of every
+dehydron) found for 1a81H match the wrappers.txt WRAPPA produced for it.
+"""
+
+import numpy
+
+from pdb_parser import CellList
+from wrappa import DEHYDRON_WRAPPING
+
+# Bump this whenever the dehydrons found change so stored results are recomputed
+WRAPPING_VERSION = 1
+
+# Radius of the desolvation sphere around each alpha carbon of a bond
+DESOLVATION_RADIUS = 6.5
+
+# Backbone hydrogen bonds: the donor N and acceptor O must be within
+# HBOND_DISTANCE, the amide hydrogen within HBOND_H_DISTANCE of the O, the
+# N-H...O angle at least HBOND_ANGLE and the C=O...H angle at least
+# HBOND_ACCEPTOR_ANGLE (angles in degrees)
+HBOND_DISTANCE = 3.5
+HBOND_H_DISTANCE = 2.5
+HBOND_ANGLE = 118.0
+HBOND_ACCEPTOR_ANGLE = 110.0
+# Residues closer than this along a chain don't form backbone hydrogen bonds
+HBOND_MIN_SEPARATION = 3
+
+# Amide hydrogens that aren't in the file are placed this far from the N
+NH_BOND_LENGTH = 1.01
+# Longest C-N distance that still counts as a peptide bond
+PEPTIDE_BOND_LENGTH = 2.0
+
+# The carbons of each standard residue that aren't bonded to a nitrogen or
+# oxygen. Carbons of other residues (such as PTR) are not counted.
+NONPOLAR_CARBONS = {
+    "ALA": ("CB",),
+    "ARG": ("CB", "CG"),
+    "ASN": ("CB",),
+    "ASP": ("CB",),
+    "CYS": ("CB",),
+    "GLN": ("CB", "CG"),
+    "GLU": ("CB", "CG"),
+    "HIS": ("CB",),
+    "ILE": ("CB", "CG1", "CG2", "CD1"),
+    "LEU": ("CB", "CG", "CD1", "CD2"),
+    "LYS": ("CB", "CG", "CD"),
+    "MET": ("CB", "CG", "CE"),
+    "PHE": ("CB", "CG", "CD1", "CD2", "CE1", "CE2", "CZ"),
+    "PRO": ("CB", "CG"),
+    "THR": ("CG2",),
+    "TRP": ("CB", "CG", "CD2", "CE3", "CZ2", "CZ3", "CH2"),
+    "TYR": ("CB", "CG", "CD1", "CD2", "CE1", "CE2"),
+    "VAL": ("CB", "CG1", "CG2"),
+}
+
+BACKBONE_ATOMS = ("N", "CA", "C", "O")
+AMIDE_HYDROGENS = ("H", "HN")
+# Every atom the analysis looks at, for restricting what gets parsed
+WRAPPING_ATOMS = tuple(sorted(set(BACKBONE_ATOMS + AMIDE_HYDROGENS).union(*NONPOLAR_CARBONS.values())))
+
+# Alternate locations other than the first are ignored
+ALT_IDS = ("", "A", "1")
+
+
+def _unit(vectors):
+    """
+    Normalize an (N, 3) array of vectors.
+    """
+
+    return vectors / numpy.linalg.norm(vectors, axis=1)[:, numpy.newaxis]
+
+def _angles(first, vertex, second):
+    """
+    The angles (in degrees) first-vertex-second for arrays of positions.
+    """
+
+    cosines = numpy.einsum("ij,ij->i", _unit(first - vertex), _unit(second - vertex))
+    return numpy.degrees(numpy.arccos(numpy.clip(cosines, -1.0, 1.0)))
+
+def residue_atoms(pdb_data, atom_names):
+    """
+    Find an atom with one of atom_names in every residue of the data. Returns
+    an array with the index of the atom for each residue of the residue index
+    (-1 for residues without one). Where a residue has several, the first
+    name in atom_names wins and then the first atom in the file.
+    """
+
+    table = pdb_data.atom_table
+    index = pdb_data.get_residue_index()
+    found = numpy.full(len(index), -1, dtype=numpy.int64)
+    usable = table.mask("alt_id", ALT_IDS)
+    for name in reversed(atom_names):
+        atoms = numpy.flatnonzero(table.mask("atom", (name,)) & usable)
+        residues = numpy.searchsorted(index.starts, atoms, side="right") - 1
+        # Keep the first atom of each residue
+        residues, first = numpy.unique(residues, return_index=True)
+        found[residues] = atoms[first]
+    return found
+
+def nonpolar_carbons(pdb_data):
+    """
+    The indices of the atoms that can wrap a hydrogen bond (see
+    NONPOLAR_CARBONS).
+    """
+
+    table = pdb_data.atom_table
+    compounds = table.categories["compound"]
+    atoms = table.categories["atom"]
+    lookup = numpy.zeros((len(compounds) + 1, len(atoms) + 1), dtype=bool)
+    for i, compound in enumerate(compounds):
+        carbons = NONPOLAR_CARBONS.get(compound, ())
+        for j, atom in enumerate(atoms):
+            lookup[i, j] = atom in carbons
+    selected = lookup[table.codes("compound").astype(numpy.int64), table.codes("atom").astype(numpy.int64)]
+    return numpy.flatnonzero(selected & table.mask("alt_id", ALT_IDS))
+
+def amide_hydrogen_positions(pdb_data, backbone=None):
+    """
+    The position of the amide hydrogen of every residue (NaN where there is
+    none). Hydrogens in the file are used as they are; otherwise a hydrogen is
+    placed on the N of any non-proline residue that is peptide bonded to the
+    residue before it, along the bisector of the C-N-CA angle.
+    """
+
+    if backbone is None:
+        backbone = dict((name, residue_atoms(pdb_data, (name,))) for name in BACKBONE_ATOMS)
+    positions = pdb_data.atom_table.positions
+    index = pdb_data.get_residue_index()
+    hydrogens = numpy.full((len(index), 3), numpy.nan)
+
+    given = residue_atoms(pdb_data, AMIDE_HYDROGENS)
+    has_hydrogen = given >= 0
+    hydrogens[has_hydrogen] = positions[given[has_hydrogen]]
+
+    previous, residues = index.adjacent_pairs().T
+    names = numpy.array(index.names, dtype=object)
+    place = (~has_hydrogen[residues] & (names[residues] != "PRO") & (backbone["C"][previous] >= 0) &
+             (backbone["N"][residues] >= 0) & (backbone["CA"][residues] >= 0))
+    previous, residues = previous[place], residues[place]
+    carbon = positions[backbone["C"][previous]]
+    nitrogen = positions[backbone["N"][residues]]
+    alpha = positions[backbone["CA"][residues]]
+    bonded = numpy.linalg.norm(nitrogen - carbon, axis=1) <= PEPTIDE_BOND_LENGTH
+    carbon, nitrogen, alpha, residues = carbon[bonded], nitrogen[bonded], alpha[bonded], residues[bonded]
+    hydrogens[residues] = nitrogen + NH_BOND_LENGTH * _unit(_unit(nitrogen - carbon) + _unit(nitrogen - alpha))
+    return hydrogens
+
+def find_hydrogen_bonds(pdb_data):
+    """
+    Find the backbone hydrogen bonds in the data. Returns two arrays with the
+    donor (N-H) and acceptor (C=O) residue of each bond, as indices into the
+    residue index. Bonds are ordered the way WRAPPA numbers them: by the
+    chain of the donor and then by acceptor.
+    """
+
+    index = pdb_data.get_residue_index()
+    positions = pdb_data.atom_table.positions
+    backbone = dict((name, residue_atoms(pdb_data, (name,))) for name in BACKBONE_ATOMS)
+    hydrogens = amide_hydrogen_positions(pdb_data, backbone)
+
+    donors = numpy.flatnonzero((backbone["N"] >= 0) & ~numpy.isnan(hydrogens[:, 0]))
+    acceptors = numpy.flatnonzero((backbone["O"] >= 0) & (backbone["C"] >= 0))
+    found_donors, found_acceptors = CellList(positions[backbone["O"][acceptors]], HBOND_DISTANCE).query_radius(
+        positions[backbone["N"][donors]], HBOND_DISTANCE)
+    donors, acceptors = donors[found_donors], acceptors[found_acceptors]
+
+    # Residues close together along a chain are not hydrogen bonded
+    chains = numpy.zeros(len(index), dtype=numpy.int64)
+    chains[index.chain_breaks] = 1
+    chains = numpy.cumsum(chains)
+    separated = (chains[donors] != chains[acceptors]) | (numpy.abs(donors - acceptors) >= HBOND_MIN_SEPARATION)
+    donors, acceptors = donors[separated], acceptors[separated]
+
+    nitrogen = positions[backbone["N"][donors]]
+    hydrogen = hydrogens[donors]
+    oxygen = positions[backbone["O"][acceptors]]
+    carbon = positions[backbone["C"][acceptors]]
+    bonded = ((numpy.linalg.norm(oxygen - hydrogen, axis=1) <= HBOND_H_DISTANCE) &
+              (_angles(nitrogen, hydrogen, oxygen) >= HBOND_ANGLE) &
+              (_angles(carbon, oxygen, hydrogen) >= HBOND_ACCEPTOR_ANGLE))
+    donors, acceptors = donors[bonded], acceptors[bonded]
+    order = numpy.lexsort((donors, acceptors, chains[donors]))
+    return donors[order], acceptors[order]
+
+def count_wrappers(pdb_data, donors, acceptors, radius=DESOLVATION_RADIUS):
+    """
+    Count the nonpolar carbons within radius of the alpha carbon of either
+    residue of each bond. Returns an array of the counts.
+    """
+
+    positions = pdb_data.atom_table.positions
+    alpha = residue_atoms(pdb_data, ("CA",))
+    carbons = nonpolar_carbons(pdb_data)
+    bond_count = len(donors)
+    if not bond_count or not len(carbons):
+        return numpy.zeros(bond_count, dtype=int)
+
+    centers = numpy.concatenate((alpha[donors], alpha[acceptors]))
+    queries, wrappers = CellList(positions[carbons], radius).query_radius(positions[centers], radius)
+    # A carbon in both spheres only wraps the bond once
+    wrapped = numpy.unique((queries % bond_count) * len(carbons) + wrappers)
+    return numpy.bincount(wrapped // len(carbons), minlength=bond_count)
+
+def find_dehydrons(pdb_data, threshold=DEHYDRON_WRAPPING, radius=DESOLVATION_RADIUS):
+    """
+    Find the dehydrons in the data: backbone hydrogen bonds wrapped by fewer
+    than threshold nonpolar carbons. Returns them in the same form as
+    wrappa.get_dehydrons, a list of ((sequence id, chain id), (sequence id,
+    chain id)) of the donor and acceptor residues.
+    """
+
+    donors, acceptors = find_hydrogen_bonds(pdb_data)
+    alpha = residue_atoms(pdb_data, ("CA",))
+    has_alpha = (alpha[donors] >= 0) & (alpha[acceptors] >= 0)
+    donors, acceptors = donors[has_alpha], acceptors[has_alpha]
+    underwrapped = count_wrappers(pdb_data, donors, acceptors, radius) < threshold
+
+    index = pdb_data.get_residue_index()
+    return [((index.sequence_ids[x], index.chain_ids[x]), (index.sequence_ids[y], index.chain_ids[y]))
+            for x, y in zip(donors[underwrapped].tolist(), acceptors[underwrapped].tolist())]